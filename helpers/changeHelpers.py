@@ -0,0 +1,170 @@
+#
+# Change manifests for downstream cache invalidation
+# Every run records the keys of the records it inserted, updated and deleted
+# per source as zlib compressed chunks in log_db, linked from the ingest log
+# document. changeMembers remembers every record key seen so far, which is
+# what tells an insert apart from an update
+#
+
+# Core python modules
+import json
+import logging
+import time
+import zlib
+from datetime import datetime
+
+# import database tools
+from bson import ObjectId
+from bson.binary import Binary
+from pymongo import ASCENDING, InsertOne, DeleteOne
+
+logger = logging.getLogger('ingest.changes')
+
+CHANGES = ['inserted', 'updated', 'deleted']
+
+BATCH_SIZE = 1000
+
+def packKeys(keys):
+    return Binary(zlib.compress(json.dumps(keys, separators=(',', ':'))))
+
+def unpackKeys(packed):
+    return json.loads(zlib.decompress(packed))
+
+def readChanges(manifests, ingestID, source):
+    # Returns {change: [record keys]} for one source of one run
+    changes = dict((change, []) for change in CHANGES)
+    for chunk in manifests.find({'ingestID': ingestID, 'source': source}).sort('_id', ASCENDING):
+        changes[chunk['change']].extend(unpackKeys(chunk['keys']))
+    return changes
+
+class manifestWriter:
+    # Buffers keys per change and writes them out a chunk at a time
+    def __init__(self, manifests, ingests, ingestID, source, chunkSize):
+        self.manifests = manifests
+        self.ingests = ingests
+        self.ingestID = ingestID
+        self.source = source
+        self.chunkSize = chunkSize
+        self.pending = dict((change, []) for change in CHANGES)
+        self.counts = dict((change, 0) for change in CHANGES)
+        self.chunks = 0
+
+    def add(self, change, keys):
+        self.pending[change].extend(keys)
+        self.counts[change] += len(keys)
+        while len(self.pending[change]) >= self.chunkSize:
+            self.writeChunk(change, self.pending[change][:self.chunkSize])
+            self.pending[change] = self.pending[change][self.chunkSize:]
+
+    def writeChunk(self, change, keys):
+        if self.ingestID is None:
+            return
+        self.manifests.insert_one({'ingestID': self.ingestID, 'source': self.source, 'change': change, 'count': len(keys), 'keys': packKeys(keys), 'created': datetime.utcnow()})
+        self.chunks += 1
+
+    def close(self, fullRefresh=False):
+        for change in CHANGES:
+            if self.pending[change]:
+                self.writeChunk(change, self.pending[change])
+                self.pending[change] = []
+        if self.ingestID is None:
+            return self.counts
+        logField = 'change_manifest.' + self.source
+        update = {'$inc': dict((logField + '.' + change, count) for change, count in self.counts.items())}
+        update['$inc'][logField + '.chunks'] = self.chunks
+        update['$set'] = {'change_manifest.collection': self.manifests.name}
+        if fullRefresh:
+            update['$set'][logField + '.full_refresh'] = True
+        self.ingests.update_one({'_id': self.ingestID}, update)
+        return self.counts
+
+class changeBuilder:
+    # Same interface as the endpoint builders. Without an ingestID only
+    # changeMembers is kept up to date and no manifest is written
+    def __init__(self, client, config, recordKeys, ingestID=None):
+        self.recordKeys = recordKeys
+        self.ingestID = ingestID
+        self.chunkSize = config.get('change_manifest_chunk', 10000)
+        self.retentionDays = config.get('change_manifest_days', 30)
+        logDB = client[config['log_db']]
+        self.manifests = logDB[config.get('change_manifest_coll', 'changeManifests')]
+        self.ingests = logDB[config['ingest_collection']]
+        self.members = client[config['endpoints_db']][config.get('change_members_coll', 'changeMembers')]
+
+    def ensureIndexes(self):
+        self.members.create_index([('source', ASCENDING), ('seen', ASCENDING)])
+        self.manifests.create_index([('ingestID', ASCENDING), ('source', ASCENDING)])
+        # Old manifests expire on their own
+        self.manifests.create_index('created', expireAfterSeconds=int(self.retentionDays * 86400))
+
+    def writer(self, source):
+        return manifestWriter(self.manifests, self.ingests, self.ingestID, source, self.chunkSize)
+
+    def update(self, source, collection, query):
+        # Records of the query that are already members were updated, the
+        # rest were inserted
+        self.ensureIndexes()
+        startTime = time.time()
+        writer = self.writer(source)
+        self.scan(source, collection, query, writer)
+        counts = writer.close()
+        logger.info("%s changes: %d inserted, %d updated in %.1fs", source, counts['inserted'], counts['updated'], time.time() - startTime)
+        return counts
+
+    def scan(self, source, collection, query, writer, seen=None):
+        recordKey = self.recordKeys[source]
+        batch = []
+        for record in collection.find(query, {recordKey: 1}, batch_size=BATCH_SIZE):
+            if record.get(recordKey) is not None:
+                batch.append(record[recordKey])
+            if len(batch) >= BATCH_SIZE:
+                self.applyBatch(source, batch, writer, seen)
+                batch = []
+        if batch:
+            self.applyBatch(source, batch, writer, seen)
+
+    def applyBatch(self, source, keys, writer, seen):
+        # seen stamps the members found by a full rebuild
+        memberIDs = [source + ':' + str(key) for key in keys]
+        existing = set(member['_id'] for member in self.members.find({'_id': {'$in': memberIDs}}, {'_id': 1}))
+        inserted = [key for memberID, key in zip(memberIDs, keys) if memberID not in existing]
+        memberOps = [InsertOne({'_id': source + ':' + str(key), 'source': source, 'record': key, 'seen': seen}) for key in inserted]
+        if memberOps:
+            self.members.bulk_write(memberOps, ordered=False)
+        writer.add('inserted', inserted)
+        if seen is None:
+            writer.add('updated', [key for memberID, key in zip(memberIDs, keys) if memberID in existing])
+        elif existing:
+            self.members.update_many({'_id': {'$in': list(existing)}}, {'$set': {'seen': seen}})
+
+    def remove(self, source, records):
+        # For records deleted from a source
+        self.ensureIndexes()
+        writer = self.writer(source)
+        writer.add('deleted', list(records))
+        self.members.delete_many({'_id': {'$in': [source + ':' + str(record) for record in records]}})
+        counts = writer.close()
+        logger.info("%s changes: %d deleted", source, counts['deleted'])
+        return counts
+
+    def rebuild(self, source, collection):
+        # A full refresh replaces every record, so updates are not listed and
+        # the manifest is flagged as a full refresh. Inserts are the keys that
+        # weren't members, deletes the members that weren't found again
+        self.ensureIndexes()
+        startTime = time.time()
+        seen = ObjectId()
+        writer = self.writer(source)
+        self.scan(source, collection, {}, writer, seen=seen)
+        deleteOps = []
+        for member in self.members.find({'source': source, 'seen': {'$ne': seen}}, {'record': 1}):
+            writer.add('deleted', [member.get('record')])
+            deleteOps.append(DeleteOne({'_id': member['_id']}))
+            if len(deleteOps) >= BATCH_SIZE:
+                self.members.bulk_write(deleteOps, ordered=False)
+                deleteOps = []
+        if deleteOps:
+            self.members.bulk_write(deleteOps, ordered=False)
+        counts = writer.close(fullRefresh=True)
+        logger.info("%s full refresh changes: %d inserted, %d deleted in %.1fs", source, counts['inserted'], counts['deleted'], time.time() - startTime)
+        return counts
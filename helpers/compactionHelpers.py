@@ -0,0 +1,41 @@
+#
+# Drops empty columns from documents before they are written to mongo
+#
+
+# Core python modules
+import logging
+
+logger = logging.getLogger('ingest.compaction')
+
+class compactionStats:
+    def __init__(self, source):
+        self.source = source
+        self.documents = 0
+        self.fieldsIn = 0
+        self.fieldsKept = 0
+        # Encoded size of the dropped elements: type byte, key, key terminator
+        # and the value itself (an empty BSON string is 5 bytes, null is 0)
+        self.bytesDropped = 0
+
+    def ratio(self):
+        if not self.fieldsIn:
+            return 1.0
+        return float(self.fieldsKept) / self.fieldsIn
+
+    def summary(self):
+        return "%s compaction kept %d of %d fields across %d documents (%.1f%% dropped, ~%d bytes saved)" % (self.source, self.fieldsKept, self.fieldsIn, self.documents, (1 - self.ratio()) * 100, self.bytesDropped)
+
+def compactDocuments(documents, keepFields, stats):
+    # Removes None and empty string values in place, except for keepFields
+    for document in documents:
+        stats.documents += 1
+        stats.fieldsIn += len(document)
+        emptyFields = [field for field, value in document.iteritems() if (value is None or value == '') and field not in keepFields]
+        for field in emptyFields:
+            if document[field] is None:
+                stats.bytesDropped += len(field) + 2
+            else:
+                stats.bytesDropped += len(field) + 7
+            del document[field]
+        stats.fieldsKept += len(document)
+    return documents
@@ -0,0 +1,108 @@
+#
+# Schema driven type conversion for CSV sources
+# Converts whole columns at a time so that documents reach mongo with
+# consistent types instead of mongoimport's per-value guesses
+#
+
+# Core python modules
+import logging
+import re
+import time
+
+# Data parsing
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('ingest.conversion')
+
+# Columns not listed here are kept as strings
+SCHEMAS = {
+    'idigbio': {
+        'float': ['dwc:decimalLatitude', 'dwc:decimalLongitude', 'dwc:coordinateUncertaintyInMeters', 'dwc:minimumElevationInMeters', 'dwc:maximumElevationInMeters', 'dwc:minimumDepthInMeters', 'dwc:maximumDepthInMeters'],
+        'integer': ['dwc:individualCount', 'dwc:year', 'dwc:month', 'dwc:day', 'dwc:startDayOfYear', 'dwc:endDayOfYear'],
+        'date': ['idigbio:dateModified', 'dcterms:modified']
+    },
+    'pbdb': {
+        'float': ['lng', 'lat', 'paleolng', 'paleolat', 'max_ma', 'min_ma', 'early_age', 'late_age'],
+        'integer': ['occurrence_no', 'reid_no', 'collection_no', 'reference_no', 'identified_no', 'accepted_no', 'pubyr', 'n_occs'],
+        'date': ['created', 'modified']
+    }
+}
+
+CHUNK_ROWS = 10000
+
+# What mongoimport parses as numbers when it guesses the type of a CSV value
+INTEGER_PATTERN = re.compile(r'^[-+]?[0-9]+$')
+FLOAT_PATTERN = re.compile(r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$|^[-+]?(inf|infinity|nan)$', re.IGNORECASE)
+INT64_MAX = 2 ** 63 - 1
+
+def guessValue(value):
+    # Integers that don't fit in 64 bits are stored as doubles, as
+    # mongoimport does. Everything else stays a string
+    if INTEGER_PATTERN.match(value):
+        number = int(value)
+        if -INT64_MAX - 1 <= number <= INT64_MAX:
+            return number
+        return float(value)
+    if FLOAT_PATTERN.match(value):
+        return float(value)
+    return value
+
+def guessColumns(frame, schema):
+    # Columns the schema doesn't type get mongoimport's per-value guesses, so
+    # documents written in-process match the ones mongoimport writes
+    typedColumns = set()
+    for columns in schema.values():
+        typedColumns.update(columns)
+    for column in frame.columns:
+        if column not in typedColumns:
+            frame[column] = pd.Series([guessValue(value) for value in frame[column]], index=frame.index, dtype=object)
+    return frame
+
+def convertFrame(frame, schema):
+    # Missing or unparseable values become None rather than NaN/NaT so that
+    # every stored value of a column has the same BSON type
+    for column in schema.get('float', []):
+        if column in frame.columns:
+            values = pd.to_numeric(frame[column], errors='coerce')
+            converted = values.astype(object)
+            converted[values.isnull()] = None
+            frame[column] = converted
+    for column in schema.get('integer', []):
+        if column in frame.columns:
+            values = pd.to_numeric(frame[column], errors='coerce')
+            whole = values.notnull() & (values == np.floor(values))
+            converted = pd.Series([None] * len(values), index=values.index, dtype=object)
+            converted[whole] = values[whole].astype(np.int64).astype(object)
+            frame[column] = converted
+    for column in schema.get('date', []):
+        if column in frame.columns:
+            values = pd.to_datetime(frame[column], errors='coerce', utc=True).dt.tz_convert(None)
+            converted = pd.Series(values.dt.to_pydatetime(), index=values.index, dtype=object)
+            converted[values.isnull()] = None
+            frame[column] = converted
+    return frame.to_dict('records')
+
+def iterTypedDocuments(csvSource, schemaName, chunkRows=CHUNK_ROWS, guessTypes=False):
+    # csvSource is a file path or a file-like object. Yields lists of typed
+    # documents, one per parsed chunk. guessTypes types the remaining columns
+    # the way mongoimport would
+    schema = SCHEMAS.get(schemaName, {})
+    reader = pd.read_csv(csvSource, sep=",", dtype=str, keep_default_na=False, chunksize=chunkRows)
+    rowCount = 0
+    convertTime = 0.0
+    while True:
+        # Only parsing and conversion are timed, not the consumer's writes
+        chunkStart = time.time()
+        try:
+            frame = next(reader)
+        except StopIteration:
+            break
+        if guessTypes:
+            frame = guessColumns(frame, schema)
+        documents = convertFrame(frame, schema)
+        convertTime += time.time() - chunkStart
+        rowCount += len(documents)
+        yield documents
+    if convertTime > 0:
+        logger.info("Converted %d %s rows at %.0f rows/sec" % (rowCount, schemaName, rowCount / convertTime))
@@ -0,0 +1,37 @@
+#
+# Collection counts cached for the length of a run
+# Counts come from collection metadata unless an exact count is asked for,
+# and are dropped from the cache whenever the run writes to that collection
+#
+
+# Core python modules
+import logging
+import threading
+
+logger = logging.getLogger('ingest.counts')
+
+counts = {}
+countsLock = threading.Lock()
+
+def getCount(collection, exact=False):
+    namespace = collection.full_name
+    if not exact:
+        with countsLock:
+            if namespace in counts:
+                return counts[namespace]
+        count = collection.estimated_document_count()
+    else:
+        # Only for reconciliation against the providers' counts
+        count = collection.count_documents({})
+    logger.debug("Counted " + str(count) + " documents in " + namespace)
+    with countsLock:
+        counts[namespace] = count
+    return count
+
+def invalidate(namespace):
+    with countsLock:
+        counts.pop(namespace, None)
+
+def resetCounts():
+    with countsLock:
+        counts.clear()
@@ -0,0 +1,218 @@
+#
+# Long running ingest daemon
+# Keeps the sources, mongo clients and caches warm between runs and ingests
+# small per source deltas on a schedule set in the "daemon" config. A local
+# http endpoint reports health and accepts control requests
+#
+
+# Core python modules
+import json
+import logging
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# local modules
+import mongoConnect
+from helpers import countHelpers
+from helpers import logHelpers
+
+logger = logging.getLogger('ingest.daemon')
+
+DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 8750,
+    'interval': 3600,
+    'intervals': {},
+    'window_overlap': 600,
+    'index_check_interval': 86400,
+    'tick': 5
+}
+
+class ingestDaemon:
+    def __init__(self, sources, runSource, tests, settings, logFiles, removeDeleted=False):
+        # sources maps each source name to its (reused) ingester instance and
+        # runSource is the same per source pipeline a single run uses
+        self.sources = sources
+        self.runSource = runSource
+        self.tests = tests
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings)
+        self.logFiles = logFiles
+        self.removeDeleted = removeDeleted
+        self.stopEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.state = {}
+        for source in sources:
+            self.state[source] = {'status': 'WAITING', 'running': False, 'paused': False, 'lastRun': None, 'lastSuccess': None, 'nextRun': time.time(), 'runs': 0, 'failures': 0}
+        self.lastIndexCheck = time.time()
+        self.server = None
+
+    def interval(self, source):
+        return self.settings['intervals'].get(source, self.settings['interval'])
+
+    def run(self):
+        self.loadLastIngests()
+        self.startServer()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        logger.info("Ingest daemon started for " + ', '.join(self.sources))
+        try:
+            while not self.stopEvent.is_set():
+                self.runDue()
+                self.stopEvent.wait(self.settings['tick'])
+        except KeyboardInterrupt:
+            self.stop()
+        logger.info("Ingest daemon stopping, waiting for running ingests")
+        for source in self.sources:
+            while self.state[source]['running']:
+                time.sleep(1)
+        if self.server:
+            self.server.shutdown()
+        logger.info("Ingest daemon stopped")
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def loadLastIngests(self):
+        # Picks the delta windows up where the last completed ingest left off
+        mongoConn = mongoConnect.mongoConnect()
+        for source in self.sources:
+            lastIngest = mongoConn.getLastIngestDate(source)
+            if lastIngest:
+                self.state[source]['lastSuccess'] = lastIngest
+                logger.info("Last completed ingest of " + source + " started " + str(lastIngest))
+        mongoConn.closeConnection()
+
+    def runDue(self):
+        now = time.time()
+        indexCheck = now - self.lastIndexCheck >= self.settings['index_check_interval']
+        if indexCheck:
+            self.lastIndexCheck = now
+        for source, state in self.state.items():
+            with self.lock:
+                if state['running'] or state['paused'] or state['nextRun'] > now:
+                    continue
+                state['running'] = True
+            sourceThread = threading.Thread(target=self.runOnce, args=(source, indexCheck))
+            sourceThread.daemon = True
+            sourceThread.start()
+
+    def runOnce(self, source, indexCheck=False):
+        state = self.state[source]
+        ingester = self.sources[source]
+        startTime = time.time()
+        started = datetime.utcnow()
+        try:
+            # Counts are only cached for the length of one run
+            countHelpers.resetCounts()
+            ingestID = logHelpers.createMongoLog([source])
+            ingester.ingestLog = ingestID
+            if state['lastSuccess']:
+                ingester.setRefreshWindow(state['lastSuccess'] - timedelta(seconds=self.settings['window_overlap']))
+            results = {}
+            self.runSource(source, ingester, self.tests, ingestID, self.removeDeleted, False, False, results, indexCheck=indexCheck)
+            status = results.get(source, 'INGEST ERROR')
+            if status == 'SUCCESS':
+                logHelpers.logRunTime(ingestID, startTime, time.time())
+        except Exception:
+            logger.error("Daemon run of " + source + " raised an exception\n" + traceback.format_exc())
+            status = 'INGEST ERROR'
+
+        with self.lock:
+            state['status'] = status
+            state['lastRun'] = started
+            state['runs'] += 1
+            if status == 'SUCCESS':
+                state['lastSuccess'] = started
+            else:
+                state['failures'] += 1
+            state['nextRun'] = time.time() + self.interval(source)
+            state['running'] = False
+        logger.info("Daemon run of " + source + " finished with " + status + " in %.1fs", time.time() - startTime)
+        if status != 'SUCCESS':
+            logHelpers.emailLogAndStatus(status, self.logFiles[0], self.logFiles[1], source + ": " + status)
+
+    def trigger(self, source):
+        with self.lock:
+            if source not in self.state:
+                return False
+            self.state[source]['nextRun'] = 0
+            self.state[source]['paused'] = False
+        return True
+
+    def pause(self, source, paused=True):
+        with self.lock:
+            if source not in self.state:
+                return False
+            self.state[source]['paused'] = paused
+        return True
+
+    def health(self):
+        with self.lock:
+            sources = {}
+            for source, state in self.state.items():
+                sources[source] = dict(state)
+                for field in ['lastRun', 'lastSuccess']:
+                    if sources[source][field]:
+                        sources[source][field] = sources[source][field].isoformat()
+                sources[source]['nextRun'] = datetime.utcfromtimestamp(state['nextRun']).isoformat()
+        healthy = all(state['status'] in ['SUCCESS', 'WAITING'] for state in sources.values())
+        return healthy, {'status': 'ok' if healthy else 'degraded', 'stopping': self.stopEvent.is_set(), 'sources': sources}
+
+    def startServer(self):
+        try:
+            self.server = HTTPServer((self.settings['host'], self.settings['port']), controlHandler)
+        except Exception as e:
+            logger.error("Could not start the daemon control endpoint: " + str(e))
+            return False
+        self.server.ingestDaemon = self
+        serverThread = threading.Thread(target=self.server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+        logger.info("Daemon control endpoint listening on " + self.settings['host'] + ":" + str(self.settings['port']))
+        return True
+
+class controlHandler(BaseHTTPRequestHandler):
+    # GET  /health            state of every source (503 if any last run failed)
+    # POST /run/<source>      run a source now
+    # POST /pause/<source>    stop scheduling a source
+    # POST /resume/<source>   start scheduling it again
+    # POST /stop              finish running ingests and exit
+    def do_GET(self):
+        if self.path.rstrip('/') != '/health':
+            return self.respond(404, {'error': 'unknown path'})
+        healthy, body = self.server.ingestDaemon.health()
+        self.respond(200 if healthy else 503, body)
+
+    def do_POST(self):
+        daemon = self.server.ingestDaemon
+        parts = self.path.strip('/').split('/')
+        if parts == ['stop']:
+            daemon.stop()
+            return self.respond(202, {'stopping': True})
+        if len(parts) != 2:
+            return self.respond(404, {'error': 'unknown path'})
+        action, source = parts
+        if action == 'run':
+            found = daemon.trigger(source)
+        elif action in ['pause', 'resume']:
+            found = daemon.pause(source, action == 'pause')
+        else:
+            return self.respond(404, {'error': 'unknown path'})
+        if not found:
+            return self.respond(404, {'error': 'unknown source ' + source})
+        self.respond(202, {action: source})
+
+    def respond(self, code, body):
+        payload = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("Control request: " + format % args)
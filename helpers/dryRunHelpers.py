@@ -0,0 +1,210 @@
+#
+# Dry runs of an ingest
+# Source data goes through the same download, parsing and validation stages
+# as a real run and is diffed against the live collection with read-only
+# queries. Nothing is written to mongo. The report covers what would be
+# inserted, updated and deleted, the throughput of each stage and a
+# projected run time
+#
+
+# Core python modules
+import logging
+import time
+
+# import database tools
+from bson import BSON
+
+# local modules
+from helpers import conversionHelpers
+from helpers import fingerprintHelpers
+from helpers import historyHelpers
+from helpers import ingestHelpers
+from helpers import streamHelpers
+
+logger = logging.getLogger('ingest.dryRun')
+
+BATCH_SIZE = 1000
+
+class stageMeter:
+    # Records and seconds spent in each stage, in the order they first ran
+    def __init__(self):
+        self.stages = []
+        self.totals = {}
+        self.startTime = time.time()
+
+    def add(self, stage, records, seconds):
+        if stage not in self.totals:
+            self.stages.append(stage)
+            self.totals[stage] = [0, 0.0]
+        self.totals[stage][0] += records
+        self.totals[stage][1] += seconds
+
+    def timed(self, stage, items, measure=len):
+        # Times the pulls from an iterator, which is where a streamed
+        # download or a parser spends its time
+        items = iter(items)
+        while True:
+            pullStart = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add(stage, 0, time.time() - pullStart)
+                return
+            self.add(stage, measure(item), time.time() - pullStart)
+            yield item
+
+    def elapsed(self):
+        return time.time() - self.startTime
+
+    def lines(self, units=None):
+        units = units or {}
+        stageLines = []
+        for stage in self.stages:
+            records, seconds = self.totals[stage]
+            rate = records / seconds if seconds else 0
+            stageLines.append("  %s: %d %s in %.1fs (%.0f/s)" % (stage, records, units.get(stage, 'records'), seconds, rate))
+        return stageLines
+
+def comparableValue(value, typed):
+    # mongoimport guesses the type of untyped CSV values, so without
+    # typed_import both sides are compared as strings
+    if isinstance(value, dict):
+        return comparableView(value, typed)
+    if isinstance(value, list):
+        return [comparableValue(item, typed) for item in value]
+    if typed or value is None or isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+def comparableView(document, typed, fields=None):
+    # Empty values are dropped, since compacted documents don't store them
+    view = {}
+    for field in (fields if fields is not None else document.keys()):
+        value = document.get(field)
+        if value is None or value == '':
+            continue
+        view[field] = comparableValue(value, typed)
+    return view
+
+class recordDiff:
+    # Looks up incoming documents by their record key and compares their
+    # fingerprints with the stored records, over the fields of the source.
+    # binaryIDs looks records up by the binary UUID _id, as the record key
+    # isn't indexed then
+    def __init__(self, collection, recordKey, typed, ignorePaths, binaryIDs=False):
+        self.collection = collection
+        self.recordKey = recordKey
+        self.typed = typed
+        self.binaryIDs = binaryIDs
+        self.ignorePaths = ignorePaths
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicate': 0, 'invalid': 0}
+        self.matched = 0
+        self.writeBytes = 0
+
+    def compare(self, documents):
+        for start in range(0, len(documents), BATCH_SIZE):
+            self.compareBatch(documents[start:start + BATCH_SIZE])
+
+    def compareBatch(self, documents):
+        keyed = {}
+        for document in documents:
+            key = document.get(self.recordKey)
+            if key is None or key == '':
+                self.counts['invalid'] += 1
+                continue
+            if self.lookupKey(key) in keyed:
+                # A real run skips these as duplicate keys
+                self.counts['duplicate'] += 1
+                continue
+            keyed[self.lookupKey(key)] = document
+        stored = {}
+        if self.binaryIDs:
+            lookup = {'_id': {'$in': [documentID for documentID in (ingestHelpers.uuidID(key) for key in keyed.keys()) if documentID is not None]}}
+        else:
+            lookup = {self.recordKey: {'$in': self.lookupValues(keyed.keys())}}
+        for record in self.collection.find(lookup):
+            stored[self.lookupKey(record.get(self.recordKey))] = record
+        for key, document in keyed.items():
+            record = stored.get(key)
+            if record is None:
+                self.counts['inserted'] += 1
+            else:
+                self.matched += 1
+                fields = document.keys()
+                incomingHash = fingerprintHelpers.fingerprint(comparableView(document, self.typed, fields), self.ignorePaths)
+                storedHash = fingerprintHelpers.fingerprint(comparableView(record, self.typed, fields), self.ignorePaths)
+                if incomingHash == storedHash:
+                    self.counts['unchanged'] += 1
+                    continue
+                self.counts['updated'] += 1
+            self.writeBytes += len(BSON.encode(document))
+
+    def lookupKey(self, key):
+        # Untyped keys arrive as strings but may be stored as numbers
+        if self.typed or key is None:
+            return key
+        return unicode(key)
+
+    def lookupValues(self, keys):
+        # Numeric strings are looked up as numbers as well
+        if self.typed:
+            return keys
+        values = list(keys)
+        for key in keys:
+            if key.isdigit():
+                values.append(int(key))
+        return values
+
+class dryRunReport:
+    def __init__(self, source, fullRefresh):
+        self.source = source
+        self.fullRefresh = fullRefresh
+        self.meter = stageMeter()
+        self.units = {'download': 'bytes'}
+        self.diff = None
+        self.deleted = 0
+        self.notes = []
+
+    def setDeleted(self, existingCount):
+        # Records a full refresh wouldn't bring back are deleted by the swap
+        if self.diff is not None:
+            self.deleted = max(0, existingCount - self.diff.matched)
+
+    def projectRunTime(self, ingests, records):
+        # The records per second of earlier real runs, which include the
+        # writes a dry run skips
+        rates = [run['rate'] for run in historyHelpers.sourceRuns(ingests, self.source) if run['rate']]
+        if not rates:
+            return None, 0
+        return records / historyHelpers.median(rates), len(rates)
+
+    def build(self, ingests):
+        counts = self.diff.counts if self.diff else {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicate': 0, 'invalid': 0}
+        incoming = sum(counts.values())
+        lines = ["%s dry run (%s)" % (self.source, 'full refresh' if self.fullRefresh else 'partial ingest')]
+        lines.append("  %d source records: %d would be inserted, %d updated, %d unchanged" % (incoming, counts['inserted'], counts['updated'], counts['unchanged']))
+        if counts['duplicate'] or counts['invalid']:
+            lines.append("  %d duplicate keys would be skipped, %d records have no record key" % (counts['duplicate'], counts['invalid']))
+        if self.fullRefresh:
+            lines.append("  %d live records are not in the source and would be deleted" % self.deleted)
+        if self.diff:
+            lines.append("  about %.1f MB of documents would be written" % (self.diff.writeBytes / 1048576.0))
+        lines.append("Stage throughput")
+        lines.extend(self.meter.lines(self.units))
+        projected, runCount = self.projectRunTime(ingests, incoming)
+        if projected is None:
+            lines.append("No earlier %s runs to project from. The dry run took %ds without any writes" % (self.source, self.meter.elapsed()))
+        else:
+            lines.append("Projected run time %ds at the median throughput of %d earlier runs (the dry run took %ds)" % (projected, runCount, self.meter.elapsed()))
+        lines.extend(self.notes)
+        report = '\n'.join(lines)
+        logger.info(report)
+        return report
+
+def parseSource(report, stage, csvSource, schemaName):
+    # For sources that are only merged into the records, such as the PBDB
+    # collections and references, parsing is all a dry run does with them
+    if not isinstance(csvSource, basestring):
+        csvSource = streamHelpers.chunkFile(csvSource)
+    for documents in report.meter.timed(stage, conversionHelpers.iterTypedDocuments(csvSource, schemaName)):
+        pass
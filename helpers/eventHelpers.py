@@ -0,0 +1,31 @@
+#
+# Sampled/aggregated logging of per record events in hot loops
+# Each event is counted, only every sampleEvery-th one is logged and the
+# totals are logged once at the end, so a large merge writes a handful of
+# lines instead of one per record
+#
+
+# Core python modules
+import logging
+
+class eventCounter:
+    def __init__(self, logger, event, sampleEvery=1000, level=logging.DEBUG):
+        self.logger = logger
+        self.event = event
+        self.sampleEvery = sampleEvery
+        self.level = level
+        self.count = 0
+        self.keys = {}
+        # Checked once instead of on every event
+        self.enabled = logger.isEnabledFor(level)
+
+    def record(self, key=None, outcome='ok'):
+        self.count += 1
+        self.keys[outcome] = self.keys.get(outcome, 0) + 1
+        if self.enabled and self.sampleEvery and self.count % self.sampleEvery == 0:
+            self.logger.log(self.level, "%s: %d so far, latest %s (%s)", self.event, self.count, key, outcome, extra={'event': self.event, 'eventCount': self.count})
+
+    def summary(self, level=logging.INFO):
+        outcomes = ', '.join('%s %d' % (outcome, count) for outcome, count in sorted(self.keys.items()))
+        self.logger.log(level, "%s: %d total (%s)", self.event, self.count, outcomes or 'none', extra={'event': self.event, 'eventCount': self.count, 'outcomes': dict(self.keys)})
+        return self.count
@@ -0,0 +1,65 @@
+#
+# Stable fingerprints of mongo documents
+# The document is walked directly with sorted keys and typed, length
+# prefixed values, so no JSON string or stripped copy is ever built
+#
+
+# Core python modules
+import hashlib
+from datetime import datetime
+
+# Paths are dotted field names. Arrays don't add to the path, so
+# 'coll_refs._id' matches the _id of every document in coll_refs. A path
+# ending in * matches every path it is a prefix of. The norm_* keys and the
+# geopoint are derived by the endpoint rebuild after a collection is live, so
+# they are left out as well, otherwise a fresh shadow never matches them
+DEFAULT_IGNORE_PATHS = frozenset(['_id', '_fingerprint', '_fingerprint_version', 'coll_refs._id', 'occ_refs._id', 'norm_*', 'geopoint'])
+
+# Stored fingerprints of another version were taken over other paths
+FINGERPRINT_VERSION = 2
+
+def fingerprint(document, ignorePaths=DEFAULT_IGNORE_PATHS):
+    digest = hashlib.md5()
+    exactPaths = frozenset(path for path in ignorePaths if not path.endswith('*'))
+    prefixes = tuple(path[:-1] for path in ignorePaths if path.endswith('*'))
+    hashValue(digest.update, document, '', (exactPaths, prefixes))
+    return digest.hexdigest()
+
+def hashValue(update, value, path, ignorePaths):
+    if isinstance(value, dict):
+        exactPaths, prefixes = ignorePaths
+        update('{')
+        for key in sorted(value):
+            childPath = path + '.' + key if path else key
+            if childPath in exactPaths or (prefixes and childPath.startswith(prefixes)):
+                continue
+            hashString(update, key)
+            hashValue(update, value[key], childPath, ignorePaths)
+        update('}')
+    elif isinstance(value, (list, tuple)):
+        update('[')
+        for item in value:
+            hashValue(update, item, path, ignorePaths)
+        update(']')
+    elif isinstance(value, basestring):
+        update('s')
+        hashString(update, value)
+    elif value is None:
+        update('n')
+    elif isinstance(value, bool):
+        update('t' if value else 'f')
+    elif isinstance(value, (int, long)):
+        update('i' + str(value) + ';')
+    elif isinstance(value, float):
+        update('d' + repr(value) + ';')
+    elif isinstance(value, datetime):
+        update('D' + value.isoformat() + ';')
+    else:
+        # ObjectId, Binary and any other BSON types
+        update('o' + type(value).__name__ + ':' + str(value) + ';')
+
+def hashString(update, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    update(str(len(value)) + ':')
+    update(value)
@@ -0,0 +1,110 @@
+#
+# GeoJSON points built from the source coordinates
+# Latitude/longitude columns are validated and written to a geopoint field
+# that a 2dsphere index (declared in test_indexes) can serve queries from
+#
+
+# Core python modules
+import logging
+import math
+import time
+
+# import database tools
+from pymongo import UpdateOne
+
+logger = logging.getLogger('ingest.geo')
+
+# Derived after a collection is live, so it is left out of sentinel
+# fingerprints (see fingerprintHelpers.DEFAULT_IGNORE_PATHS)
+GEO_FIELD = 'geopoint'
+
+# (latitude, longitude) fields, in the order they are tried
+COORDINATE_FIELDS = {
+    'idigbio': [('dwc:decimalLatitude', 'dwc:decimalLongitude')],
+    'pbdb': [('lat', 'lng')]
+}
+
+BATCH_SIZE = 1000
+
+def parseCoordinate(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        coordinate = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(coordinate) or math.isinf(coordinate):
+        return None
+    return coordinate
+
+def geoPoint(record, source):
+    # Returns a GeoJSON Point or None if the record has no usable coordinates.
+    # PBDB occurrences fall back to the coordinates of their collection
+    candidates = [record]
+    if source == 'pbdb':
+        candidates.extend(record.get('coll_refs') or [])
+    for candidate in candidates:
+        for latField, lngField in COORDINATE_FIELDS[source]:
+            lat = parseCoordinate(candidate.get(latField))
+            lng = parseCoordinate(candidate.get(lngField))
+            if lat is None or lng is None:
+                continue
+            if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                continue
+            # 0,0 is almost always a missing value exported as zeros
+            if lat == 0 and lng == 0:
+                continue
+            return {'type': 'Point', 'coordinates': [lng, lat]}
+    return None
+
+def addGeoFields(documents, source):
+    # Used on documents that pass through the ingest before they are written
+    for document in documents:
+        point = geoPoint(document, source)
+        if point:
+            document[GEO_FIELD] = point
+    return documents
+
+class geoBuilder:
+    # Same interface as the endpoint builders, but writes the points onto the
+    # source records themselves
+    def __init__(self, client, config):
+        self.client = client
+
+    def update(self, source, collection, query):
+        projection = {GEO_FIELD: 1}
+        for latField, lngField in COORDINATE_FIELDS[source]:
+            projection[latField] = 1
+            projection[lngField] = 1
+        if source == 'pbdb':
+            projection['coll_refs'] = 1
+        startTime = time.time()
+        updates = []
+        totals = {'records': 0, 'updated': 0, 'located': 0}
+        for record in collection.find(query, projection, batch_size=BATCH_SIZE):
+            totals['records'] += 1
+            point = geoPoint(record, source)
+            if point:
+                totals['located'] += 1
+            if record.get(GEO_FIELD) == point:
+                continue
+            if point:
+                updates.append(UpdateOne({'_id': record['_id']}, {'$set': {GEO_FIELD: point}}))
+            else:
+                updates.append(UpdateOne({'_id': record['_id']}, {'$unset': {GEO_FIELD: ''}}))
+            if len(updates) >= BATCH_SIZE:
+                collection.bulk_write(updates, ordered=False)
+                totals['updated'] += len(updates)
+                updates = []
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+            totals['updated'] += len(updates)
+        logger.info("Located %d of %d %s records (%d updated) in %.1fs", totals['located'], totals['records'], source, totals['updated'], time.time() - startTime)
+        return totals
+
+    def remove(self, source, records):
+        # The points go with the records
+        return None
+
+    def rebuild(self, source, collection):
+        return self.update(source, collection, {})
@@ -0,0 +1,105 @@
+#
+# Performance history of ingest runs
+# Reads the ingest log, works out per source throughput and flags runs that
+# are well outside the trailing baseline of earlier runs
+#
+
+# Core python modules
+import logging
+
+logger = logging.getLogger('ingest.history')
+
+DEFAULTS = {
+    'window': 14,
+    'threshold': 3.0,
+    'min_runs': 5,
+    'history': 90
+}
+
+def parseRunTime(timeString):
+    # addRunTime stores H:MM:SS
+    try:
+        hours, minutes, seconds = [int(part) for part in timeString.split(':')]
+    except (AttributeError, ValueError):
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+def sourceRuns(ingests, source):
+    # One entry per completed run of the source, oldest first. Runs logged
+    # before per source timings existed fall back to the run time of the
+    # whole ingest, but only when the source ran on its own
+    runs = []
+    for ingest in ingests:
+        if source not in ingest.get('ingestSources', []):
+            continue
+        seconds = ingest.get(source + '_run_seconds')
+        if seconds is None and len(ingest['ingestSources']) == 1:
+            seconds = ingest.get('runSeconds', parseRunTime(ingest.get('runTime')))
+        if not seconds:
+            continue
+        records = ingest.get(source + '_updated_records', 0)
+        runs.append({'date': ingest['ingestDate'], 'seconds': float(seconds), 'records': records, 'rate': records / float(seconds) if records else None})
+    return runs
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) / 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def robustScore(value, baseline):
+    # Distance from the baseline median in (scaled) median absolute
+    # deviations, which a few earlier outliers can't drag around
+    center = median(baseline)
+    spread = 1.4826 * median([abs(item - center) for item in baseline])
+    if not spread:
+        spread = abs(center) * 0.05 or 1.0
+    return (value - center) / spread, center
+
+def checkRun(run, baseline, threshold):
+    # Runs with records are judged on throughput, others on run time
+    findings = []
+    rates = [item['rate'] for item in baseline if item['rate']]
+    if run['rate'] and len(rates) >= max(1, len(baseline) / 2):
+        score, center = robustScore(run['rate'], rates)
+        if score < -threshold:
+            findings.append("throughput %.1f records/s against a baseline of %.1f (%.1f deviations)" % (run['rate'], center, -score))
+    else:
+        score, center = robustScore(run['seconds'], [item['seconds'] for item in baseline])
+        if score > threshold:
+            findings.append("run time %ds against a baseline of %ds (%.1f deviations)" % (run['seconds'], center, score))
+    return findings
+
+def findRegressions(runs, settings):
+    # Checks the latest run against the runs in the trailing window
+    if len(runs) <= settings['min_runs']:
+        return []
+    latest = runs[-1]
+    baseline = runs[-(settings['window'] + 1):-1]
+    return checkRun(latest, baseline, settings['threshold'])
+
+def buildReport(ingests, sources, settings=None):
+    # Returns the report text and whether any source regressed
+    runSettings = dict(DEFAULTS)
+    runSettings.update(settings or {})
+    lines = []
+    regressed = False
+    for source in sources:
+        runs = sourceRuns(ingests, source)
+        if not runs:
+            lines.append(source + ": no completed runs in the ingest log")
+            continue
+        latest = runs[-1]
+        summary = "%s: latest run %s took %ds" % (source, latest['date'].strftime('%Y-%m-%d %H:%M'), latest['seconds'])
+        if latest['rate']:
+            summary += " for %d records (%.1f records/s)" % (latest['records'], latest['rate'])
+        lines.append(summary)
+        findings = findRegressions(runs, runSettings)
+        if len(runs) <= runSettings['min_runs']:
+            lines.append("  only %d runs logged, no baseline yet" % len(runs))
+        for finding in findings:
+            regressed = True
+            lines.append("  SLOWER THAN USUAL: " + finding)
+            logger.warning("%s regression: %s", source, finding)
+    return '\n'.join(lines), regressed
@@ -0,0 +1,113 @@
+#
+# Index manager for the collections listed in test_indexes
+# Missing indexes for a collection are built with a single createIndexes
+# command and different collections are built at the same time
+#
+
+# Core python modules
+import logging
+import threading
+import time
+
+# import database tools
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import OperationFailure
+from bson.son import SON
+
+logger = logging.getLogger('ingest.indexes')
+
+def parseKey(key):
+    if isinstance(key, basestring):
+        return (key, ASCENDING)
+    return (key[0], key[1])
+
+def parseIndexSpec(spec):
+    # Specs in test_indexes can be a field name, a list of fields/[field,
+    # direction] pairs for a compound index, or an object with a "keys" list
+    # and any createIndexes options (name, unique, partialFilterExpression...)
+    options = {}
+    if isinstance(spec, basestring):
+        keys = [parseKey(spec)]
+    elif isinstance(spec, dict):
+        keys = [parseKey(key) for key in spec['keys']]
+        options = dict((option, value) for option, value in spec.items() if option != 'keys')
+    else:
+        keys = [parseKey(key) for key in spec]
+    return keys, options
+
+def keySignature(keys):
+    # Servers may report numeric directions as floats
+    signature = []
+    for field, direction in keys:
+        if isinstance(direction, (int, long, float)):
+            direction = int(direction)
+        signature.append((field, direction))
+    return tuple(signature)
+
+class indexManager:
+    def __init__(self, client, pollInterval=30):
+        self.client = client
+        self.pollInterval = pollInterval
+
+    def missingIndexes(self, db, collectionName, specs):
+        existingIndexes = self.client[db][collectionName].index_information()
+        existingKeys = set(keySignature(existingIndexes[indexName]['key']) for indexName in existingIndexes)
+        missing = []
+        for spec in specs:
+            keys, options = parseIndexSpec(spec)
+            if keySignature(keys) not in existingKeys:
+                missing.append(IndexModel(keys, **options))
+        return missing
+
+    def buildIndexes(self, db, collectionName, models):
+        namespace = db + '.' + collectionName
+        indexNames = [model.document['name'] for model in models]
+        logger.info("Building " + str(len(models)) + " indexes on " + namespace + ": " + ', '.join(indexNames))
+        startTime = time.time()
+        finished = threading.Event()
+        monitor = threading.Thread(target=self.reportProgress, args=(db, collectionName, finished))
+        monitor.daemon = True
+        monitor.start()
+        try:
+            self.client[db][collectionName].create_indexes(models)
+        except OperationFailure as e:
+            logger.error("Failed to build indexes on " + namespace + ": " + str(e))
+            return False
+        finally:
+            finished.set()
+        logger.info("Built indexes on %s in %.1f seconds" % (namespace, time.time() - startTime))
+        return True
+
+    def reportProgress(self, db, collectionName, finished):
+        namespace = db + '.' + collectionName
+        while not finished.wait(self.pollInterval):
+            try:
+                currentOps = self.client.admin.command(SON([('currentOp', 1), ('command.createIndexes', collectionName), ('ns', {'$regex': '^' + db + '\\.'})]))
+            except OperationFailure as e:
+                logger.debug("Can't read index build progress for " + namespace + ": " + str(e))
+                return
+            for op in currentOps.get('inprog', []):
+                progress = op.get('progress')
+                if progress and progress.get('total'):
+                    logger.info("Index build on %s: %d/%d (%.0f%%)" % (namespace, progress['done'], progress['total'], 100.0 * progress['done'] / progress['total']))
+                elif op.get('msg'):
+                    logger.info("Index build on " + namespace + ": " + op['msg'])
+
+    def buildAll(self, jobs):
+        # jobs is a list of (db, collectionName, models). Each collection gets
+        # its own thread so builds on different collections run concurrently
+        grouped = {}
+        for db, collectionName, models in jobs:
+            grouped.setdefault((db, collectionName), []).extend(models)
+        results = {}
+        workers = []
+        for (db, collectionName), models in grouped.items():
+            worker = threading.Thread(target=self.buildJob, args=(db, collectionName, models, results))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return all(results.values())
+
+    def buildJob(self, db, collectionName, models, results):
+        results[(db, collectionName)] = self.buildIndexes(db, collectionName, models)
@@ -7,10 +7,12 @@ from importlib import import_module
 import argparse
 import logging
 import json
-import hashlib
 import pandas as pd
 from tempfile import NamedTemporaryFile
 import csv
+import uuid
+
+from helpers import fingerprintHelpers
 
 # Create the helper logger
 logger = logging.getLogger('ingest.helpers')
@@ -24,31 +26,53 @@ def getSourceNames(sources):
 def createParser():
     parser = argparse.ArgumentParser(description="Import data from a range of sources into ePandda")
     parser.add_argument('-s', '--sources', nargs='+', help='REQUIRED. A list of sources to import data from', required=True)
-    parser.add_argument('-d', '--dryRun', action='store_true', help="Don't import only download & inspect collections")
+    parser.add_argument('-d', '--dryRun', action='store_true', help="Download, parse and diff the source data against ePandda without writing anything, then report the projected changes and run time")
     parser.add_argument('-t', '--test', action='store_true', help="Only import a subset of records for db testing")
     parser.add_argument('-l', '--logLevel', help="Set the level of message to be logged. Options: DEBUG|INFO|WARNING|ERROR")
     parser.add_argument('-F', '--fullRefresh', action='store_true', help="Set ingest to overwrite all ePandda records and download new records from providers")
     parser.add_argument('-D', '--removeDeleted', action='store_true', help="Set to run checks for deleted records from ingest sources and remove them from ePandda")
+    parser.add_argument('-S', '--stream', action='store_true', help="Stream downloads straight into mongoimport without writing source files to disk")
+    parser.add_argument('-c', '--concurrent', action='store_true', help="Run each source's ingest, indexing, delete check and counts at the same time")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Number of iDigBio collections to download and import at once during a full refresh")
+    parser.add_argument('-q', '--queue', help="Share an iDigBio full refresh with other ingest nodes through this named work queue. Use a new name for every run")
+    parser.add_argument('--snapshot', action='store_true', help="Write a parquet snapshot of each source after it ingests successfully")
+    parser.add_argument('--restore', nargs='?', const='latest', help="Restore the sources from a snapshot directory (default: the latest snapshot) instead of ingesting")
+    parser.add_argument('--report', action='store_true', help="Print the throughput of recent runs and flag regressions against earlier runs, then exit")
+    parser.add_argument('--rebuildEndpoints', action='store_true', help="Rebuild the linkage and summary collections in endpoints_db for the sources, then exit")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and ingest small updates from each source on the intervals in the daemon config")
+    parser.add_argument('--sample', type=int, help="Run the full pipeline on a seeded sample of this many records per source in scratch databases named after sample_db")
+    parser.add_argument('--sampleSets', type=int, help="Sample this many whole iDigBio recordsets (default sample_recordsets, 1)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the sampled records and recordsets")
     return parser
 
+def uuidID(value):
+    # iDigBio UUID string -> uuid used as a binary (subtype 4) _id
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def addUUIDIDs(documents):
+    for document in documents:
+        documentID = uuidID(document.get('idigbio:uuid'))
+        if documentID is not None:
+            document['_id'] = documentID
+    return documents
+
 def getMd5Hash(dict):
     # This calculates the hash of a python dict
-    # We dump to json so we can sort the keys, ensuring that we get the same hash
+    # Keys are walked in sorted order, ensuring that we get the same hash
     # for the same data
-    md5 = hashlib.md5(json.dumps(dict, sort_keys=True)).hexdigest()
-    return md5
+    return fingerprintHelpers.fingerprint(dict, ignorePaths=())
 
-def compareDocuments(source, sentinel):
-    for doc in [source, sentinel]:
-        if '_id' in doc:
-            doc.pop('_id', None)
-        for ref in ['coll_refs', 'occ_refs']:
-            if ref in doc:
-                for i in range(len(doc[ref])):
-                    if '_id' in doc[ref][i]:
-                        doc[ref][i].pop('_id', None)
-    sourceHash = getMd5Hash(source)
-    sentinelHash = getMd5Hash(sentinel)
+def compareDocuments(source, sentinel, ignorePaths=fingerprintHelpers.DEFAULT_IGNORE_PATHS):
+    # Neither document is modified. Sentinels carry the fingerprint taken when
+    # they were created, so usually only the source side gets hashed.
+    # Fingerprints of an older version are taken again from the sentinel
+    sentinelHash = sentinel.get('_fingerprint')
+    if sentinelHash is None or sentinel.get('_fingerprint_version') != fingerprintHelpers.FINGERPRINT_VERSION:
+        sentinelHash = fingerprintHelpers.fingerprint(sentinel, ignorePaths)
+    sourceHash = fingerprintHelpers.fingerprint(source, ignorePaths)
     if sourceHash != sentinelHash:
         return True
 
@@ -70,22 +94,32 @@ def csvDuplicateHeaderCheck(csvFile):
             duplicateHeaders.append(header)
     return duplicateHeaders
 
+def renameHeaderRow(row, duplicateHeaders=None):
+    # Numbers repeated header values (e.g. dwc:type -> dwc:type1, dwc:type2)
+    # mongoimport would otherwise keep only one of the repeated columns
+    if duplicateHeaders is None:
+        duplicateHeaders = [header for header in set(row) if row.count(header) > 1]
+    for duplicate in duplicateHeaders:
+        dupCount = 0
+        for i in range(len(row)):
+            if row[i] == duplicate:
+                logger.debug("Replacing bad header: " + duplicate)
+                dupCount += 1
+                row[i] = duplicate + str(dupCount)
+    return row
+
 def csvRenameDuplicateHeaders(csvFileName, duplicateHeaders):
     logger.info("Removing duplicate header values from " + csvFileName)
-    tempfile = NamedTemporaryFile(delete=False)
+    # Written next to the CSV, so it stays in the same scratch workspace and
+    # the move is a rename
+    tempfile = NamedTemporaryFile(delete=False, dir=os.path.dirname(csvFileName) or '.')
     with open(csvFileName, 'rb') as csvFile, tempfile:
         reader = csv.reader(csvFile)
         writer = csv.writer(tempfile)
         rowCount = 0
         for row in reader:
             if rowCount == 0:
-                for duplicate in duplicateHeaders:
-                    dupCount = 0
-                    for i in range(len(row)):
-                        if row[i] == duplicate:
-                            logger.debug("Replacing bad header: " + duplicate)
-                            dupCount += 1
-                            row[i] = duplicate + str(dupCount)
+                row = renameHeaderRow(row, duplicateHeaders)
             writer.writerow(row)
             rowCount += 1
     shutil.move(tempfile.name, csvFileName)
@@ -0,0 +1,140 @@
+#
+# Materialized linkage between iDigBio specimens and PBDB occurrences
+# Records are grouped on a normalized genus|formation|stage|locality key.
+# The linkage collection holds one document per key with per source counts
+# and linkMembers maps every linked record to its key, so finding the
+# occurrences for a specimen (or the reverse) is two index lookups
+#
+
+# Core python modules
+import logging
+import time
+from datetime import datetime
+
+# import database tools
+from pymongo import ASCENDING, ReplaceOne, DeleteOne, UpdateOne
+
+# local modules
+from helpers import normalizeHelpers
+
+logger = logging.getLogger('ingest.linkage')
+
+KEY_PARTS = ['genus', 'formation', 'stage', 'locality']
+
+# Source field for each part of the key
+LINK_FIELDS = {
+    'idigbio': {'genus': 'dwc:genus', 'formation': 'dwc:formation', 'stage': 'dwc:earliestAgeOrLowestStage', 'locality': 'dwc:stateProvince'},
+    'pbdb': {'genus': 'genus', 'formation': 'formation', 'stage': 'early_interval', 'locality': 'state'}
+}
+
+BATCH_SIZE = 1000
+
+def normalizeValue(value):
+    # Same folding as the norm_* key fields, with the key separator removed
+    normalized = normalizeHelpers.normalizeKey(value)
+    if not normalized:
+        return ''
+    return normalized.replace('|', ' ')
+
+def linkKey(record, fields):
+    # Records need a genus and a formation or stage to be linked
+    values = [normalizeValue(record.get(fields[part])) for part in KEY_PARTS]
+    genus, formation, stage, locality = values
+    if not genus or not (formation or stage):
+        return None
+    return '|'.join(values)
+
+def keyParts(key):
+    return dict(zip(KEY_PARTS, key.split('|')))
+
+class linkageBuilder:
+    def __init__(self, client, config, recordKeys):
+        # recordKeys maps each source to the field that identifies a record
+        self.client = client
+        self.recordKeys = recordKeys
+        endpoints = client[config['endpoints_db']]
+        self.linkage = endpoints[config.get('linkage_coll', 'linkage')]
+        self.members = endpoints[config.get('link_members_coll', 'linkMembers')]
+
+    def ensureIndexes(self):
+        self.members.create_index([('key', ASCENDING), ('source', ASCENDING)])
+        self.members.create_index([('source', ASCENDING), ('record', ASCENDING)])
+        for part in KEY_PARTS:
+            self.linkage.create_index(part)
+
+    def update(self, source, collection, query):
+        # Moves the records matched by query to their current keys and applies
+        # the change in membership to the per key counts
+        self.ensureIndexes()
+        fields = LINK_FIELDS[source]
+        recordKey = self.recordKeys[source]
+        projection = dict((field, 1) for field in fields.values())
+        projection[recordKey] = 1
+        startTime = time.time()
+        batch = []
+        totals = {'records': 0, 'moved': 0}
+        for record in collection.find(query, projection, batch_size=BATCH_SIZE):
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                self.applyBatch(source, batch, fields, recordKey, totals)
+                batch = []
+        if batch:
+            self.applyBatch(source, batch, fields, recordKey, totals)
+        self.removeEmptyKeys()
+        logger.info("Linked %d %s records (%d changed keys) in %.1fs", totals['records'], source, totals['moved'], time.time() - startTime)
+        return totals
+
+    def applyBatch(self, source, records, fields, recordKey, totals):
+        memberIDs = [source + ':' + str(record.get(recordKey)) for record in records]
+        existing = dict((member['_id'], member['key']) for member in self.members.find({'_id': {'$in': memberIDs}}, {'key': 1}))
+        deltas = {}
+        memberOps = []
+        for memberID, record in zip(memberIDs, records):
+            if record.get(recordKey) is None:
+                continue
+            newKey = linkKey(record, fields)
+            oldKey = existing.get(memberID)
+            if newKey == oldKey:
+                continue
+            if oldKey:
+                deltas[oldKey] = deltas.get(oldKey, 0) - 1
+            if newKey:
+                deltas[newKey] = deltas.get(newKey, 0) + 1
+                memberOps.append(ReplaceOne({'_id': memberID}, {'_id': memberID, 'source': source, 'record': record[recordKey], 'key': newKey}, upsert=True))
+            else:
+                memberOps.append(DeleteOne({'_id': memberID}))
+        totals['records'] += len(records)
+        totals['moved'] += len(memberOps)
+        if memberOps:
+            self.members.bulk_write(memberOps, ordered=False)
+        self.applyDeltas(source, deltas)
+
+    def applyDeltas(self, source, deltas):
+        linkOps = []
+        now = datetime.utcnow()
+        for key, delta in deltas.items():
+            if delta:
+                linkOps.append(UpdateOne({'_id': key}, {'$inc': {'counts.' + source: delta}, '$set': {'updated': now}, '$setOnInsert': keyParts(key)}, upsert=True))
+        if linkOps:
+            self.linkage.bulk_write(linkOps, ordered=False)
+
+    def remove(self, source, records):
+        # For records deleted from a source
+        memberIDs = [source + ':' + str(record) for record in records]
+        deltas = {}
+        for member in self.members.find({'_id': {'$in': memberIDs}}, {'key': 1}):
+            deltas[member['key']] = deltas.get(member['key'], 0) - 1
+        self.members.delete_many({'_id': {'$in': memberIDs}})
+        self.applyDeltas(source, deltas)
+        self.removeEmptyKeys()
+
+    def rebuild(self, source, collection):
+        # Full refreshes replace every record, so the source's links are
+        # rebuilt from scratch
+        logger.info("Rebuilding " + source + " linkage")
+        self.members.delete_many({'source': source})
+        self.linkage.update_many({}, {'$unset': {'counts.' + source: ''}})
+        return self.update(source, collection, {})
+
+    def removeEmptyKeys(self):
+        self.linkage.delete_many({'$and': [{'counts.' + source: {'$not': {'$gt': 0}}} for source in LINK_FIELDS]})
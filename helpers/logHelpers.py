@@ -6,6 +6,9 @@
 import logging
 import time
 import json
+import threading
+import atexit
+import Queue
 
 # Email modules
 import smtplib
@@ -16,6 +19,72 @@ from email import Encoders
 
 # local modules
 import mongoConnect
+from helpers import historyHelpers
+
+# Listeners started by createLog, stopped (and drained) on exit
+listeners = []
+
+class queueHandler(logging.Handler):
+    # Hands records to a listener thread so callers never wait on file or
+    # console writes. The message itself is formatted on the listener thread
+    def __init__(self, recordQueue):
+        logging.Handler.__init__(self)
+        self.recordQueue = recordQueue
+
+    def emit(self, record):
+        try:
+            if record.exc_info:
+                # Tracebacks can't outlive the calling frame, render them now
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.recordQueue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+class queueListener:
+    def __init__(self, recordQueue, handlers):
+        self.recordQueue = recordQueue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.recordQueue.get()
+            try:
+                if record is None:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self.recordQueue.task_done()
+
+    def flush(self):
+        self.recordQueue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.recordQueue.put(None)
+            self.thread.join()
+        for handler in self.handlers:
+            handler.flush()
+
+def flushLogs():
+    # Makes sure everything logged so far is on disk, e.g. before mailing the
+    # log files
+    for listener in listeners:
+        listener.flush()
+
+@atexit.register
+def stopLogs():
+    for listener in listeners:
+        listener.stop()
 
 def createLog(module, level, fileSuffix):
     logger = logging.getLogger(module)
@@ -39,8 +108,12 @@ def createLog(module, level, fileSuffix):
     fileLog.setFormatter(formatter)
     conLog.setFormatter(formatter)
 
-    logger.addHandler(fileLog)
-    logger.addHandler(conLog)
+    # The file and console handlers run behind a queue on their own thread
+    recordQueue = Queue.Queue()
+    listener = queueListener(recordQueue, [fileLog, conLog])
+    listener.start()
+    listeners.append(listener)
+    logger.addHandler(queueHandler(recordQueue))
     return logger, loggerFile
 
 def createMongoLog(sources):
@@ -72,11 +145,26 @@ def logRunTime(ingestID, startTime, endTime):
     timeString = "%d:%02d:%02d" % (hours, minutes, seconds)
     # open a mongo connection
     mongoConn = mongoConnect.mongoConnect()
-    ingestLogComplete = mongoConn.addRunTime(ingestID, timeString)
+    ingestLogComplete = mongoConn.addRunTime(ingestID, timeString, round(totalTime, 1))
     mongoConn.closeConnection()
     return ingestLogComplete
 
-def emailLogAndStatus(status, logFile, testLogFile):
+def logSourceRunTime(ingestID, source, seconds):
+    mongoConn = mongoConnect.mongoConnect()
+    sourceLogResult = mongoConn.addSourceRunTime(ingestID, source, round(seconds, 1))
+    mongoConn.closeConnection()
+    return sourceLogResult
+
+def regressionReport(sources):
+    # Throughput of the latest runs against their trailing baseline
+    config = json.load(open('./config.json'))
+    settings = config.get('regression', {})
+    mongoConn = mongoConnect.mongoConnect()
+    ingests = mongoConn.getIngestHistory(settings.get('history', historyHelpers.DEFAULTS['history']))
+    mongoConn.closeConnection()
+    return historyHelpers.buildReport(ingests, sources, settings)
+
+def emailLogAndStatus(status, logFile, testLogFile, summary=None):
     config = json.load(open('./config.json'))
     recipients = config['email_recipients']
     if len(recipients) > 1:
@@ -90,7 +178,11 @@ def emailLogAndStatus(status, logFile, testLogFile):
     msg["From"] = "michael@whirl-i-gig.com"
     msg["To"] = recipientString
 
-    msg.attach(MIMEText(status + "\nCheck the attached log files for a summary of the most recent run of the ePandda ingest service"))
+    flushLogs()
+    body = status + "\n"
+    if summary:
+        body += "\n" + summary + "\n\n"
+    msg.attach(MIMEText(body + "Check the attached log files for a summary of the most recent run of the ePandda ingest service"))
 
     for log in [logFile, testLogFile]:
         part = MIMEBase('application', "octect-stream")
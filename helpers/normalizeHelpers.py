@@ -0,0 +1,153 @@
+#
+# Normalized key fields for taxon and place columns
+# Values are ASCII folded, lowercased and whitespace collapsed into norm_*
+# fields that are indexed for exact match lookups. The vocabulary is small
+# compared to the number of records, so normalized values are memoized
+#
+
+# Core python modules
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# import database tools
+from pymongo import UpdateOne
+
+# Data parsing
+from unidecode import unidecode
+
+logger = logging.getLogger('ingest.normalize')
+
+# Key field -> source field
+KEY_FIELDS = {
+    'idigbio': {
+        'norm_family': 'dwc:family',
+        'norm_genus': 'dwc:genus',
+        'norm_formation': 'dwc:formation',
+        'norm_stage': 'dwc:earliestAgeOrLowestStage',
+        'norm_country': 'dwc:country',
+        'norm_state': 'dwc:stateProvince',
+        'norm_county': 'dwc:county'
+    },
+    'pbdb': {
+        'norm_family': 'family',
+        'norm_genus': 'genus',
+        'norm_formation': 'formation',
+        'norm_stage': 'early_interval',
+        'norm_country': 'cc',
+        'norm_state': 'state',
+        'norm_county': 'county'
+    }
+}
+
+BATCH_SIZE = 1000
+WHITESPACE = re.compile(r'\s+')
+
+class memoCache:
+    # Bounded least recently used cache
+    def __init__(self, maxSize=50000):
+        self.maxSize = maxSize
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.values:
+                value = self.values.pop(key)
+                self.values[key] = value
+                self.hits += 1
+                return value
+        value = compute(key)
+        with self.lock:
+            self.misses += 1
+            self.values[key] = value
+            if len(self.values) > self.maxSize:
+                self.values.popitem(last=False)
+        return value
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return "%d normalized values cached, %d of %d lookups hit" % (len(self.values), self.hits, lookups)
+
+keyCache = memoCache()
+
+def setCacheSize(maxSize):
+    keyCache.maxSize = maxSize
+
+def foldValue(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return WHITESPACE.sub(' ', unidecode(value).lower()).strip()
+
+def normalizeKey(value):
+    if value is None:
+        return None
+    if not isinstance(value, basestring):
+        value = str(value)
+    return keyCache.get(value, foldValue) or None
+
+def keyValues(record, source):
+    keys = {}
+    for keyField, sourceField in KEY_FIELDS[source].items():
+        normalized = normalizeKey(record.get(sourceField))
+        if normalized:
+            keys[keyField] = normalized
+    return keys
+
+def addKeyFields(documents, source):
+    # Used on documents that pass through the ingest before they are written
+    for document in documents:
+        document.update(keyValues(document, source))
+    return documents
+
+def indexSpecs(source):
+    return sorted(KEY_FIELDS[source])
+
+class keyBuilder:
+    # Same interface as the endpoint builders, but writes the key fields onto
+    # the source records themselves
+    def __init__(self, client, config, indexer):
+        self.client = client
+        self.indexer = indexer
+        setCacheSize(config.get('normalize_cache_size', 50000))
+
+    def update(self, source, collection, query):
+        self.indexer(source, collection)
+        fields = KEY_FIELDS[source]
+        projection = dict((field, 1) for field in fields.values() + fields.keys())
+        startTime = time.time()
+        updates = []
+        totals = {'records': 0, 'updated': 0}
+        for record in collection.find(query, projection, batch_size=BATCH_SIZE):
+            totals['records'] += 1
+            keys = keyValues(record, source)
+            changed = dict((keyField, value) for keyField, value in keys.items() if record.get(keyField) != value)
+            stale = dict((keyField, '') for keyField in fields if keyField in record and keyField not in keys)
+            if not changed and not stale:
+                continue
+            change = {}
+            if changed:
+                change['$set'] = changed
+            if stale:
+                change['$unset'] = stale
+            updates.append(UpdateOne({'_id': record['_id']}, change))
+            if len(updates) >= BATCH_SIZE:
+                collection.bulk_write(updates, ordered=False)
+                totals['updated'] += len(updates)
+                updates = []
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+            totals['updated'] += len(updates)
+        logger.info("Normalized keys of %d %s records (%d updated) in %.1fs. %s", totals['records'], source, totals['updated'], time.time() - startTime, keyCache.summary())
+        return totals
+
+    def remove(self, source, records):
+        # The key fields go with the records
+        return None
+
+    def rebuild(self, source, collection):
+        return self.update(source, collection, {})
@@ -0,0 +1,158 @@
+#
+# Lease based work queue in mongo for sharing a full refresh between nodes
+# Workers claim one item at a time and keep their lease alive with a
+# heartbeat. Items held by a worker that stops heartbeating are reclaimed,
+# failed items are retried until they have used up maxAttempts. The header
+# carries a heartbeat too, so a queue whose creator died while seeding it
+# can be taken over
+#
+
+# Core python modules
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+# import database tools
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger('ingest.queue')
+
+class workQueue:
+    def __init__(self, collection, queueName, leaseSeconds=600, maxAttempts=3):
+        self.collection = collection
+        self.queueName = queueName
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        self.workerID = socket.gethostname() + ':' + str(os.getpid())
+        self.heartbeatStop = threading.Event()
+        self.heartbeat = None
+        self.collection.create_index([('queue', ASCENDING), ('status', ASCENDING)])
+
+    def leaseExpiry(self):
+        return datetime.utcnow() + timedelta(seconds=self.leaseSeconds)
+
+    def staleBefore(self):
+        return datetime.utcnow() - timedelta(seconds=self.leaseSeconds)
+
+    def create(self):
+        # Only one worker creates the queue. It gets True back and is
+        # responsible for preparing the run and calling seed()
+        try:
+            self.collection.insert_one({'_id': self.queueName, 'queue': self.queueName, 'header': True, 'status': 'seeding', 'createdBy': self.workerID, 'created': datetime.utcnow(), 'lastSeen': datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        logger.info(self.workerID + " created work queue " + self.queueName)
+        return True
+
+    def takeOver(self):
+        # Takes over a queue whose creator stopped heartbeating before it was
+        # seeded, or that failed and is run again. Like create(), the worker
+        # that gets True prepares the run and calls seed()
+        staleSeeding = {'status': 'seeding', 'lastSeen': {'$lt': self.staleBefore()}}
+        header = self.collection.find_one_and_update({'_id': self.queueName, '$or': [staleSeeding, {'status': 'failed'}]}, {'$set': {'status': 'seeding', 'createdBy': self.workerID, 'lastSeen': datetime.utcnow()}, '$unset': {'finishedBy': '', 'finished': ''}})
+        if header is None:
+            return False
+        # The run starts over from a fresh shadow, so every item does too
+        self.collection.delete_many({'queue': self.queueName, 'header': {'$exists': False}})
+        logger.warning(self.workerID + " took over " + header['status'] + " work queue " + self.queueName)
+        return True
+
+    def activeQueues(self):
+        # Other queues whose workers are still heartbeating
+        active = self.collection.find({'header': True, '_id': {'$ne': self.queueName}, 'status': {'$in': ['seeding', 'ready', 'finishing']}, 'lastSeen': {'$gte': self.staleBefore()}}, {'_id': 1})
+        return [header['_id'] for header in active]
+
+    def seed(self, items):
+        # items are dicts with at least a unique 'key'
+        for order, item in enumerate(items):
+            item = dict(item)
+            item.update({'queue': self.queueName, 'status': 'pending', 'order': order, 'attempts': 0})
+            self.collection.update_one({'queue': self.queueName, 'key': item['key']}, {'$setOnInsert': item}, upsert=True)
+        self.collection.update_one({'_id': self.queueName}, {'$set': {'status': 'ready'}})
+        logger.info("Seeded " + str(len(items)) + " items into work queue " + self.queueName)
+
+    def waitUntilReady(self, pollSeconds=10):
+        while True:
+            header = self.collection.find_one({'_id': self.queueName})
+            if header and header['status'] != 'seeding':
+                return header['status']
+            if header and header.get('lastSeen', header['created']) < self.staleBefore():
+                logger.warning("The creator of work queue " + self.queueName + " stopped responding while seeding it")
+                return 'stale'
+            logger.debug("Waiting for work queue " + self.queueName + " to be seeded")
+            time.sleep(pollSeconds)
+
+    def retryable(self):
+        return {'status': 'failed', 'attempts': {'$lt': self.maxAttempts}}
+
+    def claim(self, sort=None):
+        now = datetime.utcnow()
+        if sort is None:
+            sort = [('order', ASCENDING)]
+        claimable = {'queue': self.queueName, 'header': {'$exists': False}, '$or': [{'status': 'pending'}, {'status': 'claimed', 'leaseExpires': {'$lt': now}}, self.retryable()]}
+        previous = self.collection.find_one_and_update(claimable, {'$set': {'status': 'claimed', 'owner': self.workerID, 'claimed': now, 'leaseExpires': self.leaseExpiry()}, '$inc': {'attempts': 1}}, sort=sort)
+        if previous is None:
+            return None
+        if previous['status'] == 'failed':
+            logger.warning("Retrying " + previous['key'] + " after " + str(previous['attempts']) + " failed attempts")
+        elif previous['status'] == 'claimed':
+            logger.warning("Reclaimed " + previous['key'] + " from a worker that stopped responding")
+        return self.collection.find_one({'_id': previous['_id']})
+
+    def complete(self, item, success):
+        # Only the current lease holder can complete an item
+        status = 'done' if success else 'failed'
+        result = self.collection.update_one({'queue': self.queueName, 'key': item['key'], 'owner': self.workerID, 'status': 'claimed'}, {'$set': {'status': status, 'finished': datetime.utcnow()}})
+        if result.modified_count != 1:
+            logger.warning("Lost the lease on " + item['key'] + " before it completed")
+            return False
+        return True
+
+    def startHeartbeat(self):
+        self.heartbeatStop.clear()
+        self.heartbeat = threading.Thread(target=self.renewLeases)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def stopHeartbeat(self):
+        self.heartbeatStop.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+
+    def renewLeases(self):
+        while not self.heartbeatStop.wait(self.leaseSeconds / 3):
+            try:
+                self.collection.update_many({'queue': self.queueName, 'owner': self.workerID, 'status': 'claimed'}, {'$set': {'leaseExpires': self.leaseExpiry()}})
+                self.collection.update_one({'_id': self.queueName}, {'$set': {'lastSeen': datetime.utcnow()}})
+            except Exception as e:
+                logger.error("Work queue heartbeat failed: " + str(e))
+
+    def hasUnfinished(self):
+        unfinished = self.collection.find_one({'queue': self.queueName, 'header': {'$exists': False}, '$or': [{'status': {'$in': ['pending', 'claimed']}}, self.retryable()]})
+        return unfinished is not None
+
+    def failedItems(self):
+        # Items that failed every attempt
+        return [item['key'] for item in self.collection.find({'queue': self.queueName, 'header': {'$exists': False}, 'status': 'failed'}, {'key': 1})]
+
+    def claimFinish(self):
+        # Once nothing is pending, claimed or left to retry, exactly one
+        # worker gets True and finishes the run
+        if self.hasUnfinished():
+            return False
+        header = self.collection.find_one_and_update({'_id': self.queueName, 'status': 'ready'}, {'$set': {'status': 'finishing', 'finishedBy': self.workerID}})
+        return header is not None
+
+    def markComplete(self, success):
+        status = 'complete' if success else 'failed'
+        self.collection.update_one({'_id': self.queueName}, {'$set': {'status': status, 'finished': datetime.utcnow()}})
+
+    def summary(self):
+        counts = {}
+        for item in self.collection.find({'queue': self.queueName, 'header': {'$exists': False}}, {'status': 1}):
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        return counts
@@ -0,0 +1,74 @@
+#
+# Deterministic samples of source data for sampled test runs
+# Rows are kept by the rank of a seeded hash of their record key, so the
+# same seed picks the same records whatever order they arrive in
+#
+
+# Core python modules
+import csv
+import hashlib
+import heapq
+import logging
+import random
+from cStringIO import StringIO
+
+logger = logging.getLogger('ingest.sample')
+
+def keyRank(key, seed):
+    return hashlib.md5(str(seed) + ':' + key).hexdigest()
+
+def iterLines(chunks):
+    # csv.reader wants lines, streams come in arbitrary chunks
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def sampleRows(lines, keyField, size, seed):
+    # Returns the header and the size rows with the lowest key rank
+    reader = csv.reader(lines)
+    header = next(reader)
+    keyIndex = header.index(keyField)
+    ranked = ((keyRank(row[keyIndex], seed), row) for row in reader if len(row) > keyIndex)
+    return header, [row for rank, row in heapq.nsmallest(size, ranked)]
+
+def writeRows(out, header, rows):
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+
+def sampleFile(csvFileName, keyField, size, seed):
+    # Rewrites a downloaded CSV with only its sampled rows
+    with open(csvFileName, 'rb') as csvFile:
+        header, rows = sampleRows(csvFile, keyField, size, seed)
+    with open(csvFileName, 'wb') as csvFile:
+        writeRows(csvFile, header, rows)
+    logger.info("Sampled %d rows of %s", len(rows), csvFileName)
+    return len(rows)
+
+def sampleChunks(chunks, keyField, size, seed):
+    # The sample is small enough to be handed on as a single chunk
+    header, rows = sampleRows(iterLines(chunks), keyField, size, seed)
+    out = StringIO()
+    writeRows(out, header, rows)
+    logger.info("Sampled %d streamed rows", len(rows))
+    yield out.getvalue()
+
+def chooseRecordSets(collections, count, seed, maxBytes=None):
+    # Seeded choice of whole recordsets. Sets over maxBytes are left out so
+    # the run time stays predictable
+    candidates = sorted((collection for collection in collections if not maxBytes or collection['size'] <= maxBytes), key=lambda collection: collection['key'])
+    chosen = random.Random(seed).sample(candidates, min(count, len(candidates)))
+    logger.info("Sampled recordsets: " + ', '.join(collection['key'] for collection in chosen))
+    return chosen
+
+def sampleOffset(totalCount, size, seed):
+    # Seeded start of a contiguous page of records, for APIs that can only
+    # be sampled by offset. It stays put as long as the total barely moves
+    fraction = random.Random(seed).random()
+    return int(fraction * max(0, totalCount - size))
@@ -0,0 +1,66 @@
+#
+# Size aware scheduling for downloads/imports
+# Largest items go first so that a few giant collections can't end up
+# running on their own at the end of a parallel run
+#
+
+# Core python modules
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('ingest.schedule')
+
+def largestFirst(items):
+    return sorted(items, key=lambda item: item.get('size', 0), reverse=True)
+
+def lptAssign(items, workers):
+    # Longest-processing-time bin packing, using bytes as the cost. Returns a
+    # list of (assignedBytes, items) per worker
+    workers = max(1, workers)
+    bins = [(0, i, []) for i in range(workers)]
+    heapq.heapify(bins)
+    for item in largestFirst(items):
+        assignedBytes, index, binItems = heapq.heappop(bins)
+        binItems.append(item)
+        heapq.heappush(bins, (assignedBytes + item.get('size', 0), index, binItems))
+    return [(assignedBytes, binItems) for assignedBytes, index, binItems in sorted(bins, key=lambda workerBin: workerBin[1])]
+
+def logSchedule(items, workers):
+    assignments = lptAssign(items, workers)
+    totalBytes = sum(assignedBytes for assignedBytes, binItems in assignments)
+    heaviest = max(assignedBytes for assignedBytes, binItems in assignments)
+    logger.info("Scheduling %d items (%d bytes) over %d workers, heaviest worker gets %d bytes" % (len(items), totalBytes, len(assignments), heaviest))
+    return assignments
+
+class byteBudget:
+    # Caps the total size of the items being worked on at once. An item larger
+    # than the whole budget is still let through once nothing else is running
+    def __init__(self, maxBytes=None):
+        self.maxBytes = maxBytes
+        self.inFlight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        if not self.maxBytes:
+            return
+        with self.condition:
+            while self.inFlight and self.inFlight + size > self.maxBytes:
+                self.condition.wait()
+            self.inFlight += size
+
+    def release(self, size):
+        if not self.maxBytes:
+            return
+        with self.condition:
+            self.inFlight -= size
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
@@ -0,0 +1,145 @@
+#
+# Bounded scratch space for downloads, extracted collections and exports
+# Everything a run writes to local disk goes into a workspace under one run
+# directory in the runs directory of scratch_dir. Workspaces reserve their expected size against
+# scratch_quota_bytes before anything is fetched, so parallel workers wait
+# for room instead of filling the disk, and are removed however they exit.
+# Run directories left by crashed runs are swept on the next start, and
+# nothing else in scratch_dir is ever touched
+#
+
+# Core python modules
+import atexit
+import errno
+import logging
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+
+# local modules
+from helpers import scheduleHelpers
+
+logger = logging.getLogger('ingest.scratch')
+
+DEFAULTS = {
+    'scratch_dir': './scratch',
+    'scratch_quota_bytes': None,
+    # Reserved for downloads whose size isn't known up front
+    'scratch_default_bytes': 2 * 1024 * 1024 * 1024,
+    # Extracted size of a zip relative to its download
+    'scratch_unzip_factor': 5,
+    'scratch_orphan_hours': 24
+}
+
+# Run directories are named host-pid-timestamp
+RUNS_DIR = 'ingest-runs'
+RUN_DIR_PATTERN = re.compile(r'^(.+)-([0-9]+)-([0-9]+)$')
+
+scratchSpaces = {}
+scratchLock = threading.Lock()
+
+def getScratch(config):
+    # One scratch space per process so the quota covers every worker
+    with scratchLock:
+        if 'default' not in scratchSpaces:
+            scratchSpaces['default'] = scratchSpace(config)
+            atexit.register(scratchSpaces['default'].close)
+        return scratchSpaces['default']
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def directorySize(path):
+    totalBytes = 0
+    for dirPath, dirNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            try:
+                totalBytes += os.path.getsize(os.path.join(dirPath, fileName))
+            except OSError:
+                continue
+    return totalBytes
+
+class scratchSpace:
+    def __init__(self, config):
+        self.settings = dict(DEFAULTS)
+        self.settings.update(dict((key, config[key]) for key in DEFAULTS if config.get(key) is not None))
+        self.root = os.path.join(self.settings['scratch_dir'], RUNS_DIR)
+        self.budget = scheduleHelpers.byteBudget(self.settings['scratch_quota_bytes'])
+        self.host = socket.gethostname()
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.sweepOrphans()
+        self.runDir = os.path.join(self.root, '%s-%d-%d' % (self.host, os.getpid(), time.time()))
+        os.makedirs(self.runDir)
+        self.closed = False
+
+    def sweepOrphans(self):
+        # Run directories of dead processes on this host are removed right
+        # away, those of other hosts (on a shared disk) once they are stale.
+        # Anything that isn't a run directory is left alone
+        maxAge = self.settings['scratch_orphan_hours'] * 3600
+        for entry in os.listdir(self.root):
+            entryPath = os.path.join(self.root, entry)
+            runMatch = RUN_DIR_PATTERN.match(entry)
+            if not runMatch or not os.path.isdir(entryPath):
+                continue
+            if runMatch.group(1) == self.host:
+                orphaned = not pidAlive(int(runMatch.group(2)))
+            else:
+                orphaned = time.time() - os.path.getmtime(entryPath) > maxAge
+            if not orphaned:
+                continue
+            logger.warning("Removing %d bytes of scratch space left by an earlier run: %s", directorySize(entryPath), entryPath)
+            shutil.rmtree(entryPath, ignore_errors=True)
+
+    def workspace(self, name, size=None):
+        if size is None:
+            size = self.settings['scratch_default_bytes']
+        return workspace(self, name, size)
+
+    def zipWorkspace(self, name, zipBytes):
+        # Room for a download and everything extracted from it
+        return workspace(self, name, int(zipBytes * (1 + self.settings['scratch_unzip_factor'])))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        shutil.rmtree(self.runDir, ignore_errors=True)
+
+class workspace:
+    # Context manager for a directory in the run directory, holding its
+    # reservation until the directory has been removed
+    def __init__(self, scratch, name, size):
+        self.scratch = scratch
+        self.name = name
+        self.size = size
+        self.dir = os.path.join(scratch.runDir, name)
+
+    def path(self, fileName):
+        return os.path.join(self.dir, fileName)
+
+    def __enter__(self):
+        waitStart = time.time()
+        self.scratch.budget.acquire(self.size)
+        waited = time.time() - waitStart
+        if waited > 1:
+            logger.info("Waited %.0fs for %d bytes of scratch space for %s", waited, self.size, self.name)
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        usedBytes = directorySize(self.dir)
+        if usedBytes > self.size:
+            logger.warning("%s used %d bytes of scratch space, %d were reserved", self.name, usedBytes, self.size)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.scratch.budget.release(self.size)
+        return False
@@ -0,0 +1,205 @@
+#
+# Columnar (Parquet) snapshots of ingested collections
+# A snapshot is a directory of compressed parquet parts plus a manifest.json
+# that is written last, so a snapshot without a manifest is incomplete. Small
+# collections that go with the records, such as collectionStatus, are kept
+# alongside as extended JSON
+#
+
+# Core python modules
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+
+# import database tools
+from bson import ObjectId, json_util
+
+# pyarrow is only needed for snapshots, the rest of the ingest runs without it
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('ingest.snapshot')
+
+SNAPSHOT_VERSION = 1
+# Fields that are absent from a row, as opposed to present and null
+ABSENT_COLUMN = '_absent'
+
+def available():
+    if pyarrow is None:
+        logger.error("pyarrow is not installed, snapshots are unavailable")
+        return False
+    return True
+
+def columnEncoding(values):
+    # Columns with one plain type are stored natively so the snapshot can be
+    # queried directly. Anything mixed or nested is stored as extended JSON
+    types = set(type(value) for value in values if value is not None)
+    if not types:
+        return 'string', pyarrow.string()
+    if types == set([bool]):
+        return 'bool', pyarrow.bool_()
+    if types <= set([int, long]):
+        return 'int', pyarrow.int64()
+    if types == set([float]):
+        return 'float', pyarrow.float64()
+    if types <= set([str, unicode]):
+        return 'string', pyarrow.string()
+    if types == set([datetime]):
+        return 'datetime', pyarrow.timestamp('ms')
+    if types == set([ObjectId]):
+        return 'objectid', pyarrow.string()
+    if types == set([uuid.UUID]):
+        return 'uuid', pyarrow.string()
+    return 'json', pyarrow.string()
+
+def encodeValue(value, encoding):
+    if value is None:
+        return None
+    if encoding in ['objectid', 'uuid']:
+        return str(value)
+    if encoding == 'json':
+        return json_util.dumps(value)
+    if encoding == 'string' and isinstance(value, str):
+        return value.decode('utf-8')
+    if encoding == 'datetime' and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+def decodeValue(value, encoding):
+    if value is None:
+        return None
+    if encoding == 'objectid':
+        return ObjectId(value)
+    if encoding == 'uuid':
+        return uuid.UUID(value)
+    if encoding == 'json':
+        return json_util.loads(value)
+    return value
+
+def documentsToTable(documents):
+    columns = set()
+    for document in documents:
+        columns.update(document)
+    columns = sorted(columns)
+    arrays = []
+    encodings = {}
+    for column in columns:
+        values = [document.get(column) for document in documents]
+        encoding, arrowType = columnEncoding(values)
+        encodings[column] = encoding
+        arrays.append(pyarrow.array([encodeValue(value, encoding) for value in values], type=arrowType))
+    absent = [[column for column in columns if column not in document] for document in documents]
+    arrays.append(pyarrow.array(absent, type=pyarrow.list_(pyarrow.string())))
+    metadata = {'epandda.encodings': json.dumps(encodings)}
+    schema = pyarrow.schema([pyarrow.field(column, array.type) for column, array in zip(columns + [ABSENT_COLUMN], arrays)], metadata=metadata)
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+def tableToDocuments(table):
+    encodings = json.loads(table.schema.metadata['epandda.encodings'])
+    columnValues = table.to_pydict()
+    absentRows = columnValues.pop(ABSENT_COLUMN)
+    columns = [(column, encodings[column], columnValues[column]) for column in columnValues]
+    documents = []
+    for row, absent in enumerate(absentRows):
+        absent = set(absent or [])
+        document = {}
+        for column, encoding, values in columns:
+            if column not in absent:
+                document[column] = decodeValue(values[row], encoding)
+        documents.append(document)
+    return documents
+
+class snapshotWriter:
+    def __init__(self, snapshotRoot, source, collectionName, compression='snappy', partRows=100000):
+        self.source = source
+        self.collectionName = collectionName
+        self.compression = compression
+        self.partRows = partRows
+        self.created = datetime.utcnow()
+        self.path = os.path.join(snapshotRoot, source, self.created.strftime('%Y%m%dT%H%M%S'))
+        self.tmpPath = self.path + '.partial'
+        self.parts = []
+        self.extras = {}
+        self.count = 0
+        self.buffer = []
+        os.makedirs(self.tmpPath)
+
+    def add(self, document):
+        self.buffer.append(document)
+        if len(self.buffer) >= self.partRows:
+            self.writePart()
+
+    def writePart(self):
+        if not self.buffer:
+            return
+        partName = 'part-%05d.parquet' % len(self.parts)
+        parquet.write_table(documentsToTable(self.buffer), os.path.join(self.tmpPath, partName), compression=self.compression)
+        self.parts.append({'file': partName, 'rows': len(self.buffer)})
+        self.count += len(self.buffer)
+        self.buffer = []
+
+    def addExtra(self, collectionName, documents):
+        extraName = collectionName + '.json'
+        with open(os.path.join(self.tmpPath, extraName), 'w') as extraFile:
+            extraFile.write(json_util.dumps(documents))
+        self.extras[collectionName] = {'file': extraName, 'rows': len(documents)}
+
+    def close(self):
+        self.writePart()
+        manifest = {'version': SNAPSHOT_VERSION, 'source': self.source, 'collection': self.collectionName, 'created': self.created.isoformat(), 'count': self.count, 'compression': self.compression, 'parts': self.parts, 'extras': self.extras}
+        with open(os.path.join(self.tmpPath, 'manifest.json'), 'w') as manifestFile:
+            json.dump(manifest, manifestFile, indent=2)
+        os.rename(self.tmpPath, self.path)
+        return manifest
+
+    def abort(self):
+        shutil.rmtree(self.tmpPath, ignore_errors=True)
+
+def listSnapshots(snapshotRoot, source):
+    # Complete snapshots for a source, oldest first
+    sourceRoot = os.path.join(snapshotRoot, source)
+    if not os.path.isdir(sourceRoot):
+        return []
+    return [os.path.join(sourceRoot, name) for name in sorted(os.listdir(sourceRoot)) if os.path.isfile(os.path.join(sourceRoot, name, 'manifest.json'))]
+
+def findSnapshot(snapshotRoot, source, snapshot='latest'):
+    if snapshot != 'latest':
+        return snapshot
+    snapshots = listSnapshots(snapshotRoot, source)
+    if not snapshots:
+        return None
+    return snapshots[-1]
+
+def readManifest(snapshotPath):
+    with open(os.path.join(snapshotPath, 'manifest.json')) as manifestFile:
+        return json.load(manifestFile)
+
+def readSnapshot(snapshotPath, manifest):
+    # Yields the documents of one part at a time
+    for part in manifest['parts']:
+        startTime = time.time()
+        documents = tableToDocuments(parquet.read_table(os.path.join(snapshotPath, part['file'])))
+        logger.debug("Read %d documents from %s in %.2fs", len(documents), part['file'], time.time() - startTime)
+        yield documents
+
+def readExtra(snapshotPath, manifest, collectionName):
+    # None for snapshots taken without this collection
+    extra = manifest.get('extras', {}).get(collectionName)
+    if extra is None:
+        return None
+    with open(os.path.join(snapshotPath, extra['file'])) as extraFile:
+        return json_util.loads(extraFile.read())
+
+def pruneSnapshots(snapshotRoot, source, keep):
+    if not keep:
+        return
+    for snapshotPath in listSnapshots(snapshotRoot, source)[:-keep]:
+        shutil.rmtree(snapshotPath, ignore_errors=True)
+        logger.info("Removed old snapshot " + snapshotPath)
@@ -0,0 +1,210 @@
+#
+# Helpers for streaming source downloads straight into the importer
+# Nothing handled here is written to the local disk
+#
+
+# Core python modules
+import csv
+import logging
+import struct
+import zlib
+from cStringIO import StringIO
+
+# Data harvesting/gathering
+import requests
+
+# local modules
+from helpers import ingestHelpers
+
+logger = logging.getLogger('ingest.stream')
+
+CHUNK_SIZE = 1024 * 1024
+ZIP_LOCAL_HEADER = 'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR = 'PK\x07\x08'
+
+class streamError(Exception):
+    pass
+
+class chunkBuffer:
+    # Wraps an iterator of byte chunks so that fixed size headers can be read
+    # from it without collecting the whole stream
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readChunk(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, ''
+            return data
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            return ''
+
+    def pushBack(self, data):
+        self.buffer = data + self.buffer
+
+def httpChunks(url, chunkSize=CHUNK_SIZE):
+    # The response is only read as fast as the consumer pulls chunks, so a slow
+    # importer throttles the download through the TCP window
+    logger.debug("Streaming " + url)
+    response = requests.get(url, stream=True, timeout=60)
+    if response.status_code != 200:
+        response.close()
+        raise streamError("Request for " + url + " failed with status " + str(response.status_code))
+    try:
+        for chunk in response.iter_content(chunk_size=chunkSize):
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+def deflatedChunks(reader):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while True:
+        chunk = reader.readChunk()
+        if not chunk:
+            raise streamError("Zip stream ended inside of a compressed member")
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+        # Anything past the end of the deflate stream belongs to the next entry
+        if decompressor.unused_data:
+            reader.pushBack(decompressor.unused_data)
+            break
+    remainder = decompressor.flush()
+    if remainder:
+        yield remainder
+
+def storedChunks(reader, size):
+    while size > 0:
+        chunk = reader.readChunk()
+        if not chunk:
+            raise streamError("Zip stream ended inside of a stored member")
+        if len(chunk) > size:
+            reader.pushBack(chunk[size:])
+            chunk = chunk[:size]
+        size -= len(chunk)
+        yield chunk
+
+def zip64Extra(extra):
+    # Returns the data of the ZIP64 extended information field (header id
+    # 0x0001) of a local file header, or None for a plain entry
+    offset = 0
+    while offset + 4 <= len(extra):
+        headerID, dataSize = struct.unpack('<HH', extra[offset:offset + 4])
+        if headerID == 0x0001:
+            return extra[offset + 4:offset + 4 + dataSize]
+        offset += 4 + dataSize
+    return None
+
+def zipMemberChunks(chunks, memberNames):
+    # Walks the local file headers of a zip stream and yields the decompressed
+    # contents of the first member matching one of memberNames
+    reader = chunkBuffer(chunks)
+    while True:
+        header = reader.read(30)
+        if len(header) < 30 or header[:4] != ZIP_LOCAL_HEADER:
+            # We've reached the central directory without a match
+            break
+        flags, method, compSize = struct.unpack('<6xHH8xI', header[:22])
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        memberName = reader.read(nameLength)
+        zip64 = zip64Extra(reader.read(extraLength))
+        # Local ZIP64 fields hold the uncompressed and then the compressed size
+        if zip64 is not None and compSize == 0xFFFFFFFF and len(zip64) >= 16:
+            compSize = struct.unpack('<Q', zip64[8:16])[0]
+        hasDescriptor = flags & 0x08
+        if method == 8:
+            memberData = deflatedChunks(reader)
+        elif method == 0 and not hasDescriptor:
+            memberData = storedChunks(reader, compSize)
+        else:
+            raise streamError("Unsupported zip entry " + memberName + " (method " + str(method) + ")")
+
+        if memberName.split('/')[-1] in memberNames:
+            logger.info("Streaming " + memberName + " from zip")
+            for data in memberData:
+                yield data
+            return
+        for data in memberData:
+            pass
+        if hasDescriptor:
+            # CRC and both sizes, which are 8 bytes each for ZIP64 entries.
+            # The signature in front of them is optional
+            descriptorLength = 20 if zip64 is not None else 12
+            descriptor = reader.read(4)
+            if descriptor == ZIP_DATA_DESCRIPTOR:
+                reader.read(descriptorLength)
+            else:
+                reader.read(descriptorLength - 4)
+    raise streamError("None of " + str(memberNames) + " found in zip stream")
+
+def normalizeHeaderChunks(chunks, requiredHeaders=None):
+    # Validates and renames duplicate values in the header line of a CSV
+    # stream, passing the rest of the stream through untouched
+    chunks = iter(chunks)
+    buffered = ''
+    for chunk in chunks:
+        buffered += chunk
+        if '\n' in buffered:
+            break
+    headerLine, newline, rest = buffered.partition('\n')
+    header = next(csv.reader([headerLine.rstrip('\r')]))
+    for check in requiredHeaders or []:
+        if check not in header:
+            logger.debug("Header list for invalid stream: " + str(header))
+            raise streamError("Stream is missing required header " + check)
+    header = ingestHelpers.renameHeaderRow(header)
+    headerOut = StringIO()
+    csv.writer(headerOut, lineterminator='\n').writerow(header)
+    yield headerOut.getvalue() + rest
+    for chunk in chunks:
+        yield chunk
+
+def countingChunks(chunks, counter):
+    # Counts data rows as they pass so they can be logged after the import
+    counter['rows'] = -1
+    for chunk in chunks:
+        counter['rows'] += chunk.count('\n')
+        yield chunk
+
+def fileChunks(fileObj, chunkSize=CHUNK_SIZE):
+    return iter(lambda: fileObj.read(chunkSize), '')
+
+class chunkFile:
+    # Minimal file-like view of a chunk iterator for parsers such as pandas
+    def __init__(self, chunks):
+        self.reader = chunkBuffer(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(self.reader.readChunk, ''))
+        return self.reader.read(size)
+
+    def __iter__(self):
+        # pandas checks for iteration support on file handles
+        return iter(self.readline, '')
+
+    def readline(self):
+        parts = []
+        while True:
+            chunk = self.reader.readChunk()
+            if not chunk:
+                break
+            line, newline, rest = chunk.partition('\n')
+            parts.append(line + newline)
+            if newline:
+                if rest:
+                    self.reader.pushBack(rest)
+                break
+        return ''.join(parts)
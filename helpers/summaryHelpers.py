@@ -0,0 +1,139 @@
+#
+# Precomputed record counts by country, state, genus, formation and stage
+# Each dimension has a summary collection in endpoints_db with one document
+# per value. summaryMembers remembers the values every record was counted
+# under, so each run only applies $inc deltas for the records it touched
+#
+
+# Core python modules
+import logging
+import time
+from datetime import datetime
+
+# import database tools
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, DeleteOne, UpdateOne
+
+# local modules
+from helpers import normalizeHelpers
+
+logger = logging.getLogger('ingest.summary')
+
+DIMENSIONS = ['country', 'state', 'genus', 'formation', 'stage']
+
+# Source field for each dimension. Countries are counted by ISO code, which
+# is what PBDB's cc holds
+SUMMARY_FIELDS = {
+    'idigbio': {'country': 'dwc:countryCode', 'state': 'dwc:stateProvince', 'genus': 'dwc:genus', 'formation': 'dwc:formation', 'stage': 'dwc:earliestAgeOrLowestStage'},
+    'pbdb': {'country': 'cc', 'state': 'state', 'genus': 'genus', 'formation': 'formation', 'stage': 'early_interval'}
+}
+
+BATCH_SIZE = 1000
+
+def summaryValue(value):
+    # Same folding as the linkage keys, so case and diacritic variants of a
+    # value are counted together
+    return normalizeHelpers.normalizeKey(value)
+
+def summaryValues(record, fields):
+    values = {}
+    for dimension in DIMENSIONS:
+        value = summaryValue(record.get(fields[dimension]))
+        if value is not None:
+            values[dimension] = value
+    return values
+
+class summaryBuilder:
+    def __init__(self, client, config, recordKeys):
+        # recordKeys maps each source to the field that identifies a record
+        self.client = client
+        self.recordKeys = recordKeys
+        endpoints = client[config['endpoints_db']]
+        prefix = config.get('summary_coll_prefix', 'summary_')
+        self.summaries = dict((dimension, endpoints[prefix + dimension]) for dimension in DIMENSIONS)
+        self.members = endpoints[config.get('summary_members_coll', 'summaryMembers')]
+
+    def ensureIndexes(self):
+        self.members.create_index([('source', ASCENDING)])
+        for summary in self.summaries.values():
+            summary.create_index([('total', DESCENDING)])
+
+    def update(self, source, collection, query):
+        # Recounts the records matched by query under their current values
+        self.ensureIndexes()
+        fields = SUMMARY_FIELDS[source]
+        recordKey = self.recordKeys[source]
+        projection = dict((field, 1) for field in fields.values())
+        projection[recordKey] = 1
+        startTime = time.time()
+        batch = []
+        totals = {'records': 0, 'changed': 0}
+        for record in collection.find(query, projection, batch_size=BATCH_SIZE):
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                self.applyBatch(source, batch, fields, recordKey, totals)
+                batch = []
+        if batch:
+            self.applyBatch(source, batch, fields, recordKey, totals)
+        self.removeEmptyValues()
+        logger.info("Summarized %d %s records (%d changed) in %.1fs", totals['records'], source, totals['changed'], time.time() - startTime)
+        return totals
+
+    def applyBatch(self, source, records, fields, recordKey, totals):
+        memberIDs = [source + ':' + str(record.get(recordKey)) for record in records]
+        existing = dict((member['_id'], member.get('values', {})) for member in self.members.find({'_id': {'$in': memberIDs}}, {'values': 1}))
+        deltas = dict((dimension, {}) for dimension in DIMENSIONS)
+        memberOps = []
+        for memberID, record in zip(memberIDs, records):
+            if record.get(recordKey) is None:
+                continue
+            newValues = summaryValues(record, fields)
+            oldValues = existing.get(memberID)
+            if newValues == oldValues:
+                continue
+            self.addDeltas(deltas, oldValues or {}, -1)
+            self.addDeltas(deltas, newValues, 1)
+            if newValues:
+                memberOps.append(ReplaceOne({'_id': memberID}, {'_id': memberID, 'source': source, 'values': newValues}, upsert=True))
+            elif oldValues is not None:
+                memberOps.append(DeleteOne({'_id': memberID}))
+        totals['records'] += len(records)
+        totals['changed'] += len(memberOps)
+        if memberOps:
+            self.members.bulk_write(memberOps, ordered=False)
+        self.applyDeltas(source, deltas)
+
+    def addDeltas(self, deltas, values, change):
+        for dimension, value in values.items():
+            deltas[dimension][value] = deltas[dimension].get(value, 0) + change
+
+    def applyDeltas(self, source, deltas):
+        now = datetime.utcnow()
+        for dimension, valueDeltas in deltas.items():
+            summaryOps = [UpdateOne({'_id': value}, {'$inc': {'counts.' + source: delta, 'total': delta}, '$set': {'updated': now}}, upsert=True) for value, delta in valueDeltas.items() if delta]
+            if summaryOps:
+                self.summaries[dimension].bulk_write(summaryOps, ordered=False)
+
+    def remove(self, source, records):
+        # For records deleted from a source
+        memberIDs = [source + ':' + str(record) for record in records]
+        deltas = dict((dimension, {}) for dimension in DIMENSIONS)
+        for member in self.members.find({'_id': {'$in': memberIDs}}, {'values': 1}):
+            self.addDeltas(deltas, member.get('values', {}), -1)
+        self.members.delete_many({'_id': {'$in': memberIDs}})
+        self.applyDeltas(source, deltas)
+        self.removeEmptyValues()
+
+    def rebuild(self, source, collection):
+        # Recounts the whole source, for full refreshes or when the deltas
+        # have drifted
+        logger.info("Rebuilding " + source + " summaries")
+        self.members.delete_many({'source': source})
+        for summary in self.summaries.values():
+            resetOps = [UpdateOne({'_id': row['_id']}, {'$inc': {'total': -row['counts'][source]}, '$unset': {'counts.' + source: ''}}) for row in summary.find({'counts.' + source: {'$exists': True}}, {'counts.' + source: 1})]
+            for start in range(0, len(resetOps), BATCH_SIZE):
+                summary.bulk_write(resetOps[start:start + BATCH_SIZE], ordered=False)
+        return self.update(source, collection, {})
+
+    def removeEmptyValues(self):
+        for summary in self.summaries.values():
+            summary.delete_many({'total': {'$lte': 0}})
@@ -10,57 +10,109 @@ import json
 
 # Local modules
 import mongoConnect
+from helpers import indexHelpers
+from helpers import normalizeHelpers
 
 class epanddaTests:
     def __init__(self, idb, pbdb):
-        self.config = json.load(open('./config.json'))
+        self.config = mongoConnect.loadConfig()
         self.logger = logging.getLogger("test.main")
         self.sources = {
             "idigbio": idb,
             "pbdb": pbdb
         }
 
-    def checkIndexes(self, fullRefresh, importStatus):
-        indexes = self.config['test_indexes']
+    def checkIndexes(self, importStatus, sources=None):
+        # Live collections keep their indexes through every import. Full
+        # refreshes are built and indexed in a shadow collection instead.
+        # sources limits the check to the databases of those sources
         mongoConn = mongoConnect.mongoConnect()
-        for indexCheck in indexes:
+        manager = indexHelpers.indexManager(mongoConn.client)
+        indexJobs = []
+        checkDatabases = None
+        if sources:
+            checkDatabases = [self.config[source+'_db'] for source in sources]
+        for indexCheck in self.config['test_indexes']:
             database = indexCheck['db']
+            if checkDatabases is not None and database not in checkDatabases:
+                continue
             collection = indexCheck['collection']
-            verifyIndexes = indexCheck['indexes']
-            indexTestResult = mongoConn.indexTest(database, collection, verifyIndexes)
+            missingIndexes = manager.missingIndexes(database, self.config[collection], indexCheck['indexes'])
+            if not missingIndexes:
+                self.logger.info(collection + " has all necessary indexes")
+                continue
+            self.logger.warning(collection + " is missing " + str(len(missingIndexes)) + " indexes " + importStatus + " import. They will now be created")
+            indexJobs.append((database, self.config[collection], missingIndexes))
+        indexResult = manager.buildAll(indexJobs)
+        mongoConn.closeConnection()
+        if indexResult is False:
+            self.logger.warning("Failed index test. Exit")
+        return indexResult
 
-            if indexTestResult is True:
-                if indexCheck['dropForFull'] is False:
-                    self.logger.info(collection + " has all necessary indexes")
-                elif fullRefresh is True:
-                    self.logger.info("Dropping indexes on " + collection + " for full import ")
-                    indexDropResult = mongoConn.deleteIndexes(database, collection, verifyIndexes)
-                    return indexDropResult
-                else:
-                    self.logger.info("Retaining necessary indexes for partial import")
-            elif indexCheck['dropForFull'] is False:
-                self.logger.warning(collection + " is missing the following indexes. They will now be created")
-                self.logger.warning(indexTestResult)
-                indexResult = mongoConn.createIndexes(database, collection, indexTestResult)
-                if indexResult is False:
-                    self.logger.warning(collection + " failed index test. Exit")
+    def indexShadowCollection(self, source, shadowName):
+        mongoConn = mongoConnect.mongoConnect()
+        manager = indexHelpers.indexManager(mongoConn.client)
+        sourceDB = self.config[source+'_db']
+        indexJobs = []
+        indexSpecs = []
+        for indexCheck in self.config['test_indexes']:
+            if indexCheck['db'] == sourceDB and indexCheck['collection'] == source+'_coll':
+                indexSpecs.extend(indexCheck['indexes'])
+        # The normalized key fields are filled in once the shadow is live
+        if self.config.get('normalize_keys', True):
+            indexSpecs.extend(normalizeHelpers.indexSpecs(source))
+        if source in mongoConnect.MODIFIED_FIELDS:
+            indexSpecs.append(mongoConnect.MODIFIED_FIELDS[source])
+        missingIndexes = manager.missingIndexes(sourceDB, shadowName, indexSpecs)
+        if missingIndexes:
+            indexJobs.append((sourceDB, shadowName, missingIndexes))
+        self.logger.info("Indexing " + shadowName + " before it is swapped in")
+        indexResult = manager.buildAll(indexJobs)
+        mongoConn.closeConnection()
+        if indexResult is False:
+            self.logger.error(shadowName + " failed index creation")
+        return indexResult
+
+    def promoteShadowCollection(self, source, sourceInstance, shadowName, expectedCount=None):
+        # Indexes, verifies and then atomically renames a full refresh over
+        # the live collection. Readers never see a partial collection.
+        # Snapshot restores pass the count they loaded instead, and are only
+        # checked against that. The connection is closed however it ends
+        if self.indexShadowCollection(source, shadowName) is False:
+            return False
+
+        mongoConn = mongoConnect.mongoConnect()
+        try:
+            minRatio = self.config.get('shadow_min_ratio', 0.95)
+            shadowCount = mongoConn.getCollectionCount(source, shadowName, exact=expectedCount is not None)
+            liveCount = mongoConn.getCollectionCount(source)
+            self.logger.info(shadowName + " holds " + str(shadowCount) + " records, live collection holds " + str(liveCount))
+            if not shadowCount:
+                self.logger.error(shadowName + " is empty. Keeping the live collection")
+                return False
+            if expectedCount is not None:
+                if shadowCount != expectedCount:
+                    self.logger.error(shadowName + " holds " + str(shadowCount) + " records but " + str(expectedCount) + " were restored. Keeping the live collection")
                     return False
-            else:
-                if importStatus is 'post':
-                    self.logger.info(collection + " has not been indexed. Indexing now following full import")
-                    indexResult = mongoConn.createIndexes(database, collection, indexTestResult)
-                    if indexResult is False:
-                        self.logger.warning(collection + " failed index test. Exit")
-                        return False
-                elif fullRefresh is False:
-                    self.logger.info("Need indexes for partial import. Indexing now.")
-                    indexResult = mongoConn.createIndexes(database, collection, indexTestResult)
-                    if indexResult is False:
-                        self.logger.warning(collection + " failed index test. Exit")
-                        return False
-                else:
-                    self.logger.info(collection + " is not indexed, which is necessary for the full import, proceeding")
-        return True
+            elif liveCount and shadowCount < liveCount * minRatio:
+                self.logger.error(shadowName + " is missing too many records compared to the live collection. Keeping the live collection")
+                return False
+            if expectedCount is None:
+                sourceCount = sourceInstance.getRecordCount()
+                if sourceCount and shadowCount < sourceCount * minRatio:
+                    self.logger.error(shadowName + " is missing too many records compared to " + source + ". Keeping the live collection")
+                    return False
+
+            sentinelCount = mongoConn.getSentinelCount(source)
+            if sentinelCount:
+                static, modified, missing = mongoConn.verifySentinels(source, shadowName)
+                if (modified + missing) > (sentinelCount / 10):
+                    self.logger.error("Sentinels failed to verify against " + shadowName + ". Keeping the live collection")
+                    return False
+
+            return mongoConn.swapShadowCollection(source)
+        finally:
+            mongoConn.closeConnection()
 
     def checkCounts(self, sources, fullCounts):
         for source in sources:
@@ -0,0 +1,194 @@
+#
+# Adaptive control of write batch size and concurrency
+# Batches grow while writes stay under the target latency and are halved on
+# slow writes, write errors or replication lag (additive increase,
+# multiplicative decrease) within the limits set in write_control
+#
+
+# Core python modules
+import logging
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+
+# import database tools
+from pymongo.errors import PyMongoError, BulkWriteError, OperationFailure
+
+logger = logging.getLogger('ingest.throttle')
+
+DEFAULTS = {
+    'min_batch': 100,
+    'max_batch': 5000,
+    'initial_batch': 1000,
+    'min_workers': 1,
+    'max_workers': 8,
+    'initial_workers': 4,
+    'target_latency_ms': 500,
+    'max_replication_lag': 10,
+    'lag_check_interval': 30
+}
+
+controllers = {}
+controllersLock = threading.Lock()
+
+def getController(client, config):
+    # One controller per process so what it learns carries across the many
+    # short lived mongoConnect instances. Callers get it bound to their own
+    # client, which replication lag is checked with, so the shared controller
+    # never holds on to a client its owner has closed
+    with controllersLock:
+        if 'default' not in controllers:
+            controllers['default'] = writeController(config.get('write_control', {}))
+        return clientController(controllers['default'], client)
+
+class clientController:
+    # The shared controller as seen through one connection
+    def __init__(self, controller, client):
+        self.controller = controller
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.controller, name)
+
+    def timedWrite(self, writeFunction, count):
+        return self.controller.timedWrite(writeFunction, count, self.client)
+
+    def observe(self, seconds, count, error=False):
+        self.controller.observe(seconds, count, error, self.client)
+
+    def observeImport(self, seconds, count, batchSize, workers):
+        self.controller.observeImport(seconds, count, batchSize, workers, self.client)
+
+class writeController:
+    def __init__(self, settings):
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings)
+        self.batchSize = min(max(self.settings['initial_batch'], self.settings['min_batch']), self.settings['max_batch'])
+        self.workers = min(max(self.settings['initial_workers'], self.settings['min_workers']), self.settings['max_workers'])
+        self.targetLatency = self.settings['target_latency_ms'] / 1000.0
+        self.lock = threading.Lock()
+        self.slots = threading.Condition()
+        self.activeWrites = 0
+        self.fastWrites = 0
+        self.lag = 0
+        self.lastLagCheck = 0
+        self.checkLag = True
+
+    @contextmanager
+    def slot(self):
+        # Limits the writes in progress to the current worker count
+        with self.slots:
+            while self.activeWrites >= self.workers:
+                self.slots.wait()
+            self.activeWrites += 1
+        try:
+            yield
+        finally:
+            with self.slots:
+                self.activeWrites -= 1
+                self.slots.notify_all()
+
+    def timedWrite(self, writeFunction, count, client=None):
+        with self.slot():
+            startTime = time.time()
+            try:
+                result = writeFunction()
+            except BulkWriteError as bwe:
+                # Document level errors (e.g. duplicates) aren't a load signal
+                self.observe(time.time() - startTime, count, error=bool(bwe.details.get('writeConcernErrors')), client=client)
+                raise
+            except PyMongoError:
+                self.observe(time.time() - startTime, count, error=True, client=client)
+                raise
+            self.observe(time.time() - startTime, count, client=client)
+            return result
+
+    def observe(self, seconds, count, error=False, client=None):
+        lag = self.replicationLag(client)
+        with self.lock:
+            previous = (self.batchSize, self.workers)
+            if error or lag > self.settings['max_replication_lag'] or seconds > self.targetLatency * 2:
+                self.batchSize = max(self.settings['min_batch'], self.batchSize / 2)
+                self.workers = max(self.settings['min_workers'], self.workers - 1)
+                self.fastWrites = 0
+            elif seconds < self.targetLatency:
+                self.fastWrites += 1
+                self.batchSize = min(self.settings['max_batch'], self.batchSize + self.settings['min_batch'])
+                if self.fastWrites % 5 == 0:
+                    self.workers = min(self.settings['max_workers'], self.workers + 1)
+            if (self.batchSize, self.workers) != previous:
+                logger.debug("Write control now at batch %d x %d workers (%.3fs for %d docs, lag %ds)" % (self.batchSize, self.workers, seconds, count, lag))
+        with self.slots:
+            self.slots.notify_all()
+
+    def observeImport(self, seconds, count, batchSize, workers, client=None):
+        # mongoimport only tells us its total, so estimate a per batch latency
+        if count:
+            self.observe(seconds * batchSize * workers / float(count), batchSize, client=client)
+
+    def importOptions(self):
+        return ['--numInsertionWorkers', str(self.workers), '--batchSize', str(self.batchSize)]
+
+    def replicationLag(self, client=None):
+        # client is the connection of the caller. Without one the last lag
+        # seen is used
+        if client is None or not self.checkLag or time.time() - self.lastLagCheck < self.settings['lag_check_interval']:
+            return self.lag
+        self.lastLagCheck = time.time()
+        try:
+            status = client.admin.command('replSetGetStatus')
+        except OperationFailure:
+            # Standalone server or no permission to read the replica set status
+            self.checkLag = False
+            self.lag = 0
+            return self.lag
+        primaryOptimes = [member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'PRIMARY']
+        secondaryOptimes = [member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'SECONDARY']
+        if primaryOptimes and secondaryOptimes:
+            self.lag = max(0, (primaryOptimes[0] - min(secondaryOptimes)).total_seconds())
+        return self.lag
+
+class batchWriter:
+    # Regroups documents into batches sized by the controller and writes them
+    # from a pool of threads. The queue is bounded, so a slow server holds
+    # back the parser instead of letting batches pile up in memory
+    def __init__(self, controller, writeFunction):
+        self.controller = controller
+        self.writeFunction = writeFunction
+        self.buffer = []
+        self.errors = []
+        self.batches = Queue.Queue(maxsize=controller.settings['max_workers'] * 2)
+        self.threads = []
+        for i in range(controller.settings['max_workers']):
+            writerThread = threading.Thread(target=self.writeBatches)
+            writerThread.daemon = True
+            writerThread.start()
+            self.threads.append(writerThread)
+
+    def add(self, documents):
+        self.buffer.extend(documents)
+        while len(self.buffer) >= self.controller.batchSize:
+            batchSize = self.controller.batchSize
+            self.batches.put(self.buffer[:batchSize])
+            self.buffer = self.buffer[batchSize:]
+
+    def writeBatches(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            try:
+                self.controller.timedWrite(lambda: self.writeFunction(batch), len(batch))
+            except PyMongoError as e:
+                self.errors.append(e)
+
+    def close(self):
+        if self.buffer:
+            self.batches.put(self.buffer)
+            self.buffer = []
+        for writerThread in self.threads:
+            self.batches.put(None)
+        for writerThread in self.threads:
+            writerThread.join()
+        return self.errors
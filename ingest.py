@@ -15,6 +15,8 @@ import datetime
 import argparse
 import logging
 import time
+import threading
+import traceback
 
 # import/ingest dependencies
 import urllib2
@@ -25,10 +27,13 @@ from unidecode import unidecode
 from sources import idigbio
 from sources import paleobio
 
+import mongoConnect
+
 # Helper functions for managing ingest
 from helpers import ingestHelpers
 from helpers import logHelpers
 from helpers import testHelpers
+from helpers import daemonHelpers
 
 def main():
     # Start the process timer and create ingest_run mongo entry
@@ -43,18 +48,62 @@ def main():
     logLevel = args.logLevel
     fullRefresh = args.fullRefresh
     removeDeleted = args.removeDeleted
+    streamIngest = args.stream
+    queueName = args.queue
+    workers = args.workers
+    concurrentRun = args.concurrent
+    daemonMode = args.daemon
+    snapshotAfter = args.snapshot
+    restoreSnapshot = args.restore
+    sampleRun = args.sample is not None or args.sampleSets is not None
+
+    # Reports only read the ingest log
+    if args.report:
+        logHelpers.createLog('ingest', logLevel, '_report')
+        report, regressed = logHelpers.regressionReport(ingestSources)
+        print report
+        sys.exit(8 if regressed else 0)
+
+    # The daemon keeps its mongo clients open between runs
+    if daemonMode:
+        mongoConnect.useSharedClients()
 
-    # Create log entry in ingest collection
-    ingestID = logHelpers.createMongoLog(ingestSources)
+    # Sampled test runs do a full refresh of a sample of each source into
+    # scratch databases, so the live ones are never touched
+    if sampleRun:
+        if daemonMode or dryRun or restoreSnapshot or snapshotAfter or removeDeleted or args.rebuildEndpoints:
+            print "Sampled test runs can't be combined with --daemon, --dryRun, --restore, --snapshot, --removeDeleted or --rebuildEndpoints"
+            sys.exit(1)
+        mongoConnect.useScratchDatabases()
+        mongoConn = mongoConnect.mongoConnect()
+        mongoConn.resetScratchDatabase()
+        mongoConn.closeConnection()
+        fullRefresh = True
+
+    # Create log entry in ingest collection. The daemon creates one per run
+    # and dry runs don't write to mongo at all
+    ingestID = None
+    if not daemonMode and not dryRun:
+        ingestID = logHelpers.createMongoLog(ingestSources)
 
     # Create the logs
     logger, coreLogFile = logHelpers.createLog('ingest', logLevel, '_ingest')
     testLogger, testLogFile = logHelpers.createLog('test', logLevel, '_tests')
     logger.info("Starting ePandda ingest")
+    if daemonMode and fullRefresh:
+        logger.error("Full refreshes can't be scheduled by the daemon, run them on their own")
+        sys.exit(1)
+    if dryRun and (daemonMode or restoreSnapshot or snapshotAfter or args.rebuildEndpoints):
+        logger.error("Dry runs can only be combined with a normal or full refresh ingest")
+        sys.exit(1)
     # Source classes. Add new classes here
-    idb = idigbio.idigbio(testRun, fullRefresh, ingestID)
-    pbdb = paleobio.paleobio(testRun, fullRefresh, ingestID)
+    idb = idigbio.idigbio(testRun, fullRefresh, ingestID, stream=streamIngest, queueName=queueName, workers=workers)
+    pbdb = paleobio.paleobio(testRun, fullRefresh, ingestID, stream=streamIngest)
     sourceNames = ingestHelpers.getSourceNames([idb, pbdb])
+    if sampleRun:
+        logger.info("Sampled test run with seed " + str(args.seed))
+        idb.setSample(args.sample, args.sampleSets, args.seed)
+        pbdb.setSample(args.sample, args.seed)
 
     try:
         for ingestSource in ingestSources:
@@ -71,8 +120,37 @@ def main():
     # Create test instance
     tests = testHelpers.epanddaTests(idb, pbdb)
 
+    # Recount the linkage and summaries when their deltas have drifted
+    if args.rebuildEndpoints:
+        mongoConn = mongoConnect.mongoConnect()
+        rebuildFailed = False
+        for ingestSource in ingestSources:
+            if mongoConn.updateEndpoints(ingestSource, rebuild=True) is False:
+                logger.error("Could not rebuild endpoints for " + ingestSource)
+                rebuildFailed = True
+        mongoConn.closeConnection()
+        sys.exit(9 if rebuildFailed else 0)
+
+    # Restores replace the normal ingest entirely
+    if restoreSnapshot:
+        restoreResults = {}
+        for ingestSource in ingestSources:
+            restoreResults[ingestSource] = runRestore(ingestSource, sourceNames[ingestSource], tests, restoreSnapshot, ingestID)
+        restoreSummary = '\n'.join(ingestSource + ": " + restoreResults[ingestSource] for ingestSource in ingestSources)
+        logger.info("Restore results\n" + restoreSummary)
+        if 'RESTORE ERROR' in restoreResults.values():
+            logHelpers.emailLogAndStatus('RESTORE ERROR', coreLogFile, testLogFile, restoreSummary)
+            sys.exit(7)
+        logHelpers.logRunTime(ingestID, startTime, time.time())
+        logHelpers.emailLogAndStatus('SUCCESS', coreLogFile, testLogFile, restoreSummary)
+        return
+
+    if dryRun:
+        runDryRun(ingestSources, sourceNames, tests, testRun, coreLogFile, testLogFile)
+        return
+
     # Check indexes and create if necessary
-    indexStatus = tests.checkIndexes(fullRefresh, 'pre')
+    indexStatus = tests.checkIndexes('pre')
     if indexStatus is False:
         logger.error("Index Creation Failure")
         logHelpers.emailLogAndStatus('TEST ERROR', coreLogFile, testLogFile)
@@ -85,51 +163,148 @@ def main():
         logHelpers.emailLogAndStatus('TEST ERROR', coreLogFile, testLogFile)
         sys.exit(4)
 
+    if daemonMode:
+        config = json.load(open('./config.json'))
+        daemonSources = dict((ingestSource, sourceNames[ingestSource]) for ingestSource in ingestSources)
+        daemon = daemonHelpers.ingestDaemon(daemonSources, runSource, tests, config.get('daemon', {}), (coreLogFile, testLogFile), removeDeleted)
+        daemon.run()
+        return
+
     #
     # MAIN BODY RUN THE INGESTS
     #
-    for ingestSource in ingestSources:
-        ingester = sourceNames[ingestSource]
+    sourceResults = {}
+    if concurrentRun:
+        # Each source runs its whole pipeline in its own thread so a
+        # combined run takes as long as the slowest source
+        sourceThreads = []
+        for ingestSource in ingestSources:
+            sourceThread = threading.Thread(target=runSource, args=(ingestSource, sourceNames[ingestSource], tests, ingestID, removeDeleted, dryRun, testRun, sourceResults), kwargs={'snapshot': snapshotAfter, 'countCheck': not sampleRun})
+            sourceThread.start()
+            sourceThreads.append(sourceThread)
+        for sourceThread in sourceThreads:
+            sourceThread.join()
+    else:
+        for ingestSource in ingestSources:
+            runSource(ingestSource, sourceNames[ingestSource], tests, ingestID, removeDeleted, dryRun, testRun, sourceResults, snapshot=snapshotAfter, countCheck=not sampleRun)
+            if sourceResults[ingestSource] != 'SUCCESS':
+                break
+
+    sourceSummary = '\n'.join(ingestSource + ": " + sourceResults.get(ingestSource, 'NOT RUN') for ingestSource in ingestSources)
+    logger.info("Source results\n" + sourceSummary)
+    if 'INGEST ERROR' in sourceResults.values():
+        logHelpers.emailLogAndStatus('INGEST ERROR', coreLogFile, testLogFile, sourceSummary)
+        sys.exit(5)
+    if 'SENTINEL ERROR' in sourceResults.values():
+        logger.error("Sentinels Failed to Verify, check logs")
+        logHelpers.emailLogAndStatus('SENTINEL ERROR', coreLogFile, testLogFile, sourceSummary)
+        sys.exit(6)
+
+    endTime = time.time()
+    ingestLogStatus = logHelpers.logRunTime(ingestID, startTime, endTime)
+    if ingestLogStatus == False:
+        logger.error("Failed to update mongo ingest log. CHECK FOR ERRORS!")
+    report, regressed = logHelpers.regressionReport(ingestSources)
+    logger.info("Performance report\n" + report)
+    logHelpers.emailLogAndStatus('SUCCESS' if not regressed else 'SUCCESS (SLOWER THAN USUAL)', coreLogFile, testLogFile, sourceSummary + "\n\n" + report)
+    logger.info("Ingest Complete")
+
+def runSource(ingestSource, ingester, tests, ingestID, removeDeleted, dryRun, testRun, sourceResults, indexCheck=True, snapshot=False, countCheck=True):
+    # Runs the ingest, post-indexing, delete check and counts for one source
+    # and records its outcome in sourceResults
+    logger = logging.getLogger('ingest')
+    sourceStart = time.time()
+    try:
         logger.info("Starting import for: " + ingestSource)
         outcome = ingester.runIngest(dry=dryRun, test=testRun)
         if outcome is False:
             logger.error("Import of " + ingestSource + " failed! Review full log")
-            logHelpers.emailLogAndStatus('INGEST ERROR', logger.baseFilename, testLogger.baseFilename)
-            sys.exit(5)
-        else:
-            logger.info("Import of " + ingestSource + " successful!")
+            sourceResults[ingestSource] = 'INGEST ERROR'
+            return
+        logger.info("Import of " + ingestSource + " successful!")
+        if dryRun:
+            # Nothing was written, so there is nothing to check
+            sourceResults[ingestSource] = 'SUCCESS'
+            return
 
-    # If this was a full import, create indexes on collections
-    indexCreationResult = tests.checkIndexes(fullRefresh, 'post')
+        # Make sure the collections are still fully indexed after the import
+        if indexCheck:
+            indexCreationResult = tests.checkIndexes('post', [ingestSource])
 
-    # If delete flag is set, scan collections for deleted records and
-    # remove any that are not in the source APIs
-    if removeDeleted:
-        for ingestSource in ingestSources:
-            ingester = sourceNames[ingestSource]
-            logger.info("Checking and removing deleted records")
-            deleteOutcome = ingester.deleteCheck()
+        # If delete flag is set, scan collections for deleted records and
+        # remove any that are not in the source APIs
+        if removeDeleted:
+            if hasattr(ingester, 'deleteCheck'):
+                logger.info("Checking and removing deleted records from " + ingestSource)
+                deleteOutcome = ingester.deleteCheck()
+            else:
+                logger.warning(ingestSource + " does not support removing deleted records")
 
-    # Log the current number of records in ePandda
-    addFullCounts = logHelpers.addFullCounts(ingestID, ingestSources)
+        # Log the current number of records in ePandda
+        addFullCounts = logHelpers.addFullCounts(ingestID, [ingestSource])
 
-    # Test for existence/well form-edness of sentinel records
-    sentinelErrorStatus = tests.checkSentinels(ingestSources)
-    if sentinelErrorStatus is True:
-        logger.error("Sentinels Failed to Verify, check logs")
-        logHelpers.emailLogAndStatus('SENTINEL ERROR', coreLogFile, testLogFile)
-        sys.exit(6)
+        # Test for existence/well form-edness of sentinel records
+        sentinelErrorStatus = tests.checkSentinels([ingestSource])
+        if sentinelErrorStatus is True:
+            logger.error("Sentinels for " + ingestSource + " failed to verify, check logs")
+            sourceResults[ingestSource] = 'SENTINEL ERROR'
+            return
 
-    # Check full counts against APIs of source providers
-    tests.checkCounts(ingestSources, addFullCounts)
+        # Check full counts against APIs of source providers. Samples are
+        # never the full count
+        if countCheck:
+            tests.checkCounts([ingestSource], addFullCounts)
 
+        # Time of the ingest itself, for the performance history
+        logHelpers.logSourceRunTime(ingestID, ingestSource, time.time() - sourceStart)
 
-    endTime = time.time()
-    ingestLogStatus = logHelpers.logRunTime(ingestID, startTime, endTime)
-    if ingestLogStatus == False:
-        logger.error("Failed to update mongo ingest log. CHECK FOR ERRORS!")
-    logHelpers.emailLogAndStatus('SUCCESS', coreLogFile, testLogFile)
-    logger.info("Ingest Complete")
+        # Keep a columnar copy of the verified collection for restores
+        if snapshot:
+            mongoConn = mongoConnect.mongoConnect()
+            if mongoConn.exportSnapshot(ingestSource) is False:
+                logger.warning("Snapshot of " + ingestSource + " failed, the ingest itself succeeded")
+            mongoConn.closeConnection()
+        sourceResults[ingestSource] = 'SUCCESS'
+    except Exception:
+        logger.error("Ingest of " + ingestSource + " raised an exception\n" + traceback.format_exc())
+        sourceResults[ingestSource] = 'INGEST ERROR'
+
+def runDryRun(ingestSources, sourceNames, tests, testRun, coreLogFile, testLogFile):
+    # Runs every source through its download, parsing and diff stages
+    # without any writes, indexes or sentinels and sends out the reports
+    logger = logging.getLogger('ingest')
+    sourceResults = {}
+    for ingestSource in ingestSources:
+        runSource(ingestSource, sourceNames[ingestSource], tests, None, False, True, testRun, sourceResults)
+    sourceSummary = '\n'.join(ingestSource + ": " + sourceResults.get(ingestSource, 'NOT RUN') for ingestSource in ingestSources)
+    reports = '\n\n'.join(sourceNames[ingestSource].dryRunReport for ingestSource in ingestSources if sourceResults.get(ingestSource) == 'SUCCESS')
+    logger.info("Dry run results\n" + sourceSummary + "\n\n" + reports)
+    if 'INGEST ERROR' in sourceResults.values():
+        logHelpers.emailLogAndStatus('DRY RUN ERROR', coreLogFile, testLogFile, sourceSummary + "\n\n" + reports)
+        sys.exit(5)
+    logHelpers.emailLogAndStatus('DRY RUN', coreLogFile, testLogFile, sourceSummary + "\n\n" + reports)
+
+def runRestore(ingestSource, ingester, tests, snapshot, ingestID=None):
+    # Loads a snapshot into the shadow collection and swaps it in once it
+    # has been indexed and verified. The endpoints are rebuilt for the
+    # restored records, as after a full refresh
+    logger = logging.getLogger('ingest')
+    mongoConn = mongoConnect.mongoConnect()
+    manifest = mongoConn.restoreSnapshot(ingestSource, snapshot)
+    mongoConn.closeConnection()
+    if manifest is False:
+        return 'RESTORE ERROR'
+    if tests.promoteShadowCollection(ingestSource, ingester, manifest['shadow'], expectedCount=manifest['count']) is False:
+        logger.error("Restored snapshot of " + ingestSource + " was not swapped in")
+        return 'RESTORE ERROR'
+    mongoConn = mongoConnect.mongoConnect()
+    endpointResult = mongoConn.updateEndpoints(ingestSource, rebuild=True, ingestID=ingestID)
+    mongoConn.closeConnection()
+    if endpointResult is False:
+        logger.error(ingestSource + " linkage/summaries were not fully rebuilt after the restore, rebuild them with --rebuildEndpoints")
+        return 'RESTORE ERROR'
+    logger.info("Restored " + ingestSource + " from the snapshot taken " + manifest['created'] + ". Run a partial ingest to catch up on changes since then")
+    return 'SUCCESS'
 
 if __name__ == '__main__':
     main()
@@ -6,33 +6,124 @@
 # import database tools
 from pymongo import MongoClient
 import pymongo
-from pymongo.errors import BulkWriteError, InvalidOperation
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, InvalidOperation, OperationFailure, PyMongoError
 from bson import ObjectId
+from bson.min_key import MinKey
 
 # data tools
 import json
 import csv
 
 # sys tools
-from subprocess import Popen, PIPE, call
+from subprocess import Popen, PIPE, STDOUT, call
+import threading
 import logging
 import datetime
 import math
+import time
+import re
 
 # helper module
 from helpers import ingestHelpers
+from helpers import streamHelpers
+from helpers import conversionHelpers
+from helpers import compactionHelpers
+from helpers import throttleHelpers
+from helpers import fingerprintHelpers
+from helpers import countHelpers
+from helpers import eventHelpers
+from helpers import snapshotHelpers
+from helpers import linkageHelpers
+from helpers import summaryHelpers
+from helpers import normalizeHelpers
+from helpers import geoHelpers
+from helpers import indexHelpers
+from helpers import changeHelpers
+from helpers import dryRunHelpers
+
+# Fields that identify the same record across imports, independent of _id
+SOURCE_KEYS = {
+    'idigbio': 'idigbio:uuid',
+    'pbdb': 'occurrence_no'
+}
+
+# Fields that partial ingests find the records they touched by
+MODIFIED_FIELDS = {
+    'idigbio': 'idigbio:dateModified'
+}
+
+# Config values replaced for the whole process, such as the scratch
+# databases of a sampled test run
+configOverrides = {}
+
+def loadConfig():
+    config = json.load(open('./config.json'))
+    config.update(configOverrides)
+    return config
+
+SCRATCH_DB_KEYS = ['idigbio_db', 'pbdb_db', 'endpoints_db']
+
+def useScratchDatabases():
+    # Points each source and the endpoints at their own database named after
+    # sample_db, and the ingest log at sample_log_db, so their history is kept
+    # apart. Each source keeps its own sentinels collection that way
+    config = json.load(open('./config.json'))
+    sampleDB = config.get('sample_db', 'epandda_sample')
+    scratchDBs = dict((dbKey, sampleDB + '_' + dbKey[:-len('_db')]) for dbKey in SCRATCH_DB_KEYS)
+    liveDBs = dict((config[dbKey], scratchDBs[dbKey]) for dbKey in SCRATCH_DB_KEYS)
+    configOverrides.update(scratchDBs)
+    configOverrides['log_db'] = config.get('sample_log_db', sampleDB + '_log')
+    testIndexes = []
+    for indexCheck in config['test_indexes']:
+        # The collection key (such as idigbio_coll) tells which source an
+        # index belongs to, even if live sources share a database
+        dbKey = indexCheck['collection'].rsplit('_', 1)[0] + '_db'
+        if dbKey in scratchDBs and config.get(dbKey) == indexCheck['db']:
+            testIndexes.append(dict(indexCheck, db=scratchDBs[dbKey]))
+        else:
+            testIndexes.append(dict(indexCheck, db=liveDBs.get(indexCheck['db'], indexCheck['db'])))
+    configOverrides['test_indexes'] = testIndexes
+    return scratchDBs
+
+# Clients kept open between mongoConnect instances when running as a daemon
+sharedClients = {}
+sharedClientsLock = threading.Lock()
+shareClients = [False]
+
+def useSharedClients(enabled=True):
+    shareClients[0] = enabled
+
+def getClient(uri):
+    # UUIDs are always stored as standard (subtype 4) binary, which is what
+    # binary iDigBio ids are written as
+    if not shareClients[0]:
+        return MongoClient(uri, uuidRepresentation='standard')
+    with sharedClientsLock:
+        if uri not in sharedClients:
+            sharedClients[uri] = MongoClient(uri, uuidRepresentation='standard')
+        return sharedClients[uri]
 
 class mongoConnect:
     def __init__(self):
-        self.config = json.load(open('./config.json'))
-        self.client = MongoClient("mongodb://" + self.config['mongodb_user'] + ":" + self.config['mongodb_password'] + "@" + self.config['mongodb_host'])
+        self.config = loadConfig()
+        self.shared = shareClients[0]
+        self.client = getClient("mongodb://" + self.config['mongodb_user'] + ":" + self.config['mongodb_password'] + "@" + self.config['mongodb_host'])
         self.idigbio = self.client[self.config['idigbio_db']]
         self.pbdb = self.client[self.config['pbdb_db']]
         self.ingestLog = self.client[self.config['log_db']]
         self.endpoints = self.client[self.config['endpoints_db']]
         self.logger = logging.getLogger("ingest.mongoConnection")
+        self.compactionStats = {}
+        # iDigBio specimens keyed by their UUID as a binary _id
+        self.binaryIDs = self.config.get('idigbio_binary_ids', False)
+        # Documents skipped as duplicates of an existing key, per source
+        self.duplicateSkips = {}
 
     def closeConnection(self):
+        if self.shared:
+            # Shared clients stay open for the next run
+            return True
         try:
             self.client.close()
             return True
@@ -55,40 +146,256 @@ class mongoConnect:
         else:
             return 'static'
 
-    def iDBFullImport(self, occurrenceFile, collectionKey, collectionModified):
-        importCall = Popen(['mongoimport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['idigbio_db'], '-c', self.config['idigbio_coll'], '--numInsertionWorkers', '4', '--type', 'csv', '--file', occurrenceFile, '--headerline'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = importCall.communicate()
-        if importCall.returncode != 0:
-            self.logger.error("mongoimport failed with error: " + err)
-            return False
-        else:
-            self.logger.info("mongoimport success! " + out)
-        collCollection = self.idigbio.collectionStatus
-        updateStatus = collCollection.update({'collection': collectionKey}, {'$set': {'collection': collectionKey, 'modifiedDate': collectionModified}}, upsert=True)
-        if collCollection:
-            self.logger.debug("Added/updated collection entry in collectionStatus for " + collectionKey)
+    def buildImportArgs(self, db, collection, fileType='csv', headerline=True, upsertFields=None, drop=False):
+        controller = throttleHelpers.getController(self.client, self.config)
+        importArgs = ['mongoimport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', db, '-c', collection, '--type', fileType] + controller.importOptions()
+        if headerline:
+            importArgs.append('--headerline')
+        if upsertFields:
+            importArgs.extend(['--mode', 'upsert', '--upsertFields', upsertFields])
+        if drop:
+            importArgs.append('--drop')
+        return importArgs
+
+    def importRecords(self, db, collection, importSource, source, upsertFields=None, drop=False):
+        # CSV sources are written in-process when they need to be typed or
+        # compacted, otherwise mongoimport guesses the type of each value.
+        # Untyped in-process imports make the same guesses
+        if self.config.get('typed_import', False) or self.config.get('compact_documents', False) or self.binaryIDTarget(source, collection):
+            return self.documentImport(db, collection, importSource, source, upsertFields=upsertFields, drop=drop)
+        importArgs = self.buildImportArgs(db, collection, upsertFields=upsertFields, drop=drop)
+        return self.runImport(importArgs, importSource, source)
+
+    def documentImport(self, db, collection, importSource, source, upsertFields=None, drop=False):
+        targetCollection = self.client[db][collection]
+        schemaName = None
+        if self.config.get('typed_import', False):
+            schemaName = source
+        normalize = self.config.get('normalize_keys', True) and self.normalizeTarget(source, collection)
+        locate = self.config.get('build_geopoints', True) and self.locateTarget(source, collection)
+        binaryIDs = self.binaryIDTarget(source, collection)
+        compact = self.config.get('compact_documents', False)
+        if compact:
+            keepFields = set(self.config.get('compact_keep_fields', {}).get(source, []))
+            if upsertFields:
+                keepFields.add(upsertFields)
+            stats = self.compactionStats.setdefault(source, compactionHelpers.compactionStats(source))
+        if drop:
+            targetCollection.drop()
+        if not isinstance(importSource, basestring):
+            importSource = streamHelpers.chunkFile(importSource)
+        if upsertFields and binaryIDs:
+            # The _id is the record's UUID, so upserts use the _id index
+            writeFunction = lambda batch: targetCollection.bulk_write([ReplaceOne({'_id': document['_id']} if '_id' in document else {upsertFields: document.get(upsertFields)}, document, upsert=True) for document in batch], ordered=False)
+        elif upsertFields:
+            writeFunction = lambda batch: targetCollection.bulk_write([ReplaceOne({upsertFields: document.get(upsertFields)}, document, upsert=True) for document in batch], ordered=False)
         else:
-            self.logger.warning("Failed to update this record in collectionStatus: " + collectionKey)
+            writeFunction = lambda batch: targetCollection.insert_many(batch, ordered=False)
+        # Batch size and the number of concurrent writes follow the controller
+        writer = throttleHelpers.batchWriter(throttleHelpers.getController(self.client, self.config), writeFunction)
+        writeCount = 0
+        try:
+            for documents in conversionHelpers.iterTypedDocuments(importSource, schemaName, guessTypes=schemaName is None):
+                if not documents:
+                    continue
+                if normalize:
+                    normalizeHelpers.addKeyFields(documents, source)
+                if locate:
+                    geoHelpers.addGeoFields(documents, source)
+                if binaryIDs:
+                    ingestHelpers.addUUIDIDs(documents)
+                if compact:
+                    compactionHelpers.compactDocuments(documents, keepFields, stats)
+                writer.add(documents)
+                writeCount += len(documents)
+        except Exception as e:
+            writer.close()
+            countHelpers.invalidate(targetCollection.full_name)
+            self.logger.error("Document import of " + collection + " failed: " + str(e))
+            return False
+        writeErrors = self.skipDuplicates(writer.close(), source)
+        countHelpers.invalidate(targetCollection.full_name)
+        if writeErrors:
+            self.logger.error("Document import bulk failure for " + collection)
+            for writeError in writeErrors:
+                if isinstance(writeError, BulkWriteError):
+                    self.logger.error(writeError.details)
+                else:
+                    self.logger.error(str(writeError))
+            return False
+        self.logger.info("Document import success! " + str(writeCount) + " documents written to " + collection)
+        return True
+
+    def dryRunImport(self, source, importSource, report):
+        # Parses, validates and diffs a CSV source against the live collection
+        # the way importRecords would write it, with read-only queries
+        typed = self.config.get('typed_import', False)
+        if report.diff is None:
+            sourceCollection = self.client[self.config[source+'_db']][self.config[source+'_coll']]
+            report.diff = dryRunHelpers.recordDiff(sourceCollection, SOURCE_KEYS[source], typed, self.getFingerprintIgnorePaths(), binaryIDs=self.binaryIDs and source == 'idigbio')
+        if not isinstance(importSource, basestring):
+            importSource = streamHelpers.chunkFile(importSource)
+        try:
+            for documents in report.meter.timed('parse', conversionHelpers.iterTypedDocuments(importSource, source if typed else None)):
+                diffStart = time.time()
+                report.diff.compare(documents)
+                report.meter.add('diff', len(documents), time.time() - diffStart)
+                validateStart = time.time()
+                normalizeHelpers.addKeyFields(documents, source)
+                if self.locateTarget(source, self.config[source+'_coll']):
+                    geoHelpers.addGeoFields(documents, source)
+                report.meter.add('validate', len(documents), time.time() - validateStart)
+        except Exception as e:
+            self.logger.error("Dry run of " + source + " failed: " + str(e))
+            return False
         return True
 
-    def iDBPartialImport(self, occurrenceFile, collectionKey, collectionModified, fileType):
-        importCall = Popen(['mongoimport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['idigbio_db'], '-c', self.config['idigbio_coll'], '--numInsertionWorkers', '4', '--type', fileType, '--file', occurrenceFile, '--headerline', '--mode', 'upsert', '--upsertFields', 'idigbio:uuid'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    def runImport(self, importArgs, importSource, source=None):
+        # importSource is either the path to a file or an iterator of chunks
+        # that is streamed to mongoimport over stdin
+        if not isinstance(importSource, basestring):
+            return self.streamImport(importArgs, importSource, source)
+        startTime = time.time()
+        importCall = Popen(importArgs + ['--file', importSource], stdin=PIPE, stdout=PIPE, stderr=PIPE)
         out, err = importCall.communicate()
-        if importCall.returncode != 0:
+        self.invalidateImportCount(importArgs)
+        if not self.importSucceeded(importCall.returncode, out + err, source):
             self.logger.error("mongoimport failed with error: " + err)
             return False
-        else:
-            self.logger.info("mongoimport success! " + out)
-        collCollection = self.idigbio.collectionStatus
+        self.logger.info("mongoimport success! " + out)
+        self.observeImport(importArgs, time.time() - startTime, out + err)
+        return True
+
+    def importSucceeded(self, returncode, output, source):
+        # mongoimport carries on past duplicate key errors. Those documents
+        # are counted as skipped and only other errors fail the import
+        failedMatch = re.search(r'(\d+) document\(s\) failed to import', output)
+        failedCount = int(failedMatch.group(1)) if failedMatch else 0
+        duplicateCount = output.count('E11000')
+        if failedCount and duplicateCount >= failedCount:
+            self.addDuplicateSkips(source, failedCount)
+            return True
+        return returncode == 0 and not failedCount
+
+    def skipDuplicates(self, writeErrors, source):
+        # Returns the write errors left once duplicate key errors (11000) from
+        # unordered inserts are counted as skips
+        remainingErrors = []
+        for writeError in writeErrors:
+            if isinstance(writeError, BulkWriteError):
+                details = writeError.details
+                duplicates = [error for error in details.get('writeErrors', []) if error.get('code') == 11000]
+                self.addDuplicateSkips(source, len(duplicates))
+                if len(duplicates) == len(details.get('writeErrors', [])) and not details.get('writeConcernErrors'):
+                    continue
+            remainingErrors.append(writeError)
+        return remainingErrors
+
+    def addDuplicateSkips(self, source, skipped):
+        if skipped:
+            self.duplicateSkips[source] = self.duplicateSkips.get(source, 0) + skipped
+
+    def ensureUniqueKey(self, source, collectionName):
+        # Full imports insert through a unique index on the source's record
+        # key, so re-runs and overlapping recordsets can't create duplicates
+        if self.binaryIDTarget(source, collectionName):
+            return True
+        sourceKey = SOURCE_KEYS[source]
+        try:
+            self.client[self.config[source+'_db']][collectionName].create_index(sourceKey, unique=True)
+        except OperationFailure as e:
+            self.logger.warning("Could not create a unique " + sourceKey + " index on " + collectionName + ": " + str(e))
+            return False
+        return True
+
+    def invalidateImportCount(self, importArgs):
+        namespace = importArgs[importArgs.index('-d') + 1] + '.' + importArgs[importArgs.index('-c') + 1]
+        countHelpers.invalidate(namespace)
+
+    def observeImport(self, importArgs, seconds, output):
+        # Feeds the throughput of a finished mongoimport back to the controller
+        importedMatch = re.search(r'imported (\d+) document', output)
+        if not importedMatch:
+            return
+        workers = int(importArgs[importArgs.index('--numInsertionWorkers') + 1])
+        batchSize = int(importArgs[importArgs.index('--batchSize') + 1])
+        throttleHelpers.getController(self.client, self.config).observeImport(seconds, int(importedMatch.group(1)), batchSize, workers)
+
+    def streamImport(self, importArgs, chunks, source=None):
+        # Writes to the pipe block while mongoimport works through its buffer,
+        # which keeps the download from running ahead of the import
+        startTime = time.time()
+        importCall = Popen(importArgs, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        output = []
+        drain = threading.Thread(target=lambda: output.append(importCall.stdout.read()))
+        drain.daemon = True
+        drain.start()
+        streamFailed = False
+        try:
+            for chunk in chunks:
+                importCall.stdin.write(chunk)
+        except IOError as e:
+            self.logger.error("mongoimport closed its input early: " + str(e))
+            streamFailed = True
+        except Exception as e:
+            self.logger.error("Stream into mongoimport failed: " + str(e))
+            importCall.kill()
+            streamFailed = True
+        try:
+            importCall.stdin.close()
+        except IOError:
+            pass
+        importCall.wait()
+        drain.join()
+        self.invalidateImportCount(importArgs)
+        out = ''.join(output)
+        if streamFailed or not self.importSucceeded(importCall.returncode, out, source):
+            self.logger.error("mongoimport failed with error: " + out)
+            return False
+        self.logger.info("mongoimport success! " + out)
+        self.observeImport(importArgs, time.time() - startTime, out)
+        return True
+
+    def updateIDBCollectionStatus(self, collectionKey, collectionModified, statusCollection='collectionStatus'):
+        collCollection = self.idigbio[statusCollection]
         updateStatus = collCollection.update({'collection': collectionKey}, {'$set': {'collection': collectionKey, 'modifiedDate': collectionModified}}, upsert=True)
-        if collCollection:
+        if updateStatus:
             self.logger.debug("Added/updated collection entry in collectionStatus for " + collectionKey)
         else:
             self.logger.warning("Failed to update this record in collectionStatus: " + collectionKey)
+
+    def iDBFullImport(self, occurrenceSource, collectionKey, collectionModified, collection=None, statusCollection='collectionStatus'):
+        # collection and statusCollection are overridden to build a full
+        # refresh into a shadow collection
+        if collection is None:
+            collection = self.config['idigbio_coll']
+        self.ensureUniqueKey('idigbio', collection)
+        if self.importRecords(self.config['idigbio_db'], collection, occurrenceSource, 'idigbio') is False:
+            return False
+        self.updateIDBCollectionStatus(collectionKey, collectionModified, statusCollection)
+        return True
+
+    def iDBPartialImport(self, occurrenceSource, collectionKey, collectionModified, fileType):
+        if fileType == 'csv' or self.binaryIDs:
+            importResult = self.importRecords(self.config['idigbio_db'], self.config['idigbio_coll'], occurrenceSource, 'idigbio', upsertFields='idigbio:uuid')
+        else:
+            importArgs = self.buildImportArgs(self.config['idigbio_db'], self.config['idigbio_coll'], fileType=fileType, upsertFields='idigbio:uuid')
+            importResult = self.runImport(importArgs, occurrenceSource, 'idigbio')
+        if importResult is False:
+            return False
+        # Daemon windows aren't tracked in collectionStatus
+        if collectionKey is not None:
+            self.updateIDBCollectionStatus(collectionKey, collectionModified)
         return True
 
+    def removeRecordset(self, collectionName, recordSet):
+        removeResult = self.idigbio[collectionName].delete_many({'idigbio:recordset': recordSet})
+        countHelpers.invalidate(self.idigbio[collectionName].full_name)
+        self.logger.info("Removed " + str(removeResult.deleted_count) + " records of " + recordSet + " from " + collectionName)
+        return removeResult.deleted_count
+
     def idbGetRecordSets(self):
-        specimens = self.idigbio.specimens
+        specimens = self.idigbio[self.config['idigbio_coll']]
         recordSets = specimens.distinct("idigbio:recordset")
         recordSetCounts = []
         if not recordSets:
@@ -96,47 +403,61 @@ class mongoConnect:
         for recordSet in recordSets:
             setCount = specimens.find({'idigbio:recordset': recordSet}).count()
             if not setCount:
-                self.loggger("Couldn't find idigbio recordset " + recordSet + " for counting")
+                self.logger.error("Couldn't find idigbio recordset " + recordSet + " for counting")
                 return False
             recordSetCounts.append((recordSet, setCount))
 
         return recordSetCounts
 
-    def idbCheckAndDeleteRecords(self, setID, sourceUUIDs):
-        specimens = self.idigbio.specimens
-        epanddaUUIDs = set(specimens.find({'idigbio:recordset': setID}, {'idigbio:uuid': 1, '_id': -1}))
+    def idbCheckAndDeleteRecords(self, setID, sourceUUIDs, ingestID=None):
+        # Removes the specimens of a recordset that are no longer in iDigBio
+        # and returns how many were removed
+        specimens = self.idigbio[self.config['idigbio_coll']]
+        epanddaUUIDs = set(specimen['idigbio:uuid'] for specimen in specimens.find({'idigbio:recordset': setID}, {'idigbio:uuid': 1, '_id': 0}) if 'idigbio:uuid' in specimen)
         self.logger.debug("Comparing source and local sets for " + setID)
-        deletedSpecimens = list(sourceUUIDs ^ epanddaUUIDs)
-        if len(deleteSpecimens) > 0:
-            self.logger.info("Found " + str(len(deleteSpecimens)) + " deleted specimens in ePandda. Removing")
-            self.logger.debug(deleteSpecimens)
-        else:
-            self.logger.debug("Didn't find any missing specimens. Check recordset " + setID + "in iDigBio")
-        
-
-    def pbdbIngestTmpCollections(self, csvFiles):
-        for csvFile in csvFiles:
-            # Checking for duplicate headers
-            duplicateHeaders = ingestHelpers.csvDuplicateHeaderCheck(csvFile)
-            if duplicateHeaders:
-                self.logger.debug(duplicateHeaders)
-                renameStatus = ingestHelpers.csvRenameDuplicateHeaders(csvFile, duplicateHeaders)
-            collectionName = 'tmp_' + csvFile[:-4]
-            importArgs = ['mongoimport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['pbdb_db'], '-c', collectionName, '--numInsertionWorkers', '4', '--type', 'csv', '--file', csvFile, '--headerline']
+        deletedSpecimens = list(epanddaUUIDs - sourceUUIDs)
+        if not deletedSpecimens:
+            self.logger.debug("Didn't find any missing specimens. Check recordset " + setID + " in iDigBio")
+            return 0
+        self.logger.info("Found " + str(len(deletedSpecimens)) + " deleted specimens in ePandda. Removing")
+        self.logger.debug(deletedSpecimens)
+        # Counts are taken off the derived collections before the records go
+        self.removeFromEndpoints('idigbio', deletedSpecimens, ingestID)
+        deletedCount = 0
+        for start in range(0, len(deletedSpecimens), 10000):
+            deleteBatch = deletedSpecimens[start:start + 10000]
+            if self.binaryIDs:
+                deleteResult = specimens.delete_many({'_id': {'$in': [ingestHelpers.uuidID(specimen) for specimen in deleteBatch]}})
+            else:
+                deleteResult = specimens.delete_many({'idigbio:uuid': {'$in': deleteBatch}})
+            deletedCount += deleteResult.deleted_count
+        countHelpers.invalidate(specimens.full_name)
+        return deletedCount
+
+    def pbdbIngestTmpCollections(self, csvSources):
+        # csvSources is a list of (name, source) pairs, where source is either
+        # a downloaded CSV file or a stream of CSV chunks
+        for sourceName, csvSource in csvSources:
+            if isinstance(csvSource, basestring):
+                # Checking for duplicate headers
+                duplicateHeaders = ingestHelpers.csvDuplicateHeaderCheck(csvSource)
+                if duplicateHeaders:
+                    self.logger.debug(duplicateHeaders)
+                    renameStatus = ingestHelpers.csvRenameDuplicateHeaders(csvSource, duplicateHeaders)
+            else:
+                csvSource = streamHelpers.normalizeHeaderChunks(csvSource)
+            collectionName = 'tmp_' + sourceName
+            dropExisting = False
+            upsertFields = None
             if collectionName == 'tmp_occurrence':
-                importArgs.append('--drop')
-            	self.logger.debug("Dropping existing records in " + collectionName)
-	    elif collectionName == 'tmp_reference':
-                importArgs.extend(['--mode', 'upsert', '--upsertFields', 'reference_no'])
+                dropExisting = True
+                self.logger.debug("Dropping existing records in " + collectionName)
+            elif collectionName == 'tmp_reference':
+                upsertFields = 'reference_no'
             elif collectionName == 'tmp_collection':
-                importArgs.extend(['--mode', 'upsert', '--upsertFields', 'collection_no'])
-            importCall = Popen(importArgs, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            out, err = importCall.communicate()
-            if importCall.returncode != 0:
-                self.logger.error("mongoimport failed with error: " + err)
+                upsertFields = 'collection_no'
+            if self.importRecords(self.config['pbdb_db'], collectionName, csvSource, 'pbdb', upsertFields=upsertFields, drop=dropExisting) is False:
                 return False
-            else:
-                self.logger.info("mongoimport success! " + out)
         return True
 
     def pbdbMergeTmpCollections(self, occurrence, collection, reference):
@@ -153,33 +474,65 @@ class mongoConnect:
 
         self.logger.info("Merging occurrences and collections")
         collectionNos = occurrenceCollection.distinct('collection_no')
+        collectionEvents = eventHelpers.eventCounter(self.logger, "Merged collection data")
         for collectionNo in collectionNos:
             collectionData = collectionCollection.find_one({'collection_no': collectionNo})
             if not collectionData:
-                self.logger.error("Could not find collection_no: " + str(collectionNo))
+                self.logger.error("Could not find collection_no: %s", collectionNo)
+                collectionEvents.record(collectionNo, 'missing')
                 continue
             collectionData.pop("_id", None) # Remove ObjectID field
-            self.logger.debug("Adding collection data for collection_no: " + str(collectionNo))
             occurrenceCollection.update_many({'collection_no': collectionNo}, {'$addToSet': {'coll_refs': collectionData}})
+            collectionEvents.record(collectionNo)
+        collectionEvents.summary()
 
         self.logger.info("Merging occurrences and references")
         referenceNos = occurrenceCollection.distinct('reference_no')
+        referenceEvents = eventHelpers.eventCounter(self.logger, "Merged reference data")
         for referenceNo in referenceNos:
             referenceData = referenceCollection.find_one({'reference_no': referenceNo})
             if not referenceData:
-                self.logger.error("Could not find reference_no: " + str(referenceNo))
+                self.logger.error("Could not find reference_no: %s", referenceNo)
+                referenceEvents.record(referenceNo, 'missing')
                 continue
             referenceData.pop("_id", None) # Remove ObjectID field
-            self.logger.debug("Adding collection data for collection_no: " + str(referenceNo))
             occurrenceCollection.update_many({'reference_no': referenceNo}, {'$addToSet': {'occ_refs': referenceData}})
+            referenceEvents.record(referenceNo)
+        referenceEvents.summary()
 
         return True
 
-    def pbdbMergeNewData(self, tmp_occurrence):
+    def pbdbTmpOccurrenceNos(self, tmp_occurrence):
+        # The occurrences brought in by the current run
+        return self.pbdb[tmp_occurrence].distinct('occurrence_no')
+
+    def pbdbMergeNewData(self, tmp_occurrence, stream=False, collection=None, exportPath='tmp_occurrence.json'):
         self.logger.info("Merging new PaleoBio data")
 
+        exportArgs = ['mongoexport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['pbdb_db'], '-c', tmp_occurrence, '--type', 'json']
+        if collection is None:
+            importArgs = self.buildImportArgs(self.config['pbdb_db'], self.config['pbdb_coll'], fileType='json', headerline=False, upsertFields='occurrence_no')
+        else:
+            # A shadow collection starts empty and unindexed, so plain inserts
+            # avoid an unindexed upsert lookup for every document
+            importArgs = self.buildImportArgs(self.config['pbdb_db'], collection, fileType='json', headerline=False)
+        if stream:
+            self.logger.debug("Piping contents of temporary collection into upsert")
+            exportCall = Popen(exportArgs, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            exportErrors = []
+            drain = threading.Thread(target=lambda: exportErrors.append(exportCall.stderr.read()))
+            drain.daemon = True
+            drain.start()
+            importResult = self.streamImport(importArgs, streamHelpers.fileChunks(exportCall.stdout), 'pbdb')
+            exportCall.wait()
+            drain.join()
+            if exportCall.returncode != 0:
+                self.logger.error("mongoexport failed with error: " + ''.join(exportErrors))
+                return False
+            return importResult
+
         self.logger.debug("Exporting contents of temporary collection")
-        exportCall = Popen(['mongoexport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['pbdb_db'], '-c', 'tmp_occurrence', '--type', 'json', '-o', 'tmp_occurrence.json'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        exportCall = Popen(exportArgs + ['-o', exportPath], stdin=PIPE, stdout=PIPE, stderr=PIPE)
         out, err = exportCall.communicate()
         if exportCall.returncode != 0:
             self.logger.error("mongoexport failed with error: " + err)
@@ -188,14 +541,16 @@ class mongoConnect:
             self.logger.debug("Successfully exported temp mongo collection! " + out)
 
         self.logger.debug("Importing new contents of temporary collection with upsert")
-        importCall = Popen(['mongoimport', '--host', self.config['mongodb_host'], '-u', self.config['mongodb_user'], '-p', self.config['mongodb_password'], '--authenticationDatabase', 'admin', '-d', self.config['pbdb_db'], '-c', self.config['pbdb_coll'], '--numInsertionWorkers', '4', '--type', 'json', '--file', 'tmp_occurrence.json', '--mode', 'upsert', '--upsertFields', 'occurrence_no'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = importCall.communicate()
-        if importCall.returncode != 0:
-            self.logger.error("mongoimport failed with error: " + err)
+        return self.runImport(importArgs, exportPath, 'pbdb')
+
+    def resetScratchDatabase(self):
+        # Sampled test runs start from empty scratch databases
+        if 'log_db' not in configOverrides:
+            self.logger.error("Not using scratch databases, refusing to drop " + self.config['idigbio_db'])
             return False
-        else:
-            self.logger.info("mongoimport success! " + out)
-            return True
+        for dbKey in SCRATCH_DB_KEYS:
+            self.client.drop_database(self.config[dbKey])
+            self.logger.info("Dropped scratch database " + self.config[dbKey])
         return True
 
     def createIngestLog(self, sources):
@@ -204,9 +559,16 @@ class mongoConnect:
         ingestId = ingestRecord.inserted_id
         return ingestId
 
-    def addRunTime(self, ingestID, timeString):
+    def getLastIngestDate(self, source):
+        ingests = self.ingestLog[self.config['ingest_collection']]
+        lastIngest = ingests.find_one({'ingestSources': source, 'status': 'COMPLETE'}, sort=[('ingestDate', pymongo.DESCENDING)])
+        if not lastIngest:
+            return None
+        return lastIngest['ingestDate']
+
+    def addRunTime(self, ingestID, timeString, runSeconds=None):
         ingests = self.ingestLog[self.config['ingest_collection']]
-        ingestResult = ingests.update_one({'_id': ingestID}, {'$set': {'runTime': timeString, 'status': 'COMPLETE'}})
+        ingestResult = ingests.update_one({'_id': ingestID}, {'$set': {'runTime': timeString, 'runSeconds': runSeconds, 'status': 'COMPLETE'}})
         if ingestResult.modified_count == 1:
             self.logger.debug("Added run time to mongo ingest log")
             return True
@@ -214,6 +576,22 @@ class mongoConnect:
             self.logger.warning("Could not add time to mongo ingest log!")
             return False
 
+    def addSourceRunTime(self, ingestID, source, runSeconds):
+        ingests = self.ingestLog[self.config['ingest_collection']]
+        ingestResult = ingests.update_one({'_id': ingestID}, {'$set': {source+'_run_seconds': runSeconds}})
+        if ingestResult.modified_count == 1:
+            self.logger.debug("Added " + source + " run time to ingest log")
+            return True
+        else:
+            self.logger.warning("Could not add " + source + " run time to ingest log!")
+            return False
+
+    def getIngestHistory(self, days):
+        # Completed runs from the last n days, oldest first
+        ingests = self.ingestLog[self.config['ingest_collection']]
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        return list(ingests.find({'status': 'COMPLETE', 'ingestDate': {'$gte': since}}).sort('ingestDate', pymongo.ASCENDING))
+
     def addToIngestCount(self, ingestID, source, recordCount):
         ingests = self.ingestLog[self.config['ingest_collection']]
         ingestResult = ingests.update_one({'_id': ingestID}, {'$inc': {source+'_updated_records': recordCount}})
@@ -224,15 +602,242 @@ class mongoConnect:
             self.logger.warning("Could not add import count to ingest log!")
             return False
 
-    def getCollectionCount(self, source):
+    def addCompactionLog(self, ingestID, source):
+        if source not in self.compactionStats:
+            return True
+        stats = self.compactionStats[source]
+        self.logger.info(stats.summary())
+        ingests = self.ingestLog[self.config['ingest_collection']]
+        ingestResult = ingests.update_one({'_id': ingestID}, {'$inc': {source+'_compaction_fields_in': stats.fieldsIn, source+'_compaction_fields_kept': stats.fieldsKept, source+'_compaction_bytes_dropped': stats.bytesDropped}})
+        if ingestResult.modified_count == 1:
+            self.logger.debug("Added compaction stats to ingest log")
+            return True
+        else:
+            self.logger.warning("Could not add compaction stats to ingest log!")
+            return False
+
+    def exportSnapshot(self, source):
+        # Writes the live collection out to a parquet snapshot
+        if not snapshotHelpers.available():
+            return False
+        snapshotRoot = self.config.get('snapshot_dir', './snapshots')
+        collectionName = self.config[source+'_coll']
+        sourceCollection = self.client[self.config[source+'_db']][collectionName]
+        startTime = time.time()
+        writer = snapshotHelpers.snapshotWriter(snapshotRoot, source, collectionName, compression=self.config.get('snapshot_compression', 'snappy'), partRows=self.config.get('snapshot_part_rows', 100000))
+        try:
+            for document in sourceCollection.find({}, batch_size=10000):
+                writer.add(document)
+            # Collections swapped in with the records, such as collectionStatus
+            for shadowName, liveName in self.getShadowRenames(source)[1:]:
+                writer.addExtra(liveName, list(self.client[self.config[source+'_db']][liveName].find({})))
+            manifest = writer.close()
+        except Exception as e:
+            writer.abort()
+            self.logger.error("Snapshot of " + source + " failed: " + str(e))
+            return False
+        self.logger.info("Snapshot of %d %s records written to %s in %.1fs", manifest['count'], source, writer.path, time.time() - startTime)
+        snapshotHelpers.pruneSnapshots(snapshotRoot, source, self.config.get('snapshot_keep', 3))
+        return writer.path
+
+    def restoreSnapshot(self, source, snapshot='latest'):
+        # Loads a snapshot into the shadow collection. The caller verifies
+        # and swaps it in. Returns the manifest or False
+        if not snapshotHelpers.available():
+            return False
+        snapshotPath = snapshotHelpers.findSnapshot(self.config.get('snapshot_dir', './snapshots'), source, snapshot)
+        if not snapshotPath:
+            self.logger.error("No snapshot of " + source + " to restore")
+            return False
+        manifest = snapshotHelpers.readManifest(snapshotPath)
+        if manifest['source'] != source:
+            self.logger.error(snapshotPath + " is a snapshot of " + manifest['source'] + ", not " + source)
+            return False
+        shadowName = self.prepareShadowCollection(source)
+        shadowCollection = self.client[self.config[source+'_db']][shadowName]
+        self.logger.info("Restoring " + str(manifest['count']) + " " + source + " records from " + snapshotPath)
+        startTime = time.time()
+        writer = throttleHelpers.batchWriter(throttleHelpers.getController(self.client, self.config), lambda batch: shadowCollection.insert_many(batch, ordered=False))
+        try:
+            for documents in snapshotHelpers.readSnapshot(snapshotPath, manifest):
+                writer.add(documents)
+        except Exception as e:
+            writer.close()
+            self.logger.error("Could not read snapshot " + snapshotPath + ": " + str(e))
+            return False
+        writeErrors = self.skipDuplicates(writer.close(), source)
+        countHelpers.invalidate(shadowCollection.full_name)
+        if writeErrors:
+            self.logger.error("Snapshot restore bulk failure for " + source)
+            for writeError in writeErrors:
+                self.logger.error(str(writeError))
+            return False
+        for extraShadow, liveName in self.getShadowRenames(source)[1:]:
+            extraDocuments = snapshotHelpers.readExtra(snapshotPath, manifest, liveName)
+            if extraDocuments is None:
+                # Older snapshots don't have it. An empty one is swapped in so
+                # it isn't left describing records that are no longer there
+                self.logger.warning(snapshotPath + " has no " + liveName + ", it will be reset")
+            if extraDocuments:
+                self.client[self.config[source+'_db']][extraShadow].insert_many(extraDocuments, ordered=False)
+            else:
+                self.client[self.config[source+'_db']].create_collection(extraShadow)
+            countHelpers.invalidate(self.config[source+'_db'] + '.' + extraShadow)
+        self.logger.info("Restored %s into %s in %.1fs", snapshotPath, shadowName, time.time() - startTime)
+        manifest['shadow'] = shadowName
+        return manifest
+
+    def endpointBuilders(self, ingestID=None):
+        # The collections in endpoints_db that are derived from the sources.
+        # ingestID is the run the change manifest is written for
+        builders = []
+        if self.config.get('normalize_keys', True):
+            builders.append(('normalized keys', normalizeHelpers.keyBuilder(self.client, self.config, self.indexKeyFields)))
+        if self.config.get('build_geopoints', True):
+            builders.append(('geopoints', geoHelpers.geoBuilder(self.client, self.config)))
+        if self.config.get('build_linkage', True):
+            builders.append(('linkage', linkageHelpers.linkageBuilder(self.client, self.config, SOURCE_KEYS)))
+        if self.config.get('build_summaries', True):
+            builders.append(('summaries', summaryHelpers.summaryBuilder(self.client, self.config, SOURCE_KEYS)))
+        if self.config.get('build_change_manifest', True):
+            builders.append(('change manifest', changeHelpers.changeBuilder(self.client, self.config, SOURCE_KEYS, ingestID)))
+        return builders
+
+    def indexKeyFields(self, source, collection):
+        manager = indexHelpers.indexManager(self.client)
+        missingIndexes = manager.missingIndexes(collection.database.name, collection.name, normalizeHelpers.indexSpecs(source))
+        if missingIndexes:
+            manager.buildIndexes(collection.database.name, collection.name, missingIndexes)
+
+    def indexModifiedField(self, source, collection):
+        # Every endpoint builder runs the touched records query of a partial
+        # ingest, which would otherwise scan the whole collection each time
+        if source not in MODIFIED_FIELDS:
+            return
+        manager = indexHelpers.indexManager(self.client)
+        missingIndexes = manager.missingIndexes(collection.database.name, collection.name, [MODIFIED_FIELDS[source]])
+        if missingIndexes:
+            manager.buildIndexes(collection.database.name, collection.name, missingIndexes)
+
+    def binaryIDTarget(self, source, collection):
+        # mongoimport can't write binary ids, so these imports always go
+        # through the in-process writer
+        return self.binaryIDs and source == 'idigbio' and collection.startswith(self.config['idigbio_coll'])
+
+    def normalizeTarget(self, source, collection):
+        # Key fields and geopoints are added to the documents of the main
+        # collection (or its shadow) and to tmp_occurrence, which is merged
+        # into it
+        return collection.startswith(self.config[source+'_coll']) or collection == 'tmp_occurrence'
+
+    def locateTarget(self, source, collection):
+        # PBDB occurrences fall back to the coordinates of their collection,
+        # which are only there once coll_refs is merged, so their points are
+        # left to the geopoints builder
+        return source != 'pbdb' and self.normalizeTarget(source, collection)
+
+    def updateEndpoints(self, source, query=None, records=None, rebuild=False, ingestID=None):
+        # Updates the derived collections for the records touched by a run,
+        # given either as a query or as a list of record keys, or rebuilds
+        # them for the whole source
+        sourceCollection = self.client[self.config[source+'_db']][self.config[source+'_coll']]
+        updateResult = True
+        if query is not None and not rebuild:
+            self.indexModifiedField(source, sourceCollection)
+        for name, builder in self.endpointBuilders(ingestID):
+            try:
+                if rebuild:
+                    builder.rebuild(source, sourceCollection)
+                elif records is not None:
+                    for start in range(0, len(records), 10000):
+                        builder.update(source, sourceCollection, {SOURCE_KEYS[source]: {'$in': records[start:start + 10000]}})
+                else:
+                    builder.update(source, sourceCollection, query)
+            except PyMongoError as e:
+                self.logger.error("Could not update " + source + " " + name + ": " + str(e))
+                updateResult = False
+        return updateResult
+
+    def removeFromEndpoints(self, source, records, ingestID=None):
+        # For records deleted from a source
+        removeResult = True
+        for name, builder in self.endpointBuilders(ingestID):
+            try:
+                for start in range(0, len(records), 10000):
+                    builder.remove(source, records[start:start + 10000])
+            except PyMongoError as e:
+                self.logger.error("Could not remove deleted " + source + " records from " + name + ": " + str(e))
+                removeResult = False
+        return removeResult
+
+    def addDuplicateLog(self, ingestID, source):
+        skipped = self.duplicateSkips.pop(source, 0)
+        if not skipped:
+            return True
+        self.logger.info("Skipped %d duplicate %s records", skipped, source)
+        ingests = self.ingestLog[self.config['ingest_collection']]
+        ingestResult = ingests.update_one({'_id': ingestID}, {'$inc': {source+'_duplicates_skipped': skipped}})
+        if ingestResult.modified_count == 1:
+            self.logger.debug("Added duplicate count to ingest log")
+            return True
+        else:
+            self.logger.warning("Could not add duplicate count to ingest log!")
+            return False
+
+    def getShadowName(self, source, collectionName=None):
+        if collectionName is None:
+            collectionName = self.config[source+'_coll']
+        return collectionName + self.config.get('shadow_suffix', '_shadow')
+
+    def getShadowRenames(self, source):
+        renames = [(self.getShadowName(source), self.config[source+'_coll'])]
+        if source == 'idigbio':
+            renames.append((self.getShadowName(source, 'collectionStatus'), 'collectionStatus'))
+        return renames
+
+    def prepareShadowCollection(self, source):
+        # Clears anything left behind by an earlier failed refresh. No indexes
+        # are created so the bulk load runs without index maintenance
         sourceDB = self.client[self.config[source+'_db']]
-        sourceCollection = sourceDB[self.config[source+'_coll']]
-        totalCount = sourceCollection.find({}).count()
+        for shadowName, liveName in self.getShadowRenames(source):
+            sourceDB.drop_collection(shadowName)
+            countHelpers.invalidate(sourceDB[shadowName].full_name)
+        shadowName = self.getShadowName(source)
+        self.ensureUniqueKey(source, shadowName)
+        self.logger.info("Building full refresh of " + source + " into " + shadowName)
+        return shadowName
+
+    def swapShadowCollection(self, source):
+        dbName = self.config[source+'_db']
+        existingCollections = self.client[dbName].collection_names()
+        for shadowName, liveName in self.getShadowRenames(source):
+            if shadowName not in existingCollections:
+                self.logger.warning("No " + shadowName + " collection to swap in")
+                continue
+            countHelpers.invalidate(dbName + '.' + shadowName)
+            countHelpers.invalidate(dbName + '.' + liveName)
+            try:
+                self.client.admin.command('renameCollection', dbName + '.' + shadowName, to=dbName + '.' + liveName, dropTarget=True)
+                self.logger.info("Swapped " + shadowName + " in as " + liveName)
+            except OperationFailure as e:
+                self.logger.error("Failed to swap " + shadowName + " in as " + liveName + ": " + str(e))
+                return False
+        return True
+
+    def getCollectionCount(self, source, collectionName=None, exact=False):
+        # Served from collection metadata and cached for the run unless an
+        # exact count is needed
+        sourceDB = self.client[self.config[source+'_db']]
+        if collectionName is None:
+            collectionName = self.config[source+'_coll']
+        sourceCollection = sourceDB[collectionName]
+        totalCount = countHelpers.getCount(sourceCollection, exact=exact)
         return totalCount
 
     def addLogCount(self, ingestID, source):
         ingests = self.ingestLog[self.config['ingest_collection']]
-        totalCount = self.getCollectionCount(source)
+        # These totals are reconciled against the providers, so count exactly
+        totalCount = self.getCollectionCount(source, exact=True)
         self.logger.info(str(totalCount) + " Records in " + source)
         ingestResult = ingests.update_one({'_id': ingestID}, {'$set': {source+"_total_records": totalCount}})
         if ingestResult.modified_count == 1:
@@ -242,53 +847,6 @@ class mongoConnect:
             self.logger.warning("Could not add total count to ingest log!")
             return False
 
-    def indexTest(self, db, collection, indexes):
-        self.logger.debug("Checking indexes for " + collection)
-        collectionName = self.config[collection]
-        testCollection = self.client[db][collectionName]
-        existingIndexes = testCollection.index_information()
-        indexChecklist = []
-        missingIndexes = []
-        for indexID in existingIndexes:
-            indexName = existingIndexes[indexID]['key'][0][0]
-            self.logger.debug("Adding record for index " + indexName)
-            indexChecklist.append(indexName)
-        for index in indexes:
-            if index not in indexChecklist:
-                missingIndexes.append(index)
-        if missingIndexes:
-            return missingIndexes
-        return True
-
-
-    def deleteIndexes(self, db, collection, indexes):
-        self.logger.debug("Checking indexes for " + collection)
-        collectionName = self.config[collection]
-        testCollection = self.client[db][collectionName]
-	for index in indexes:
-	    try:
-		testCollection.drop_index(index)
-		self.logger.debug("Dropped " + index + " from " + collection)
-
-	    except:
-		self.logger.error("Failed to Drop index " + index + " on collection " + collection + " Exiting ")
-		return False
-
-	return True
-
-    def createIndexes(self, db, collection, indexes):
-        self.logger.info("Creating missing indexes for " + collection)
-        collectionName = self.config[collection]
-        targetCollection = self.client[db][collectionName]
-        for index in indexes:
-            try:
-                targetCollection.create_index(index)
-                self.logger.info("Created index " + index + " on " + collection)
-            except:
-                self.logger.error("Failed to create index " + index + " on " + collection)
-                return False
-        return True
-
     # This method is going to be deprecated as unecessary!
     # TODO DELETE once confirmed that we can just use upsert on records
     def generalPartialImport(self, reader, sourceType, idField, mongoCollection):
@@ -337,7 +895,7 @@ class mongoConnect:
     def getSentinelCount(self, source):
         sourceDB = self.client[self.config[source+'_db']]
         sentinelCollection = sourceDB['sentinels']
-        totalCount = sentinelCollection.find({}).count()
+        totalCount = countHelpers.getCount(sentinelCollection)
         return totalCount
 
     def addSentinels(self, source, totalCount, existingSentinels):
@@ -349,13 +907,16 @@ class mongoConnect:
         sentinelMax = int(math.ceil(totalCount * self.config['sentinel_ratio']))
         newSentinels = sentinelMax - existingSentinels
         sentinelInterval = totalCount / sentinelMax
-        self.logger.debug("setting sentinel interval to " + str(sentinelInterval) + " for max " + str(newSentinels) + " sentinals")
-        try:
-            lastSentinel = sentinelCollection.find_one({}).sort([('_id', -1)])
+        self.logger.debug("setting sentinel interval to %d for max %d sentinals", sentinelInterval, newSentinels)
+        # MinKey sorts before ObjectId and binary ids alike
+        lastSentinel = sentinelCollection.find_one({}, sort=[('_id', -1)])
+        if lastSentinel:
             lastSentinelID = lastSentinel['_id']
-        except AttributeError:
-            lastSentinelID = ObjectId('000000000000000000000000')
-        sentinelCount = 0
+        else:
+            lastSentinelID = MinKey()
+        controller = throttleHelpers.getController(self.client, self.config)
+        ignorePaths = self.getFingerprintIgnorePaths()
+        sentinelCount = pendingSentinels = 0
         bulk = sentinelCollection.initialize_unordered_bulk_op()
         while sentinelCount < newSentinels:
             sentinelCursor = sourceCollection.find({'_id': {'$gt': lastSentinelID}}).skip(sentinelInterval).limit(1)
@@ -364,64 +925,78 @@ class mongoConnect:
             except StopIteration:
                 sentinelCount += 1
                 continue
+            # Store the fingerprint so verification only has to hash the source
+            newSentinel['_fingerprint'] = fingerprintHelpers.fingerprint(newSentinel, ignorePaths)
+            newSentinel['_fingerprint_version'] = fingerprintHelpers.FINGERPRINT_VERSION
             bulk.find({'_id': newSentinel['_id']}).upsert().update({'$set': newSentinel})
             lastSentinelID = newSentinel['_id']
             sentinelCount += 1
-            if sentinelCount % 250 == 0:
-                try:
-                    bulk_results = bulk.execute()
-                    self.logger.debug(bulk_results)
-                except BulkWriteError as bwe:
-                    self.logger.error("Partial import bulk failure for these Sentinels")
-                    self.logger.error(bwe.details)
-                    importError = True
-                except InvalidOperation as io:
-                    self.logger.info("There were no records to update in Sentinels")
+            pendingSentinels += 1
+            if pendingSentinels >= controller.batchSize:
+                self.executeSentinelBulk(bulk, controller, pendingSentinels)
                 bulk = sentinelCollection.initialize_unordered_bulk_op()
+                pendingSentinels = 0
 
-        if sentinelCount % 250 != 0:
-            try:
-                bulk_results = bulk.execute()
-                self.logger.debug(bulk_results)
-            except BulkWriteError as bwe:
-                self.logger.error("Partial import bulk failure for these Sentinels")
-                self.logger.error(bwe.details)
-                importError = True
-            except InvalidOperation as io:
-                self.logger.info("There were no records to update in Sentinels")
-
+        if pendingSentinels:
+            self.executeSentinelBulk(bulk, controller, pendingSentinels)
+        countHelpers.invalidate(sentinelCollection.full_name)
 
-        self.logger.info(str(sentinelCount) + " new sentinel records created")
+        self.logger.info("%d new sentinel records created", sentinelCount)
         if sentinelCount + existingSentinels >= sentinelMax:
             return True
         else:
             return False
 
-    def verifySentinels(self, source):
+    def getFingerprintIgnorePaths(self):
+        # Volatile paths that differ between copies of the same record
+        return fingerprintHelpers.DEFAULT_IGNORE_PATHS.union(self.config.get('fingerprint_ignore_paths', []))
+
+    def executeSentinelBulk(self, bulk, controller, sentinelCount):
+        try:
+            bulk_results = controller.timedWrite(bulk.execute, sentinelCount)
+            self.logger.debug(bulk_results)
+        except BulkWriteError as bwe:
+            self.logger.error("Partial import bulk failure for these Sentinels")
+            self.logger.error(bwe.details)
+        except InvalidOperation as io:
+            self.logger.info("There were no records to update in Sentinels")
+
+    def verifySentinels(self, source, collectionName=None):
         sourceDB = self.client[self.config[source+'_db']]
-        sourceCollection = sourceDB[self.config[source+'_coll']]
+        if collectionName is None:
+            collectionName = self.config[source+'_coll']
+        sourceCollection = sourceDB[collectionName]
         sentinelCollection = sourceDB['sentinels']
+        # Sentinels are matched on the source's own key, which survives the
+        # new _ids assigned by a full refresh
+        sourceKey = SOURCE_KEYS[source]
+        ignorePaths = self.getFingerprintIgnorePaths()
 
         sentinels = sentinelCollection.find({})
         self.logger.info("Checking sentinels for " + source)
-        modifiedSentinels = staticSentinels = missingSentinels = sentinelBatch = sentinelCount = 0
+        modifiedSentinels = staticSentinels = missingSentinels = 0
+        sentinelEvents = eventHelpers.eventCounter(self.logger, "Checked " + source + " sentinels", sampleEvery=100, level=logging.INFO)
         for sentinel in sentinels:
-            if sentinelCount % 100 == 0:
-                sentinelBatch += 1
-                self.logger.info("Processing Sentinel Batch " + str(sentinelBatch))
-            sentinelCount += 1
-            sourceRecord = sourceCollection.find_one({'_id': sentinel['_id']})
+            sentinelID = sentinel['_id']
+            if self.binaryIDs and source == 'idigbio':
+                sourceRecord = sourceCollection.find_one({'_id': ingestHelpers.uuidID(sentinel.get(sourceKey))})
+            else:
+                sourceRecord = sourceCollection.find_one({sourceKey: sentinel.get(sourceKey)})
             if not sourceRecord:
                 missingSentinels += 1
-                self.logger.warning("document " + str(sourceRecord['_id']) + " is missing")
+                self.logger.warning("document %s is missing", sentinelID)
+                sentinelEvents.record(sentinelID, 'missing')
                 continue
-            recordChanged = ingestHelpers.compareDocuments(sourceRecord, sentinel)
+            recordChanged = ingestHelpers.compareDocuments(sourceRecord, sentinel, ignorePaths)
             if recordChanged is True:
                 modifiedSentinels += 1
-                self.logger.warning("document " + str(sourceRecord['_id']) + " has changed")
+                self.logger.warning("document %s has changed", sentinelID)
+                sentinelEvents.record(sentinelID, 'modified')
                 continue
 
             staticSentinels += 1
+            sentinelEvents.record(sentinelID, 'unchanged')
 
-        self.logger.info(str(staticSentinels) + " Sentinels Unchanged / " + str(modifiedSentinels) + " Sentinels Modified / " + str(missingSentinels) + " Sentinels Missing")
+        sentinelEvents.summary(level=logging.DEBUG)
+        self.logger.info("%d Sentinels Unchanged / %d Sentinels Modified / %d Sentinels Missing", staticSentinels, modifiedSentinels, missingSentinels)
         return staticSentinels, modifiedSentinels, missingSentinels
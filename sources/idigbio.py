@@ -21,26 +21,36 @@ import shutil
 import logging
 from datetime import datetime, timedelta
 import time
+import math
 import re
+import threading
+import Queue
 
 # local modules
 import mongoConnect
+from helpers import dryRunHelpers
 from helpers import ingestHelpers
+from helpers import queueHelpers
+from helpers import sampleHelpers
+from helpers import scratchHelpers
+from helpers import scheduleHelpers
+from helpers import streamHelpers
 from helpers import testHelpers
 
 class idigbio:
-    def __init__(self, test, fullRefresh, ingestLog):
-        self.config = json.load(open('./config.json'))
+    def __init__(self, test, fullRefresh, ingestLog, stream=False, queueName=None, workers=1):
+        self.config = mongoConnect.loadConfig()
         self.source = "idigbio"
         self.fullRefresh = fullRefresh
+        self.stream = stream
+        self.queueName = queueName
+        self.workers = max(1, workers)
         self.ingestURL = "http://s.idigbio.org/idigbio-static-downloads?max-keys=10000000"
         self.collectionRoot = "http://s.idigbio.org/idigbio-static-downloads/"
         self.refreshInterval = self.config['idigbio_ingest_interval']
         if test:
             self.refreshInterval = 1
-        self.refreshDate = datetime.today() - timedelta(days=int(self.refreshInterval))
-        self.refreshFrom = self.refreshDate.strftime('%Y-%m-%d')
-        self.refreshURL = 'https://api.idigbio.org/v2/download/?rq={"datemodified":{"type":"range","gte":"' + self.refreshFrom + '"}}'
+        self.setRefreshWindow(datetime.today() - timedelta(days=int(self.refreshInterval)), '%Y-%m-%d', recordStatus=True)
         self.refreshDownloadURL = "http://s.idigbio.org/idigbio-downloads/"
         self.recordCountURL = "https://search.idigbio.org/v2/summary/count/records/"
         self.deleteCheckRoot = "https://search.idigbio.org/v2/summary/stats/api?recordset="
@@ -49,6 +59,30 @@ class idigbio:
         self.testLogger = logging.getLogger("test.idigbio")
         self.ingestLog = ingestLog
         self.tests = testHelpers.epanddaTests(None, None)
+        self.scratch = scratchHelpers.getScratch(self.config)
+        self.occurrenceFiles = ['occurrence.txt', 'occurrence.csv']
+        self.sampleSets = None
+        self.sampleSize = None
+        self.sampleQuota = None
+        self.sampleSeed = 0
+        self.headerChecklist = ['idigbio:uuid', 'idigbio:institutionName', 'dwc:genus', 'dwc:specificEpithet', 'dwc:country', 'dwc:stateProvince', 'dwc:earliestAgeOrLowestStage', 'dwc:latestAgeOrHighestStage', 'dwc:formation']
+
+    def setRefreshWindow(self, refreshDate, dateFormat='%Y-%m-%dT%H:%M:%S', recordStatus=False):
+        # The daemon narrows this to the time since its last completed run.
+        # Daily windows are recorded in collectionStatus so a day isn't
+        # imported twice. The daemon's move on with every run, so they aren't
+        self.refreshDate = refreshDate
+        self.refreshFrom = refreshDate.strftime(dateFormat)
+        self.recordStatus = recordStatus
+        self.refreshURL = 'https://api.idigbio.org/v2/download/?rq={"datemodified":{"type":"range","gte":"' + self.refreshFrom + '"}}'
+
+    def setSample(self, sampleSize, sampleSets, seed):
+        # Sampled test runs do a full ingest of a seeded choice of whole
+        # recordsets, cut down to sampleSize records between them if given
+        self.sampleSets = sampleSets or self.config.get('sample_recordsets', 1)
+        self.sampleSize = sampleSize
+        self.sampleSeed = seed
+        self.queueName = None
 
     # This is the main component of the ingester, and relies on a few different
     # helpers. But most of this code is specific to iDigBio
@@ -56,11 +90,23 @@ class idigbio:
         # Should this be a dry or test run?
         dryRun = dry
         testRun = test
+        if dryRun:
+            return self.runDryIngest()
         # Check the type of import that should be run
         if self.fullRefresh:
             ingestResult = self.runFullIngest()
+            if ingestResult is False:
+                self.logger.error("Full refresh of iDigBio was not swapped in")
+                return False
         else:
             ingestResult = self.runPartialIngest()
+            if ingestResult is False:
+                # The daemon only moves its window on once a run succeeds
+                self.logger.error("Partial ingest of iDigBio failed")
+                return False
+
+        # Update the linkage and summaries for the records touched by this run
+        self.updateEndpoints()
 
         # create Sentinel records for new records
         sentinelStatus = self.tests.createSentinels(['idigbio'])
@@ -70,40 +116,262 @@ class idigbio:
         return True
 
     def runPartialIngest(self):
-        self.logger.info("Starting ingest of iDigbio records modified in past " + str(self.refreshInterval) + " days")
+        self.logger.info("Starting ingest of iDigbio records modified since " + self.refreshFrom)
 
         # open a mongo connection
         mongoConn = mongoConnect.mongoConnect()
-        collectionName = 'iDigBio_ingest_' + self.refreshFrom
-        # Check if the collection has already been updated for this date
-        refreshStatus = mongoConn.checkIDBCollectionStatus(collectionName, self.refreshFrom)
+        collectionName = None
+        refreshStatus = None
+        if self.recordStatus:
+            collectionName = 'iDigBio_ingest_' + self.refreshFrom
+            # Check if the collection has already been updated for this date
+            refreshStatus = mongoConn.checkIDBCollectionStatus(collectionName, self.refreshFrom)
         if refreshStatus == 'static':
+            # Nothing left to do, which isn't a failure
             self.logger.info("An ingest has already been run from this date")
-            return False
+            mongoConn.closeConnection()
+            return True
 
-        # Query the iDigBio API for modified records
-        occurrenceFile, collectionKey = self.idbAPIDownload(self.refreshURL)
-        if not occurrenceFile:
+        # Query the iDigBio API for modified records. The download and its
+        # extracted files are removed with the workspace
+        with self.scratch.workspace('partial', 0 if self.stream else None) as work:
+            partialResult = self.runPartialImport(mongoConn, collectionName, work)
+        mongoConn.closeConnection()
+        return partialResult
+
+    def runPartialImport(self, mongoConn, collectionName, work):
+        downloadResult = self.idbAPIDownload(self.refreshURL, work)
+        if not downloadResult:
             return False
+        occurrenceFile, collectionKey = downloadResult
 
-        # Get the count of records being imported and store it in the ingest log
-        recordCount = ingestHelpers.csvCountRows(occurrenceFile)
-        recordCountResult = mongoConn.addToIngestCount(self.ingestLog, self.source, recordCount)
-        if recordCountResult is False:
-            self.logger.error("Could not log record count. Check validity carefully!")
+        if self.stream:
+            rowCounter = {}
+            occurrenceFile = streamHelpers.countingChunks(occurrenceFile, rowCounter)
+        else:
+            # Get the count of records being imported and store it in the ingest log
+            self.logIngestCount(mongoConn, ingestHelpers.csvCountRows(occurrenceFile))
 
         # Download and ingest the created iDigBio file
         ingestResult = mongoConn.iDBPartialImport(occurrenceFile, collectionName, self.refreshFrom, 'csv')
         if ingestResult is False:
             self.logger.error("There were at least some errors during import of " + collectionKey)
-            print "Imported with at least some errors"
         else:
             self.logger.info("Updated records in " + collectionKey)
+        if self.stream:
+            self.logIngestCount(mongoConn, rowCounter.get('rows', 0))
+        mongoConn.addCompactionLog(self.ingestLog, self.source)
+        mongoConn.addDuplicateLog(self.ingestLog, self.source)
 
+        return ingestResult is not False
+
+    def runDryIngest(self):
+        # Downloads, parses and diffs the records a real run would import
+        # without writing to mongo. The report is kept for the run summary
+        mongoConn = mongoConnect.mongoConnect()
+        report = dryRunHelpers.dryRunReport(self.source, self.fullRefresh)
+        if self.stream:
+            report.notes.append("Streamed downloads are read as they are parsed, so parse times include the download")
+        if self.fullRefresh:
+            self.logger.info("Starting dry run of a complete iDigBio ingest")
+            collections = self.getCollectionListing()
+            for collection in scheduleHelpers.largestFirst(collections):
+                if self.dryRunCollection(mongoConn, report, collection) is False:
+                    self.logger.error("Dry run of " + collection['key'] + " failed")
+            report.setDeleted(mongoConn.getCollectionCount(self.source, exact=True))
+        else:
+            self.logger.info("Starting dry run of iDigBio records modified since " + self.refreshFrom)
+            if self.dryRunCollection(mongoConn, report, None) is False:
+                mongoConn.closeConnection()
+                return False
+            report.notes.append("Deleted records are only found by --removeDeleted, which a dry run doesn't check")
+        ingests = mongoConn.getIngestHistory(self.config.get('regression', {}).get('history', 90))
+        self.dryRunReport = report.build(ingests)
+        mongoConn.closeConnection()
         return True
 
+    def dryRunCollection(self, mongoConn, report, collection):
+        # Without a collection the records modified since refreshFrom are
+        # requested from the API, as for a partial ingest
+        if collection is None:
+            workspace = self.scratch.workspace('dry-partial', 0 if self.stream else None)
+        else:
+            workspace = self.scratch.zipWorkspace('dry-' + collection['key'], 0 if self.stream else collection['size'])
+        with workspace as work:
+            downloadStart = time.time()
+            if collection is None:
+                downloadResult = self.idbAPIDownload(self.refreshURL, work)
+                if not downloadResult:
+                    return False
+                occurrenceFile, collectionKey = downloadResult
+            elif self.stream:
+                occurrenceFile = self.streamCollection(self.collectionRoot, collection['key'])
+            else:
+                collectionKey = collection['key']
+                collectionDir = self.downloadCollection(self.collectionRoot, collectionKey, work)
+                if not collectionDir:
+                    return False
+                occurrenceFile = self.checkCollection(collectionDir)
+            if self.stream:
+                return mongoConn.dryRunImport(self.source, report.meter.timed('download', occurrenceFile), report)
+            report.meter.add('download', os.path.getsize(work.path(collectionKey)), time.time() - downloadStart)
+            if not occurrenceFile:
+                return False
+            return mongoConn.dryRunImport(self.source, occurrenceFile, report)
+
+    def updateEndpoints(self):
+        mongoConn = mongoConnect.mongoConnect()
+        if self.fullRefresh:
+            endpointResult = mongoConn.updateEndpoints(self.source, rebuild=True, ingestID=self.ingestLog)
+        else:
+            # A partial ingest only brings in records modified since
+            # refreshFrom. dateModified is a string, or a date with typed_import
+            touched = {'$or': [{'idigbio:dateModified': {'$gte': self.refreshFrom}}, {'idigbio:dateModified': {'$gte': self.refreshDate}}]}
+            endpointResult = mongoConn.updateEndpoints(self.source, query=touched, ingestID=self.ingestLog)
+        mongoConn.closeConnection()
+        if endpointResult is False:
+            self.logger.error("iDigBio linkage/summaries were not fully updated, rebuild them with --rebuildEndpoints")
+        return endpointResult
+
+    def logIngestCount(self, mongoConn, recordCount):
+        # Store the count of records being imported in the ingest log
+        recordCountResult = mongoConn.addToIngestCount(self.ingestLog, self.source, recordCount)
+        if recordCountResult is False:
+            self.logger.error("Could not log record count. Check validity carefully!")
+
     def runFullIngest(self):
         self.logger.info("Starting complete iDigBio Ingest")
+        collections = self.getCollectionListing()
+        if self.sampleSets:
+            collections = sampleHelpers.chooseRecordSets(collections, self.sampleSets, self.sampleSeed, self.config.get('sample_max_set_bytes', 50 * 1024 * 1024))
+            if self.sampleSize:
+                self.sampleQuota = int(math.ceil(self.sampleSize / float(max(1, len(collections)))))
+
+        # open a mongo connection
+        mongoConn = mongoConnect.mongoConnect()
+        if self.queueName:
+            return self.runQueuedIngest(mongoConn, collections)
+
+        # The refresh is built in a shadow collection and swapped in at the end
+        # so the live collection stays indexed and complete throughout
+        shadowName = mongoConn.prepareShadowCollection(self.source)
+        mongoConn.closeConnection()
+
+        # Work through the largest collections first across the workers
+        scheduleHelpers.logSchedule(collections, self.workers)
+        collectionQueue = Queue.Queue()
+        for collection in scheduleHelpers.largestFirst(collections):
+            collectionQueue.put(collection)
+        self.runWorkers(self.listWorker, collectionQueue, shadowName)
+
+        # Index, verify and swap in the refreshed collection
+        return self.tests.promoteShadowCollection(self.source, self, shadowName)
+
+    def runQueuedIngest(self, mongoConn, collections):
+        # Shares the refresh with every other node running the same queue. The
+        # node that creates the queue prepares the shadow collection and the
+        # last node to finish swaps it in. Queue names are taken as given, so
+        # every run needs its own
+        queue = queueHelpers.workQueue(mongoConn.idigbio.workQueue, self.queueName, maxAttempts=self.config.get('queue_max_attempts', 3))
+        shadowName = mongoConn.getShadowName(self.source)
+        creator = queue.create() or queue.takeOver()
+        while not creator:
+            queueStatus = queue.waitUntilReady()
+            if queueStatus in ('stale', 'failed'):
+                # Its creator died while seeding it, or an earlier run of this
+                # queue failed and is run again
+                creator = queue.takeOver()
+                continue
+            if queueStatus == 'complete':
+                self.logger.error("Work queue " + self.queueName + " has already completed. Give every run its own --queue name")
+                mongoConn.closeConnection()
+                return False
+            if queueStatus == 'finishing':
+                self.logger.info("Another worker is swapping in the refreshed collection of " + self.queueName)
+                mongoConn.closeConnection()
+                return True
+            break
+
+        # The header heartbeat tells other runs this queue is still active
+        queue.startHeartbeat()
+        try:
+            if creator:
+                activeQueues = queue.activeQueues()
+                if activeQueues:
+                    # Preparing the shadow would drop what they are building
+                    self.logger.error("Work queues " + ', '.join(activeQueues) + " are still building the shadow collection. Not starting " + self.queueName)
+                    queue.markComplete(False)
+                    return False
+                mongoConn.prepareShadowCollection(self.source)
+                queue.seed(collections)
+
+            self.runWorkers(self.queueWorker, queue, shadowName)
+
+            self.logger.info("Work queue " + self.queueName + " finished: " + str(queue.summary()))
+            if not queue.claimFinish():
+                self.logger.info("Another worker is swapping in the refreshed collection")
+                return True
+            failedItems = queue.failedItems()
+            if failedItems:
+                # The shadow is missing these recordsets, so it isn't swapped in
+                self.logger.error(str(len(failedItems)) + " recordsets failed every attempt, keeping the live collection: " + ', '.join(failedItems))
+                queue.markComplete(False)
+                return False
+            promoteResult = self.tests.promoteShadowCollection(self.source, self, shadowName)
+            queue.markComplete(promoteResult)
+            return promoteResult
+        finally:
+            queue.stopHeartbeat()
+            mongoConn.closeConnection()
+
+    def runWorkers(self, worker, work, shadowName):
+        # Every worker gets its own mongo connection. Bytes in flight are
+        # capped across all of them by max_bytes_in_flight
+        budget = scheduleHelpers.byteBudget(self.config.get('max_bytes_in_flight'))
+        workerThreads = []
+        for i in range(self.workers):
+            workerThread = threading.Thread(target=worker, args=(work, budget, shadowName))
+            workerThread.start()
+            workerThreads.append(workerThread)
+        for workerThread in workerThreads:
+            workerThread.join()
+
+    def listWorker(self, collectionQueue, budget, shadowName):
+        mongoConn = mongoConnect.mongoConnect()
+        while True:
+            try:
+                collection = collectionQueue.get_nowait()
+            except Queue.Empty:
+                break
+            with budget.reserve(collection['size']):
+                self.importCollection(mongoConn, collection, shadowName)
+        mongoConn.addCompactionLog(self.ingestLog, self.source)
+        mongoConn.addDuplicateLog(self.ingestLog, self.source)
+        mongoConn.closeConnection()
+
+    def queueWorker(self, queue, budget, shadowName):
+        mongoConn = mongoConnect.mongoConnect()
+        while True:
+            # Largest first across every node sharing the queue
+            item = queue.claim(sort=[('size', -1)])
+            if item is None:
+                if not queue.hasUnfinished():
+                    break
+                # Other workers still hold items. Keep waiting in case one
+                # of them dies and its lease has to be picked up
+                time.sleep(30)
+                continue
+            if item['attempts'] > 1:
+                # Clear out whatever the failed worker managed to import
+                mongoConn.removeRecordset(shadowName, item['key'][:-4])
+            with budget.reserve(item['size']):
+                importResult = self.importCollection(mongoConn, item, shadowName)
+            queue.complete(item, importResult)
+        mongoConn.addCompactionLog(self.ingestLog, self.source)
+        mongoConn.addDuplicateLog(self.ingestLog, self.source)
+        mongoConn.closeConnection()
+
+    def getCollectionListing(self):
         # Get and parse iDigBios XML digest of all of their component collections
         endpoints = urllib2.urlopen(self.ingestURL).read()
     	endpointXML = BeautifulSoup(endpoints, 'lxml')
@@ -117,74 +385,67 @@ class idigbio:
             print "Please adjust the URL in the idigbio.py __init__ function it is returning truncated results"
             sys.exit(1)
 
-        # open a mongo connection
-        mongoConn = mongoConnect.mongoConnect()
-
-    	# Iterate through everything we get back
+        collections = []
     	for collection in endpointXML.find_all('contents'):
             collectionKey = collection.key.string
-            collectionModified = collection.lastmodified.string
-            collectionSize = collection.size.string
             # Skip these collections
             if '.eml' in collectionKey or 'idigbio' in collectionKey or '.png' in collectionKey:
                 self.logger.info("This idigbio collection cannot be imported: " + collectionKey)
                 continue
-
-            # Check if this collection a) exists and b) was modified since last import
-            # If not exists import it straight, if it does replace matching docs in mongo
-            # Returns 3 possible flags: new | modified | static
-            # TODO only update specific fields? Or just overwrite in mongo?
-            self.logger.info("Checking status of collection " + collectionKey)
-            collectionStatus = mongoConn.checkIDBCollectionStatus(collectionKey, collectionModified)
-            if collectionStatus == 'static':
-                self.logger.debug("Skipping collection " + collectionKey + " no changes since last ingest")
-                continue
-
-    		# Download & unzip the zip file!
-            collectionDir = self.downloadCollection(self.collectionRoot, collectionKey)
+            collections.append({'key': collectionKey, 'modified': collection.lastmodified.string, 'size': int(collection.size.string)})
+        return collections
+
+    def importCollection(self, mongoConn, collection, shadowName):
+        # Waits for scratch space for the download and its extracted files,
+        # which are removed with the workspace whether the import works or not
+        with self.scratch.zipWorkspace(collection['key'], 0 if self.stream else collection['size']) as work:
+            return self.importCollectionIn(mongoConn, collection, shadowName, work)
+
+    def importCollectionIn(self, mongoConn, collection, shadowName, work):
+        collectionKey = collection['key']
+        collectionModified = collection['modified']
+        shadowStatus = mongoConn.getShadowName(self.source, 'collectionStatus')
+        if self.stream:
+            # Stream the occurrence file out of the zip straight into mongo
+            rowCounter = {}
+            occurrenceFile = self.streamCollection(self.collectionRoot, collectionKey)
+            if self.sampleQuota:
+                occurrenceFile = sampleHelpers.sampleChunks(occurrenceFile, 'idigbio:uuid', self.sampleQuota, self.sampleSeed)
+            occurrenceFile = streamHelpers.countingChunks(occurrenceFile, rowCounter)
+        else:
+            # Download & unzip the zip file!
+            collectionDir = self.downloadCollection(self.collectionRoot, collectionKey, work)
             if not collectionDir:
-                continue
+                return False
 
             # Check that we got a decent CSV/TXT file in that unzipped directory
             # This spot checks 'core' fields from each of the main indexes we create
             # If there they're it means that its a well formed record
             occurrenceFile = self.checkCollection(collectionDir)
             if not occurrenceFile:
-                continue
+                return False
+            if self.sampleQuota:
+                sampleHelpers.sampleFile(occurrenceFile, 'idigbio:uuid', self.sampleQuota, self.sampleSeed)
 
             # Get the count of records being imported and store it in the ingest log
-            recordCount = ingestHelpers.csvCountRows(occurrenceFile)
-            recordCountResult = mongoConn.addToIngestCount(self.ingestLog, self.source, recordCount)
-            if recordCountResult is False:
-                self.logger.error("Could not log record count. Check validity carefully!")
-
-            # TODO Image check and merge
-
-            # If the collection has validated, then either import the full collection or
-            # import the updated specimens
-            if collectionStatus == 'new':
-                self.logger.info("Doing full import of " + collectionKey)
-                fullImportResult = mongoConn.iDBFullImport(occurrenceFile, collectionKey, collectionModified)
-                if fullImportResult is False:
-                    self.logger.error("Import of " + collectionKey + " Failed")
-                self.logger.info("Imported " + collectionKey)
-            elif collectionStatus == 'modified':
-                self.logger.info("Doing partial import of " + collectionKey)
-                partialImportResult = mongoConn.iDBPartialImport(occurrenceFile, collectionKey, collectionModified, 'csv')
-                if partialImportResult is False:
-                    self.logger.error("There were at least some errors during import of " + collectionKey)
-                    print "Imported with at least some errors"
-                else:
-                    self.logger.info("Updated records in " + collectionKey)
+            self.logIngestCount(mongoConn, ingestHelpers.csvCountRows(occurrenceFile))
 
-    		# Once we're done delete the ZIP and directory and move on to the next!
-            self.logger.debug("Deleting " + collectionKey + " & " + collectionDir)
-            os.remove(collectionKey)
-            shutil.rmtree(collectionDir)
+        # TODO Image check and merge
 
-        return True
+        # Every collection is new to the shadow collection
+        self.logger.info("Doing full import of " + collectionKey)
+        fullImportResult = mongoConn.iDBFullImport(occurrenceFile, collectionKey, collectionModified, collection=shadowName, statusCollection=shadowStatus)
+        if fullImportResult is False:
+            self.logger.error("Import of " + collectionKey + " Failed")
+        else:
+            self.logger.info("Imported " + collectionKey)
+
+        if self.stream:
+            self.logIngestCount(mongoConn, rowCounter.get('rows', 0))
+        return fullImportResult
 
-    def idbAPIDownload(self, requestURL):
+    def idbAPIDownload(self, requestURL, work=None):
+        # work is the scratch workspace the download is extracted into
         # Generate the request to iDigBio for records changed in the specified range
         modifiedStatusURL = self.generateIDBRecordRequest(requestURL)
         if modifiedStatusURL is False:
@@ -202,8 +463,11 @@ class idigbio:
         if collectionMatch:
             collectionKey = collectionMatch.group(1)
 
+        if self.stream:
+            return self.streamCollection(self.refreshDownloadURL, collectionKey), collectionKey
+
         # Download & unzip the zip file!
-        collectionDir = self.downloadCollection(self.refreshDownloadURL, collectionKey)
+        collectionDir = self.downloadCollection(self.refreshDownloadURL, collectionKey, work)
         if not collectionDir:
             return False
 
@@ -253,27 +517,35 @@ class idigbio:
 
 
 
-    def downloadCollection(self, collectionRoot, collectionKey):
+    def downloadCollection(self, collectionRoot, collectionKey, work):
         self.logger.debug("Downloading collection " + collectionKey)
         sourceColl = urllib2.urlopen(collectionRoot + collectionKey).read()
+        zipPath = work.path(collectionKey)
         try:
-            with open(collectionKey, 'wb') as zip_file:
+            with open(zipPath, 'wb') as zip_file:
                 zip_file.write(sourceColl)
             # Unzip the zip file!
-            collectionDir = collectionKey[:-4]
-            with zipfile.ZipFile(collectionKey, 'r') as unzip:
+            collectionDir = work.path(collectionKey[:-4])
+            with zipfile.ZipFile(zipPath, 'r') as unzip:
                 unzip.extractall(collectionDir)
         except zipfile.BadZipfile:
             self.logger.error("This file cannot be unzipped! Manually check for validity: " + collectionKey)
             return None
         return collectionDir
 
+    def streamCollection(self, collectionRoot, collectionKey):
+        # Yields the validated occurrence file from a zip as it downloads
+        self.logger.debug("Streaming collection " + collectionKey)
+        zipChunks = streamHelpers.httpChunks(collectionRoot + collectionKey)
+        occurrenceChunks = streamHelpers.zipMemberChunks(zipChunks, self.occurrenceFiles)
+        return streamHelpers.normalizeHeaderChunks(occurrenceChunks, self.headerChecklist)
+
     def checkCollection(self, collectionDir):
         self.logger.debug("Checking collection directory" + collectionDir)
         dirContents = os.listdir(collectionDir)
         validFile = False
         for collFile in dirContents:
-            if collFile in ['occurrence.txt', 'occurrence.csv']:
+            if collFile in self.occurrenceFiles:
                 self.logger.info("Found valid " + collFile + " in " + collectionDir)
                 occurrenceFile = collectionDir + '/' + collFile
                 validFile = True
@@ -283,8 +555,7 @@ class idigbio:
             return None
         occurrenceHeader = pd.read_csv(occurrenceFile, sep=",", nrows=1)
         occurrenceHeadList = list(occurrenceHeader.columns.values)
-        headerChecklist = ['idigbio:uuid', 'idigbio:institutionName', 'dwc:genus', 'dwc:specificEpithet', 'dwc:country', 'dwc:stateProvince', 'dwc:earliestAgeOrLowestStage', 'dwc:latestAgeOrHighestStage', 'dwc:formation']
-        for check in headerChecklist:
+        for check in self.headerChecklist:
             if check not in occurrenceHeadList:
                 self.logger.error(occurrenceFile + "is not a valid CSV or TXT. Check source collection for validity")
                 self.logger.debug("Header list for invalid file: " + str(occurrenceHeadList))
@@ -295,6 +566,9 @@ class idigbio:
         return occurrenceFile
 
     def getRecordCount(self):
+        # A sample has no provider count to be checked against
+        if self.sampleSets:
+            return None
         self.logger.debug("Checking full PBDB record Count")
         resp = requests.get(self.recordCountURL)
         if resp.status_code == 200:
@@ -347,17 +621,27 @@ class idigbio:
 
     def deleteRecords(self, setID):
         specimenUUIDs = set()
-        downloadURL = self.apiDownloadRoot+'{"recordset": ' + setID + '}'
-        # Download the relevant collection from the API
-        occurrenceFile = idbAPIDownload(self.refreshURL)
-        with open(occurrenceFile, 'rb') as csvFile:
-            specimenReader = csv.reader(csvFile)
-            for specimen in specimenReader:
+        downloadURL = self.apiDownloadRoot + '{"recordset":"' + setID + '"}'
+        # Download the relevant collection from the API. Only the UUIDs are
+        # kept once the workspace is removed
+        with self.scratch.workspace('delete-' + setID, 0 if self.stream else None) as work:
+            downloadResult = self.idbAPIDownload(downloadURL, work)
+            if not downloadResult:
+                self.logger.error("Could not download recordset " + setID + " to check for deleted records")
+                return False
+            occurrenceFile, collectionKey = downloadResult
+            if self.stream:
+                csvFile = streamHelpers.chunkFile(occurrenceFile)
+            else:
+                csvFile = open(occurrenceFile, 'rb')
+            for specimen in csv.DictReader(csvFile):
                 specimenUUIDs.add(specimen['idigbio:uuid'])
+            if not self.stream:
+                csvFile.close()
 
         # open a mongo connection
         mongoConn = mongoConnect.mongoConnect()
-        idbRecordSets = mongoConn.idbCheckAndDeleteRecords(setID, specimenUUIDs)
-
-
+        deletedCount = mongoConn.idbCheckAndDeleteRecords(setID, specimenUUIDs, self.ingestLog)
         mongoConn.closeConnection()
+        self.logger.info("Removed " + str(deletedCount) + " deleted specimens from " + setID)
+        return deletedCount
@@ -17,28 +17,58 @@ import os
 import os.path
 import shutil
 import logging
+import math
+import time
+import csv
+from datetime import datetime
 
 # local stuff
 import mongoConnect
+from helpers import dryRunHelpers
 from helpers import ingestHelpers
+from helpers import sampleHelpers
+from helpers import scratchHelpers
+from helpers import streamHelpers
 from helpers import testHelpers
 
 class paleobio:
-    def __init__(self, test, fullRefresh, ingestLog):
-        self.config = json.load(open('./config.json'))
+    def __init__(self, test, fullRefresh, ingestLog, stream=False):
+        self.config = mongoConnect.loadConfig()
         self.source = "pbdb"
+        self.stream = stream
+        self.fullRefresh = fullRefresh
         self.logger = logging.getLogger("ingest.paleobio")
         ingestInterval = self.config['pbdb_ingest_interval'] + 'd'
         if test:
             ingestInterval = '24h'
         elif fullRefresh:
             ingestInterval = '1900'
-        self.occurrenceURL = 'https://paleobiodb.org/data1.2/occs/list.csv?all_records&show=full&occs_modified_after=' + ingestInterval
-        self.collectionURL = 'https://paleobiodb.org/data1.2/colls/list.csv?all_records&show=full&colls_modified_after=' + ingestInterval
-        self.referenceURL = 'https://paleobiodb.org/data1.2/refs/list.csv?all_records&show=both&refs_modified_after=' + ingestInterval
+        self.setIngestInterval(ingestInterval)
         self.recordCountURL = 'https://paleobiodb.org/data1.2/occs/list.json?all_records&rowcount&limit=1'
         self.ingestLog = ingestLog
         self.tests = testHelpers.epanddaTests(None, None)
+        self.scratch = scratchHelpers.getScratch(self.config)
+        self.sampleSize = None
+        self.sampleSeed = 0
+
+    def setIngestInterval(self, ingestInterval):
+        self.occurrenceURL = 'https://paleobiodb.org/data1.2/occs/list.csv?all_records&show=full&occs_modified_after=' + ingestInterval
+        self.collectionURL = 'https://paleobiodb.org/data1.2/colls/list.csv?all_records&show=full&colls_modified_after=' + ingestInterval
+        self.referenceURL = 'https://paleobiodb.org/data1.2/refs/list.csv?all_records&show=both&refs_modified_after=' + ingestInterval
+
+    def setSample(self, sampleSize, seed):
+        # Sampled test runs do a full ingest of a seeded page of occurrences
+        # with only the collections and references they cite. The sample is
+        # small, so it is always downloaded to files
+        self.sampleSize = sampleSize or self.config.get('sample_records', 1000)
+        self.sampleSeed = seed
+        self.stream = False
+
+    def setRefreshWindow(self, refreshDate):
+        # The daemon narrows this to the time since its last completed run.
+        # PBDB takes the window as a number of hours before now
+        hours = int(math.ceil((datetime.utcnow() - refreshDate).total_seconds() / 3600.0))
+        self.setIngestInterval(str(max(1, hours)) + 'h')
 
     # This is the main component of the ingester, and relies on a few different
     # helpers. But most of this code is specific to PaleoBio
@@ -46,34 +76,63 @@ class paleobio:
         # Should this be a dry or test run?
         dryRun = dry
         testRun = test
-        # Download source PBDB spreadsheets
-        self.logger.info("Starting download from PaleoBio")
-        downloadResults = self.downloadFromPBDB()
-        if downloadResults is False:
-            self.logger.error("A download failed! Ingest halted")
-            return False
-        self.logger.info("Completed paleobio download")
+        if dryRun:
+            return self.runDryIngest()
+        # Downloads and the tmp_occurrence export live in a scratch workspace
+        # that is removed however the ingest ends
+        with self.scratch.workspace('pbdb', 0 if self.stream else None) as work:
+            return self.runIngestIn(work)
 
+    def runIngestIn(self, work):
         # open a mongo connection
         mongoConn = mongoConnect.mongoConnect()
         downloadedFiles = ['occurrence.csv', 'collection.csv', 'reference.csv']
+        if self.stream:
+            # Stream the PBDB spreadsheets straight into the temporary collections
+            rowCounter = {}
+            csvSources = [
+                ('occurrence', streamHelpers.countingChunks(streamHelpers.httpChunks(self.occurrenceURL), rowCounter)),
+                ('collection', streamHelpers.httpChunks(self.collectionURL)),
+                ('reference', streamHelpers.httpChunks(self.referenceURL))
+            ]
+        else:
+            # Download source PBDB spreadsheets
+            self.logger.info("Starting download from PaleoBio")
+            if self.sampleSize:
+                downloadResults = self.downloadSample(work)
+            else:
+                downloadResults = self.downloadFromPBDB(work)
+            if downloadResults is False:
+                self.logger.error("A download failed! Ingest halted")
+                return False
+            self.logger.info("Completed paleobio download")
+            csvSources = [(csvFile[:-4], work.path(csvFile)) for csvFile in downloadedFiles]
+
         # Ingest records into temporary mongo collections for easier merging
         self.logger.info("Creating ingest collections")
-        tmpCollectionResults = mongoConn.pbdbIngestTmpCollections(downloadedFiles)
+        tmpCollectionResults = mongoConn.pbdbIngestTmpCollections(csvSources)
         if tmpCollectionResults is False:
             self.logger.error("Could not create all necessary mongo collections. Halting")
             return False
         self.logger.info("Created PaleoBio temporary collections")
+        # Empty fields are dropped from the temporary collections, so the
+        # merged documents written to pbdb_coll are already compact
+        mongoConn.addCompactionLog(self.ingestLog, self.source)
 
         # Get the count of records being imported and store it in the ingest log
-        recordCount = ingestHelpers.csvCountRows('occurrence.csv')
+        if self.stream:
+            recordCount = rowCounter.get('rows', 0)
+        else:
+            recordCount = ingestHelpers.csvCountRows(work.path('occurrence.csv'))
         recordCountResult = mongoConn.addToIngestCount(self.ingestLog, self.source, recordCount)
         if recordCountResult is False:
             self.logger.error("Could not log record count. Check validity carefully!")
 
-        for csvFile in downloadedFiles:
-            os.remove(csvFile)
-            self.logger.debug("Deleted source file: " + csvFile)
+        if not self.stream:
+            # Free the scratch space for the export of the merged occurrences
+            for csvFile in downloadedFiles:
+                os.remove(work.path(csvFile))
+                self.logger.debug("Deleted source file: " + csvFile)
         # Merge collections and references into occurrence collection
         self.logger.info("Merging temporary collections")
         mergeResult = mongoConn.pbdbMergeTmpCollections('tmp_occurrence', 'tmp_collection', 'tmp_reference')
@@ -82,12 +141,33 @@ class paleobio:
             return False
         self.logger.info("Created merged dataset")
 
-        # Merge new data into main pbdb collection
-        ingestResult = mongoConn.pbdbMergeNewData('tmp_occurrence')
+        # Merge new data into main pbdb collection. Full refreshes are built in
+        # a shadow collection and swapped in once they have been verified
+        shadowName = None
+        if self.fullRefresh:
+            shadowName = mongoConn.prepareShadowCollection(self.source)
+        ingestResult = mongoConn.pbdbMergeNewData('tmp_occurrence', stream=self.stream, collection=shadowName, exportPath=work.path('tmp_occurrence.json'))
+        # The unique occurrence_no index is on the collection merged into, so
+        # this is where duplicates are skipped
+        mongoConn.addDuplicateLog(self.ingestLog, self.source)
         if ingestResult is False:
             self.logger.error("There was an error ingesting new records. Halting and please review the log")
             return False
-        os.remove('tmp_occurrence.json')
+        if not self.stream:
+            os.remove(work.path('tmp_occurrence.json'))
+        if self.fullRefresh:
+            promoteResult = self.tests.promoteShadowCollection(self.source, self, shadowName)
+            if promoteResult is False:
+                self.logger.error("Full refresh of PaleoBio was not swapped in")
+                return False
+
+        # Update the linkage and summaries for the occurrences from this run
+        if self.fullRefresh:
+            endpointResult = mongoConn.updateEndpoints(self.source, rebuild=True, ingestID=self.ingestLog)
+        else:
+            endpointResult = mongoConn.updateEndpoints(self.source, records=mongoConn.pbdbTmpOccurrenceNos('tmp_occurrence'), ingestID=self.ingestLog)
+        if endpointResult is False:
+            self.logger.error("PaleoBio linkage/summaries were not fully updated, rebuild them with --rebuildEndpoints")
 
         # Create sentinels on the ingested data
         sentinelStatus = self.tests.createSentinels(['pbdb'])
@@ -97,21 +177,111 @@ class paleobio:
 
         return True
 
-    def downloadFromPBDB(self):
+    def runDryIngest(self):
+        # Downloads and parses the PBDB spreadsheets and diffs the occurrences
+        # against pbdb_coll without writing to mongo. Collections and
+        # references are only merged into the occurrences, so they are parsed
+        # but not diffed. The report is kept for the run summary
+        with self.scratch.workspace('dry-pbdb', 0 if self.stream else None) as work:
+            return self.runDryIngestIn(work)
+
+    def runDryIngestIn(self, work):
+        mongoConn = mongoConnect.mongoConnect()
+        report = dryRunHelpers.dryRunReport(self.source, self.fullRefresh)
+        downloadedFiles = ['occurrence.csv', 'collection.csv', 'reference.csv']
+        if self.stream:
+            report.notes.append("Streamed downloads are read as they are parsed, so parse times include the download")
+            csvSources = [
+                ('occurrence', report.meter.timed('download', streamHelpers.httpChunks(self.occurrenceURL))),
+                ('collection', report.meter.timed('download', streamHelpers.httpChunks(self.collectionURL))),
+                ('reference', report.meter.timed('download', streamHelpers.httpChunks(self.referenceURL)))
+            ]
+        else:
+            self.logger.info("Starting dry run download from PaleoBio")
+            downloadStart = time.time()
+            if self.downloadFromPBDB(work) is False:
+                self.logger.error("A download failed! Dry run halted")
+                mongoConn.closeConnection()
+                return False
+            report.meter.add('download', sum(os.path.getsize(work.path(csvFile)) for csvFile in downloadedFiles), time.time() - downloadStart)
+            csvSources = [(csvFile[:-4], work.path(csvFile)) for csvFile in downloadedFiles]
+
+        schemaName = self.source if self.config.get('typed_import', False) else None
+        dryResult = True
+        for sourceName, csvSource in csvSources:
+            if isinstance(csvSource, basestring):
+                duplicateHeaders = ingestHelpers.csvDuplicateHeaderCheck(csvSource)
+                if duplicateHeaders:
+                    ingestHelpers.csvRenameDuplicateHeaders(csvSource, duplicateHeaders)
+            else:
+                csvSource = streamHelpers.normalizeHeaderChunks(csvSource)
+            if sourceName == 'occurrence':
+                dryResult = mongoConn.dryRunImport(self.source, csvSource, report)
+                if dryResult is False:
+                    break
+            else:
+                dryRunHelpers.parseSource(report, 'parse ' + sourceName + 's', csvSource, schemaName)
+        if dryResult is False:
+            mongoConn.closeConnection()
+            return False
+
+        if self.fullRefresh:
+            report.setDeleted(mongoConn.getCollectionCount(self.source, exact=True))
+        ingests = mongoConn.getIngestHistory(self.config.get('regression', {}).get('history', 90))
+        self.dryRunReport = report.build(ingests)
+        mongoConn.closeConnection()
+        return True
+
+    def downloadFromPBDB(self, work):
         for downloadURL in [('occurrence', self.occurrenceURL), ('collection', self.collectionURL), ('reference', self.referenceURL)]:
             self.logger.debug("Downloading " + downloadURL[0] + " from PaleoBio")
             sourceCSV = urllib2.urlopen(downloadURL[1]).read()
-            with open(downloadURL[0]+".csv", "wb") as csvFile:
+            with open(work.path(downloadURL[0]+".csv"), "wb") as csvFile:
                 csvFile.write(sourceCSV)
             # Verify that file exists
-            if os.path.isfile(downloadURL[0]+".csv"):
+            if os.path.isfile(work.path(downloadURL[0]+".csv")):
                 self.logger.info("Successfully downloaded " + downloadURL[0])
             else:
                 self.logger.error("Failed to download " + downloadURL[0])
                 return False
         return True
 
+    def downloadSample(self, work):
+        totalCount = self.getProviderCount()
+        if not totalCount:
+            self.logger.error("Could not get the PBDB record count to sample from")
+            return False
+        offset = sampleHelpers.sampleOffset(totalCount, self.sampleSize, self.sampleSeed)
+        self.logger.info("Sampling %d PBDB occurrences from offset %d", self.sampleSize, offset)
+        occurrenceURL = 'https://paleobiodb.org/data1.2/occs/list.csv?all_records&show=full&limit=' + str(self.sampleSize) + '&offset=' + str(offset)
+        with open(work.path("occurrence.csv"), "wb") as csvFile:
+            csvFile.write(urllib2.urlopen(occurrenceURL).read())
+        with open(work.path("occurrence.csv"), "rb") as csvFile:
+            occurrences = list(csv.DictReader(csvFile))
+        # Only the collections and references of the sampled occurrences
+        idLists = [
+            ('collection', 'https://paleobiodb.org/data1.2/colls/list.csv?all_records&show=full&coll_id=', 'collection_no'),
+            ('reference', 'https://paleobiodb.org/data1.2/refs/list.csv?all_records&show=both&ref_id=', 'reference_no')
+        ]
+        for sourceName, listURL, idField in idLists:
+            ids = sorted(set(occurrence[idField] for occurrence in occurrences if occurrence.get(idField)))
+            with open(work.path(sourceName + ".csv"), "wb") as csvFile:
+                for start in range(0, len(ids), 200):
+                    sourceCSV = urllib2.urlopen(listURL + ','.join(ids[start:start + 200])).read()
+                    if start:
+                        # Only the first request keeps its header row
+                        sourceCSV = sourceCSV.split('\n', 1)[1] if '\n' in sourceCSV else ''
+                    csvFile.write(sourceCSV)
+            self.logger.info("Downloaded %d sampled %ss", len(ids), sourceName)
+        return True
+
     def getRecordCount(self):
+        # A sample has no provider count to be checked against
+        if self.sampleSize:
+            return None
+        return self.getProviderCount()
+
+    def getProviderCount(self):
         self.logger.debug("Checking full PBDB record Count")
         resp = requests.get(self.recordCountURL)
         if resp.status_code == 200: